@@ -1,7 +1,10 @@
 import dash_uploader
-from dash import Dash, dcc, html
+import flask
+import diskcache
+from dash import Dash, DiskcacheManager, dcc, html
 
 from modules.functions.functions_shared import *
+from modules.functions.functions_mask import configure_mask_edits
 
 from modules.interface import (
     widgets_browser,
@@ -10,6 +13,9 @@ from modules.interface import (
     widgets_moke,
     widgets_xrd,
     widgets_hdf5,
+    widgets_catalogue,
+    widgets_comparison,
+    widgets_correlation,
 )
 from modules.callbacks import (
     callbacks_browser,
@@ -18,6 +24,9 @@ from modules.callbacks import (
     callbacks_moke,
     callbacks_xrd,
     callbacks_hdf5,
+    callbacks_catalogue,
+    callbacks_comparison,
+    callbacks_correlation,
 )
 
 pd.set_option('display.max_colwidth', None)
@@ -26,20 +35,50 @@ pd.set_option('display.max_columns', None)
 folderpath = None
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
-os.chdir(script_dir)
 
 PROGRAM_VERSION = '0.12 beta'
 UPLOAD_FOLDER_ROOT = os.path.join(script_dir, "uploads")
+CACHE_FOLDER_ROOT = os.path.join(script_dir, "cache")
+# Folder opened by the browser tab at startup, the app folder unless set in the environment
+DATA_FOLDER_ROOT = os.path.abspath(os.environ.get("DATA_FOLDER", script_dir))
 
-# Clean the upload folder
-cleanup_directory(UPLOAD_FOLDER_ROOT)
+# Clean the upload folder, recent uploads may belong to sessions served by other workers
+UPLOAD_MAX_AGE = 24 * 3600
+cleanup_directory(UPLOAD_FOLDER_ROOT, max_age=UPLOAD_MAX_AGE)
+
+# Results dataframes and measurement arrays are cached on disk, shared by all the server workers
+configure_shared_cache(os.path.join(CACHE_FOLDER_ROOT, "shared"))
+
+# Mask edits are buffered on disk until written to the files, apart from the shared cache so that they are never evicted
+configure_mask_edits(os.path.join(CACHE_FOLDER_ROOT, "mask_edits"))
+
+# Interactive reads and batch jobs run in separate scheduler lanes, see functions_shared.scheduled
+configure_scheduler(os.path.join(CACHE_FOLDER_ROOT, "scheduler"))
 
 # %%
-app = Dash(suppress_callback_exceptions=True)
+# Long callbacks (imports, batch fits, exports, loop maps) run as background jobs in separate processes,
+# queued on disk so that no external broker is needed
+background_callback_manager = DiskcacheManager(diskcache.Cache(os.path.join(CACHE_FOLDER_ROOT, "background_jobs")))
+
+# Responses are gzip compressed (flask-compress), figures are mostly base64 typed arrays, see compact_figure
+app = Dash(suppress_callback_exceptions=True, compress=True, background_callback_manager=background_callback_manager)
 
 dash_uploader.configure_upload(app, UPLOAD_FOLDER_ROOT)
 
-children_browser = widgets_browser.WidgetsBROWSER()
+
+# Scheduler queue depth and wait times as json, also shown in the HDF5 tab
+@app.server.route("/scheduler")
+def scheduler_stats():
+    return flask.jsonify(get_scheduler_stats())
+
+
+# Neighbour prefetch hit rate and time saved as json, also shown in the HDF5 tab
+@app.server.route("/prefetch")
+def prefetch_stats():
+    return flask.jsonify(get_prefetch_stats())
+
+
+children_browser = widgets_browser.WidgetsBROWSER(DATA_FOLDER_ROOT)
 browser_tab = children_browser.make_tab_from_widgets()
 
 children_hdf5 = widgets_hdf5.WidgetsHDF5(UPLOAD_FOLDER_ROOT)
@@ -57,6 +96,15 @@ moke_tab = children_moke.make_tab_from_widgets()
 children_xrd = widgets_xrd.WidgetsXRD(folderpath)
 xrd_tab = children_xrd.make_tab_from_widgets()
 
+children_catalogue = widgets_catalogue.WidgetsCATALOGUE(CACHE_FOLDER_ROOT)
+catalogue_tab = children_catalogue.make_tab_from_widgets()
+
+children_comparison = widgets_comparison.WidgetsCOMPARISON(CACHE_FOLDER_ROOT)
+comparison_tab = children_comparison.make_tab_from_widgets()
+
+children_correlation = widgets_correlation.WidgetsCORRELATION()
+correlation_tab = children_correlation.make_tab_from_widgets()
+
 
 # Defining the main window layout
 app.layout = html.Div(
@@ -64,9 +112,11 @@ app.layout = html.Div(
         dcc.Tabs(
             id="tabs",
             value="browser",
-            children=[browser_tab, hdf5_tab, profil_tab, edx_tab, moke_tab, xrd_tab],
+            children=[browser_tab, hdf5_tab, profil_tab, edx_tab, moke_tab, xrd_tab, catalogue_tab, comparison_tab, correlation_tab],
 
-        )
+        ),
+        # Writes the buffered heatmap edit mode toggles, whatever the open tab
+        dcc.Interval(id="mask_flush_interval", interval=10000),
     ],
     className="window_layout",
 )
@@ -78,6 +128,12 @@ callbacks_profil.callbacks_profil(app)
 callbacks_edx.callbacks_edx(app)
 callbacks_moke.callbacks_moke(app, children_moke)
 callbacks_xrd.callbacks_xrd(app, children_xrd)
+callbacks_catalogue.callbacks_catalogue(app)
+callbacks_comparison.callbacks_comparison(app)
+callbacks_correlation.callbacks_correlation(app)
+
+# WSGI entry point for production serving, run_production.sh serves app:server with gunicorn
+server = app.server
 
 if __name__ == "__main__":
     app.run(debug=True, port=8050)
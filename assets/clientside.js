@@ -0,0 +1,39 @@
+/*
+Clientside callbacks, executed in the browser without a round-trip to the server
+*/
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    heatmap: {
+        // Copy the clicked heatmap position to the tab position store
+        update_position: function (heatmap_click) {
+            if (!heatmap_click) {
+                return null;
+            }
+            const point = heatmap_click.points[0];
+            return [point.x, point.y];
+        },
+
+        // Restyle zmin/zmax and the colorbar ticks of the displayed heatmap, same ticks as functions_shared.colorbar_layout
+        update_color_range: function (z_min, z_max, precision, figure) {
+            if (!figure || !figure.data || figure.data.length === 0 || z_min === null || z_max === null
+                || z_min === undefined || z_max === undefined) {
+                return window.dash_clientside.no_update;
+            }
+
+            const digits = Math.max(0, parseInt(precision) || 0);
+            const z_mid = (z_min + z_max) / 2;
+            const tick_values = [z_min, (z_min + z_mid) / 2, z_mid, (z_max + z_mid) / 2, z_max];
+
+            const heatmap = Object.assign({}, figure.data[0], {
+                zmin: z_min,
+                zmax: z_max,
+                colorbar: Object.assign({}, figure.data[0].colorbar, {
+                    tickvals: tick_values,
+                    ticktext: tick_values.map(value => value.toFixed(digits)),
+                }),
+            });
+
+            return Object.assign({}, figure, {data: [heatmap].concat(figure.data.slice(1))});
+        },
+    },
+});
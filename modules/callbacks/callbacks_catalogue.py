@@ -0,0 +1,88 @@
+from ..functions.functions_catalogue import *
+
+'''Callbacks for catalogue tab'''
+
+def callbacks_catalogue(app):
+
+    # Display the catalogued folder (data folder set in the browser tab) and the catalogue content
+    @app.callback(
+        [Output("catalogue_path_box", "children"),
+         Output("catalogue_summary_table", "data"),
+         Output("catalogue_summary_table", "columns"),
+         Output("catalogue_quantity_0", "options"),
+         Output("catalogue_quantity_1", "options"),
+         Output("catalogue_quantity_2", "options")],
+        Input("data_path_store", "data"),
+        Input("catalogue_text_box", "children"),
+        State("catalogue_db_path", "data"),
+    )
+    def catalogue_load_summary(data_path, text_box, db_path):
+        if data_path is None:
+            return "Select a data folder in the browser tab", [], [], [], [], []
+
+        summary_df = catalogue_get_summary(db_path, data_path)
+        quantities = catalogue_get_quantities(db_path, data_path)
+        columns = [{"name": column, "id": column} for column in summary_df.columns]
+
+        return f"Catalogue of {data_path}", summary_df.to_dict("records"), columns, quantities, quantities, quantities
+
+
+    # Index the new and modified HDF5 files of the data folder
+    @app.callback(
+        Output("catalogue_text_box", "children", allow_duplicate=True),
+        Input("catalogue_update_button", "n_clicks"),
+        State("data_path_store", "data"),
+        State("catalogue_db_path", "data"),
+        background=True,
+        progress=Output("catalogue_text_box", "children"),
+        running=[
+            (Output("catalogue_update_button", "disabled"), True, False),
+            (Output("catalogue_cancel_button", "style"), {"display": "inline-block"}, {"display": "none"}),
+        ],
+        cancel=[Input("catalogue_cancel_button", "n_clicks")],
+        prevent_initial_call=True,
+    )
+    @scheduled("batch")
+    def catalogue_update_folder(set_progress, n_clicks, data_path, db_path):
+        if n_clicks > 0:
+            if data_path is None:
+                return "Select a data folder in the browser tab to catalogue"
+            counts = catalogue_update(db_path, data_path, progress_callback=set_progress)
+            return (f"Catalogue updated: {counts['added']} added, {counts['updated']} updated, "
+                    f"{counts['unchanged']} unchanged, {counts['removed']} removed")
+
+
+    # Search the catalogue for positions matching all the conditions
+    @app.callback(
+        [Output("catalogue_results_table", "data"),
+         Output("catalogue_results_table", "columns"),
+         Output("catalogue_plot", "figure"),
+         Output("catalogue_text_box", "children", allow_duplicate=True)],
+        Input("catalogue_search_button", "n_clicks"),
+        [State(f"catalogue_{field}_{index}", "value") for index in range(3)
+         for field in ["quantity", "operator", "value"]],
+        State("data_path_store", "data"),
+        State("catalogue_db_path", "data"),
+        prevent_initial_call=True,
+    )
+    @scheduled("interactive")
+    def catalogue_search(n_clicks, *args):
+        condition_values, data_path, db_path = args[:-2], args[-2], args[-1]
+        conditions = [
+            (quantity, operator, value)
+            for quantity, operator, value in zip(*[iter(condition_values)] * 3)
+            if quantity is not None and value is not None
+        ]
+        if not conditions:
+            return [], [], go.Figure(layout=plot_layout("")), "Select at least one quantity and value"
+
+        start = time.perf_counter()
+        df = catalogue_query(db_path, conditions, data_path)
+        elapsed = time.perf_counter() - start
+
+        columns = [{"name": column, "id": column} for column in df.columns if column != "file_path"]
+        fig = catalogue_plot_matches(df)
+        message = (f"{len(df)} positions on {df['file_path'].nunique()} wafers match "
+                   f"({1000 * elapsed:.1f} ms)")
+
+        return df.drop(columns="file_path").to_dict("records"), columns, compact_figure(fig), message
@@ -0,0 +1,90 @@
+from ..functions.functions_comparison import *
+from ..functions.functions_catalogue import catalogue_update, catalogue_get_quantities
+
+'''Callbacks for comparison tab'''
+
+def callbacks_comparison(app):
+
+    # List the catalogued quantities of the data folder (set in the browser tab)
+    @app.callback(
+        [Output("comparison_path_box", "children"),
+         Output("comparison_quantity", "options")],
+        Input("data_path_store", "data"),
+        Input("comparison_text_box", "children"),
+        State("comparison_db_path", "data"),
+    )
+    def comparison_load_quantities(data_path, text_box, db_path):
+        if data_path is None:
+            return "Select a data folder in the browser tab", []
+
+        return f"Comparison of {data_path}", catalogue_get_quantities(db_path, data_path)
+
+
+    # List the maps holding the selected quantity
+    @app.callback(
+        Output("comparison_entries", "options"),
+        Input("comparison_quantity", "value"),
+        Input("comparison_quantity", "options"),
+        State("data_path_store", "data"),
+        State("comparison_db_path", "data"),
+    )
+    def comparison_load_entries(quantity, quantity_options, data_path, db_path):
+        if quantity is None or data_path is None:
+            return []
+
+        summary_df = comparison_get_summaries(db_path, quantity, data_path)
+        return [{"label": f"{sample_name} ({dataset})", "value": entry}
+                for sample_name, dataset, entry in
+                zip(summary_df["sample_name"], summary_df["dataset"], summary_df["entry"])]
+
+
+    # Update the catalogue of the data folder then plot the selected maps with a shared colour range
+    @app.callback(
+        [Output("comparison_plot", "figure"),
+         Output("comparison_range_box", "children"),
+         Output("comparison_text_box", "children", allow_duplicate=True)],
+        Input("comparison_button", "n_clicks"),
+        State("comparison_quantity", "value"),
+        State("comparison_entries", "value"),
+        State("comparison_range_mode", "value"),
+        State("comparison_z_min", "value"),
+        State("comparison_z_max", "value"),
+        State("comparison_columns", "value"),
+        State("data_path_store", "data"),
+        State("comparison_db_path", "data"),
+        background=True,
+        progress=Output("comparison_text_box", "children"),
+        running=[(Output("comparison_button", "disabled"), True, False)],
+        prevent_initial_call=True,
+    )
+    @scheduled("interactive")
+    def comparison_plot_folder(set_progress, n_clicks, quantity, entry_list, range_mode, z_min, z_max, nb_columns,
+                               data_path, db_path):
+        if data_path is None:
+            return no_update, "", "Select a data folder in the browser tab"
+        if quantity is None:
+            return no_update, "", "Select a quantity to compare"
+
+        start = time.perf_counter()
+        # Only new or modified files are read, usually none
+        counts = catalogue_update(db_path, data_path, progress_callback=set_progress)
+
+        summary_df = comparison_select_entries(comparison_get_summaries(db_path, quantity, data_path), entry_list)
+        if summary_df.empty:
+            return go.Figure(layout=plot_layout("")), "", f"No wafer holds {quantity}"
+
+        z_min, z_max = comparison_get_colour_range(summary_df, range_mode, z_min, z_max)
+        maps_df = comparison_get_maps(db_path, quantity, summary_df)
+
+        units = summary_df["units"].dropna().iloc[0] if summary_df["units"].notna().any() else ""
+        fig = comparison_plot_maps(summary_df, maps_df, z_min, z_max, nb_columns or COMPARISON_COLUMNS,
+                                   colorbar_title=f"{quantity} ({units})" if units else quantity)
+        elapsed = time.perf_counter() - start
+
+        range_text = (f"{quantity}: colour range {z_min:.4g} to {z_max:.4g}, values from "
+                      f"{summary_df['min'].min():.4g} to {summary_df['max'].max():.4g}, "
+                      f"median of the wafer medians {summary_df['median'].median():.4g}")
+        message = (f"{len(summary_df)} maps compared in {elapsed:.2f} s "
+                   f"({counts['added'] + counts['updated']} files indexed)")
+
+        return compact_figure(fig), range_text, message
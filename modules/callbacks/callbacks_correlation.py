@@ -0,0 +1,74 @@
+from ..functions.functions_correlation import *
+
+'''Callbacks for correlation tab'''
+
+def callbacks_correlation(app):
+
+    # List the datasets with results and their quantities
+    @app.callback(
+        [Output("correlation_path_box", "children"),
+         Output("correlation_reference", "options"),
+         Output("correlation_reference", "value"),
+         Output("correlation_x", "options"),
+         Output("correlation_y", "options"),
+         Output("correlation_color", "options")],
+        Input("hdf5_path_store", "data"),
+    )
+    @check_conditions(correlation_conditions, hdf5_path_index=0)
+    def correlation_scan_hdf5_for_results(hdf5_path):
+        df_dict = correlation_read_results(hdf5_path)
+        if not df_dict:
+            return f"No results found in {hdf5_path.name}", [], None, [], [], []
+
+        quantities = [quantity for df in df_dict.values() for quantity in correlation_get_quantities(df)]
+        dataset_list = list(df_dict)
+
+        return hdf5_path.name, dataset_list, dataset_list[0], quantities, quantities, quantities
+
+
+    # Join the datasets on the reference positions, plot the selected quantities and the correlation matrix
+    @app.callback(
+        [Output("correlation_scatter", "figure"),
+         Output("correlation_matrix", "figure"),
+         Output("correlation_match_box", "children"),
+         Output("correlation_text_box", "children")],
+        Input("correlation_reference", "value"),
+        Input("correlation_tolerance", "value"),
+        Input("correlation_join_mode", "value"),
+        Input("correlation_x", "value"),
+        Input("correlation_y", "value"),
+        Input("correlation_color", "value"),
+        State("hdf5_path_store", "data"),
+        prevent_initial_call=True,
+    )
+    @check_conditions(correlation_conditions, hdf5_path_index=6)
+    @scheduled("interactive")
+    def correlation_update_plots(reference, tolerance, join_mode, x_column, y_column, color_column, hdf5_path):
+        if reference is None:
+            raise PreventUpdate
+
+        start = time.perf_counter()
+        df_dict = correlation_read_results(hdf5_path)
+        if reference not in df_dict:
+            raise PreventUpdate
+        joined_df, match_counts = correlation_spatial_join(
+            df_dict, reference, CORRELATION_TOLERANCE if tolerance is None else tolerance, join_mode
+        )
+        elapsed = time.perf_counter() - start
+
+        quantities = correlation_get_quantities(joined_df)
+        matrix_fig = correlation_plot_matrix(joined_df, quantities)
+        match_text = "\n".join(f"{dataset}: {count}/{len(df_dict[reference])} positions matched"
+                               for dataset, count in match_counts.items())
+
+        if x_column not in joined_df.columns or y_column not in joined_df.columns:
+            return (go.Figure(layout=plot_layout("")), compact_figure(matrix_fig), match_text,
+                    f"{len(joined_df)} positions joined in {1000 * elapsed:.1f} ms, select the X and Y quantities")
+
+        if color_column not in joined_df.columns:
+            color_column = None
+        scatter_fig = correlation_plot_scatter(joined_df, x_column, y_column, color_column)
+        pearson = joined_df[x_column].corr(joined_df[y_column])
+
+        return (compact_figure(scatter_fig), compact_figure(matrix_fig), match_text,
+                f"{len(joined_df)} positions joined in {1000 * elapsed:.1f} ms, r = {pearson:.3f}")
@@ -0,0 +1,48 @@
+from ..functions.functions_derived import *
+
+
+"""Callbacks of the derived maps, shared by the tabs of the measurement techniques"""
+
+
+def register_derived_callbacks(app, prefix, conditions):
+    """
+    Register the callbacks of the derived map controls of a tab, see widgets_shared.make_heatmap_derived_controls
+
+    Parameters:
+        app (dash.Dash): application
+        prefix (str): prefix of the component ids of the tab, e.g. 'edx'
+        conditions (function): conditions of the tab callbacks, see check_conditions
+    """
+
+    # Datasets of the same technique that the selected dataset can be compared with
+    @app.callback(
+        [Output(f"{prefix}_heatmap_reference", "options"),
+         Output(f"{prefix}_heatmap_reference", "value")],
+        Input(f"{prefix}_select_dataset", "options"),
+        Input(f"{prefix}_select_dataset", "value"),
+    )
+    def update_reference_list(dataset_list, selected_dataset):
+        if not dataset_list:
+            return [], None
+        return [dataset for dataset in dataset_list if dataset != selected_dataset], None
+
+
+    # Export the derived map next to the HDF5 file
+    @app.callback(
+        Output(f"{prefix}_text_box", "children", allow_duplicate=True),
+        Input(f"{prefix}_heatmap_export_derived", "n_clicks"),
+        State(f"{prefix}_select_dataset", "value"),
+        State(f"{prefix}_heatmap_reference", "value"),
+        State(f"{prefix}_heatmap_operation", "value"),
+        State("hdf5_path_store", "data"),
+        background=True,
+        running=[(Output(f"{prefix}_heatmap_export_derived", "disabled"), True, False)],
+        prevent_initial_call=True,
+    )
+    @check_conditions(conditions, hdf5_path_index=4)
+    @scheduled("batch")
+    def export_derived_map(n_clicks, selected_dataset, reference_dataset, operation, hdf5_path):
+        if reference_dataset is None:
+            return "Select a dataset to compare with before exporting"
+        output_path = derived_export(hdf5_path, selected_dataset, reference_dataset, operation)
+        return f"Derived map exported to {output_path.name}"
@@ -1,21 +1,20 @@
 from ..functions.functions_edx import *
+from ..functions.functions_derived import *
+from ..functions.functions_outliers import *
+from ..functions.functions_mask import *
+from ..functions.functions_heatmap import *
+from ..callbacks.callbacks_derived import register_derived_callbacks
+from ..callbacks.callbacks_outliers import register_outlier_callbacks
 
 def callbacks_edx(app):
 
-    # Callback to update position based on heatmap click
-    @app.callback(Output('edx_position_store', 'data'),
-                  Input('edx_heatmap', 'clickData'),
-                  prevent_initial_call=True
-                  )
-    def edx_update_position(heatmap_click):
-        if heatmap_click is None:
-            return None
-        target_x = heatmap_click['points'][0]['x']
-        target_y = heatmap_click['points'][0]['y']
-
-        position = (target_x, target_y)
-
-        return position
+    # Callback to update position based on heatmap click, handled in the browser (assets/clientside.js)
+    app.clientside_callback(
+        ClientsideFunction(namespace="heatmap", function_name="update_position"),
+        Output("edx_position_store", "data"),
+        Input("edx_heatmap", "clickData"),
+        prevent_initial_call=True,
+    )
 
 
     # Callback to find all relevant datasets in HDF5 file
@@ -26,7 +25,7 @@ def callbacks_edx(app):
     )
     @check_conditions(edx_conditions, hdf5_path_index=0)
     def edx_scan_hdf5_for_datasets(hdf5_path):
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             dataset_list = get_hdf5_datasets(hdf5_file, dataset_type='edx')
 
         return dataset_list, dataset_list[0]
@@ -44,7 +43,7 @@ def callbacks_edx(app):
         if selected_dataset is None:
             raise PreventUpdate
 
-        with h5py.File(hdf5_path, 'r') as hdf5_file:
+        with open_hdf5(hdf5_path, 'r') as hdf5_file:
             edx_group = hdf5_file[selected_dataset]
             if check_group_for_results(edx_group):
                 return 'Found results for all points'
@@ -67,6 +66,17 @@ def callbacks_edx(app):
     #     return edx_element_list, edx_element_list[0]
     
 
+    # Colour range edits only restyle the displayed heatmap, in the browser (assets/clientside.js)
+    app.clientside_callback(
+        ClientsideFunction(namespace="heatmap", function_name="update_color_range"),
+        Output("edx_heatmap", "figure", allow_duplicate=True),
+        Input("edx_heatmap_min", "value"),
+        Input("edx_heatmap_max", "value"),
+        State("edx_heatmap_precision", "value"),
+        State("edx_heatmap", "figure"),
+        prevent_initial_call=True,
+    )
+
     # Callback for heatmap selection
     @app.callback(
         [
@@ -76,20 +86,31 @@ def callbacks_edx(app):
             Output("edx_heatmap_select", "options"),
         ],
         Input("edx_heatmap_select", "value"),
-        Input("edx_heatmap_min", "value"),
-        Input("edx_heatmap_max", "value"),
+        State("edx_heatmap_min", "value"),
+        State("edx_heatmap_max", "value"),
         Input("edx_heatmap_precision", "value"),
         Input("edx_heatmap_edit", "value"),
         Input('hdf5_path_store', 'data'),
         Input("edx_select_dataset", "value"),
+        Input("edx_heatmap_interpolation", "value"),
+        Input("edx_heatmap_resolution", "value"),
+        Input("edx_heatmap_map_options", "value"),
+        Input("edx_heatmap_reference", "value"),
+        Input("edx_heatmap_operation", "value"),
+        Input("edx_outlier_store", "data"),
         prevent_initial_call=True,
     )
     @check_conditions(edx_conditions, hdf5_path_index=5)
-    def edx_update_heatmap(heatmap_select, z_min, z_max, precision, edit_toggle, hdf5_path, selected_dataset):
-        with h5py.File(hdf5_path, 'r') as hdf5_file:
+    @scheduled("interactive")
+    def edx_update_heatmap(heatmap_select, z_min, z_max, precision, edit_toggle, hdf5_path, selected_dataset,
+                           interpolation, resolution, map_options, reference_dataset, operation,
+                           outlier_store):
+        with open_hdf5(hdf5_path, 'r') as hdf5_file:
             edx_group = hdf5_file[selected_dataset]
 
-            if ctx.triggered_id in ["edx_heatmap_select", "edx_heatmap_edit", "edx_heatmap_precision"]:
+            if ctx.triggered_id in ["edx_heatmap_select", "edx_heatmap_edit", "edx_heatmap_precision",
+                                   "edx_heatmap_interpolation", "edx_heatmap_resolution", "edx_heatmap_map_options",
+                                   "edx_heatmap_reference", "edx_heatmap_operation"]:
                 z_min = None
                 z_max = None
 
@@ -98,6 +119,10 @@ def callbacks_edx(app):
                 masking = False
 
             edx_df = edx_make_results_dataframe_from_hdf5(edx_group)
+            if reference_dataset is not None:
+                edx_df = get_derived_dataframe_from_hdf5(edx_group, reference_dataset, operation)
+            # Mask layers hold the edits not written yet, derived maps combine the ignored tags of both datasets
+            mask_layers = get_mask_layers(edx_group) if masking and reference_dataset is None else None
 
             if heatmap_select is not None and selected_dataset is not None:
                 plot_title = f"EDX composition map <br>{selected_dataset}"
@@ -105,11 +130,15 @@ def callbacks_edx(app):
             else:
                 plot_title = ""
                 colorbar_title = ""
+            colorbar_title = derived_colorbar_title(colorbar_title, reference_dataset, operation)
 
 
             fig = make_heatmap_from_dataframe(edx_df, values=heatmap_select, z_min=z_min, z_max=z_max,
                                               plot_title=plot_title, colorbar_title=colorbar_title,
-                                              precision=precision, masking=masking)
+                                              precision=precision, masking=masking, interpolation=interpolation,
+                                              resolution=resolution or HEATMAP_RESOLUTION, map_options=map_options,
+                                              mask_layers=mask_layers, hdf5_group=edx_group)
+            fig = outliers_add_to_heatmap(fig, outlier_store, selected_dataset)
 
 
             z_min = np.round(fig.data[0].zmin, precision)
@@ -119,7 +148,15 @@ def callbacks_edx(app):
             if "default" in options:
                 options.remove("default")
 
-            return fig, z_min, z_max, options
+            return compact_figure(fig), z_min, z_max, options
+
+
+    # Reference dataset selection and export of the derived maps
+    register_derived_callbacks(app, "edx", edx_conditions)
+
+
+    # Outlier detection and review of the candidates
+    register_outlier_callbacks(app, "edx", edx_conditions)
 
 
     # EDX plot
@@ -130,6 +167,7 @@ def callbacks_edx(app):
         State("hdf5_path_store", "data"),
     )
     @check_conditions(edx_conditions, hdf5_path_index=2)
+    @scheduled("interactive")
     def edx_update_plot(selected_dataset, position, hdf5_path):
         if position is None:
             raise PreventUpdate
@@ -137,13 +175,18 @@ def callbacks_edx(app):
         target_x = position[0]
         target_y = position[1]
 
-        with h5py.File(hdf5_path, 'r') as hdf5_file:
+        with open_hdf5(hdf5_path, 'r') as hdf5_file:
             edx_group = hdf5_file[selected_dataset]
+            if ctx.triggered_id == "edx_position_store":
+                record_prefetch_access(edx_get_measurement_from_hdf5, edx_group, target_x, target_y)
             measurement_df = edx_get_measurement_from_hdf5(edx_group, target_x, target_y)
 
+        if ctx.triggered_id == "edx_position_store":
+            prefetch_neighbours(edx_get_measurement_from_hdf5, hdf5_path, selected_dataset, target_x, target_y)
+
         fig = edx_plot_measurement_from_dataframe(measurement_df)
 
-        return fig
+        return compact_figure(fig)
     
     
     
@@ -164,12 +207,7 @@ def callbacks_edx(app):
         target_x = heatmap_click['points'][0]['x']
         target_y = heatmap_click['points'][0]['y']
 
-        with h5py.File(hdf5_path, 'a') as hdf5_file:
-            edx_group = hdf5_file[selected_dataset]
-            position_group = get_target_position_group(edx_group, target_x, target_y)
-            if not position_group.attrs["ignored"]:
-                position_group.attrs["ignored"] = True
-                return f"{target_x}, {target_y} ignore set to True"
-            else:
-                position_group.attrs["ignored"] = False
-                return f"{target_x}, {target_y} ignore set to False"
+        point_layers, nb_pending = toggle_mask_point(hdf5_path, selected_dataset, target_x, target_y)
+        if point_layers is None:
+            raise PreventUpdate
+        return format_mask_point(target_x, target_y, point_layers, nb_pending)
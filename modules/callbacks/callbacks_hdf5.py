@@ -2,10 +2,9 @@ from dash import Input, Output, State, ctx, html, dcc
 from dash.exceptions import PreventUpdate
 import zipfile
 
-from ..functions.functions_edx import edx_make_results_dataframe_from_hdf5
-from ..functions.functions_profil import profil_make_results_dataframe_from_hdf5
+from ..functions.functions_export import export_hdf5_results, export_folder_results
 from ..functions.functions_shared import *
-from ..functions.functions_xrd import xrd_make_results_dataframe_from_hdf5
+from ..functions.functions_mask import flush_mask_edits, MASK_FLUSH_DELAY
 from ..hdf5_compilers.hdf5compile_base import *
 from ..hdf5_compilers.hdf5compile_edx import *
 from ..hdf5_compilers.hdf5compile_esrf import write_esrf_to_hdf5, write_xrd_results_to_hdf5
@@ -99,12 +98,21 @@ def callbacks_hdf5(app):
         State('hdf5_measurement_type', 'value'),
         State('hdf5_path_store', 'data'),
         State("hdf5_dataset_name", "value"),
+        background=True,
+        progress=Output('hdf5_text_box', 'children'),
+        running=[
+            (Output('hdf5_add_button', 'disabled'), True, False),
+            (Output('hdf5_cancel_button', 'style'), {'display': 'inline-block'}, {'display': 'none'}),
+        ],
+        cancel=[Input('hdf5_cancel_button', 'n_clicks')],
         prevent_initial_call=True
     )
-
-    def add_measurement_to_file(n_clicks, uploaded_folder_path, measurement_type, hdf5_path, dataset_name):
+    @scheduled("batch")
+    def add_measurement_to_file(set_progress, n_clicks, uploaded_folder_path, measurement_type, hdf5_path,
+                                dataset_name):
         if n_clicks > 0:
             print(uploaded_folder_path)
+            set_progress(f'Adding {measurement_type} measurement to {hdf5_path}...')
             if measurement_type == 'EDX':
                 write_edx_to_hdf5(hdf5_path, uploaded_folder_path, dataset_name=dataset_name)
                 return f'Added {measurement_type} measurement to {hdf5_path} as {dataset_name}.'
@@ -127,6 +135,15 @@ def callbacks_hdf5(app):
             return f'Failed to add measurement to {hdf5_path}.'
 
 
+    # Each session uploads to its own folder so that concurrent uploads (possibly on other workers) do not collide
+    @app.callback(
+        Output('hdf5_upload', 'upload_id'),
+        Input('hdf5_upload_folder_root', 'data'),
+    )
+    def set_session_upload_id(upload_folder_root):
+        return uuid.uuid4().hex
+
+
     @app.callback(
         [Output('hdf5_upload_folder_path', 'data'),
          Output('hdf5_measurement_type', 'value'),
@@ -179,7 +196,7 @@ def callbacks_hdf5(app):
         ]
 
         if measurement_type == "XRD results":
-            with h5py.File(hdf5_path, "r") as hdf5_file:
+            with open_hdf5(hdf5_path, "r") as hdf5_file:
                 datasets = get_hdf5_datasets(hdf5_file, "xrd")
             if not datasets:
                 return new_children, "No ESRF or XRD datasets found in HDF5 file"
@@ -200,37 +217,70 @@ def callbacks_hdf5(app):
         Output("hdf5_text_box", "children", allow_duplicate=True),
         Input("hdf5_export", "n_clicks"),
         State("hdf5_path_store", "data"),
+        State("hdf5_export_format", "value"),
+        background=True,
+        progress=Output("hdf5_text_box", "children"),
+        running=[
+            (Output("hdf5_export", "disabled"), True, False),
+            (Output("hdf5_export_folder", "disabled"), True, False),
+            (Output("hdf5_cancel_button", "style"), {"display": "inline-block"}, {"display": "none"}),
+        ],
+        cancel=[Input("hdf5_cancel_button", "n_clicks")],
         prevent_initial_call=True
     )
-    def export_hdf5_results_to_csv(n_clicks, hdf5_path):
+    @scheduled("batch")
+    def export_hdf5_results_to_file(set_progress, n_clicks, hdf5_path, file_format):
         if n_clicks > 0:
-            hdf5_path = Path(hdf5_path)
-            general_df = None
-            with h5py.File(hdf5_path, "r") as hdf5_file:
-                for dataset_name, dataset_group in hdf5_file.items():
-                    if dataset_name == "sample":
-                        continue
-                    else:
-                        if dataset_group.attrs["HT_type"] == "edx":
-                            df = edx_make_results_dataframe_from_hdf5(dataset_group)
-                        if dataset_group.attrs["HT_type"] == "moke":
-                            df = moke_make_results_dataframe_from_hdf5(dataset_group)
-                        if dataset_group.attrs["HT_type"] in ["esrf","xrd"]:
-                            df = xrd_make_results_dataframe_from_hdf5(dataset_group)
-                        if dataset_group.attrs["HT_type"] == "profil":
-                            df = profil_make_results_dataframe_from_hdf5(dataset_group)
+            output_path, skipped_list = export_hdf5_results(hdf5_path, file_format, progress_callback=set_progress)
+            message = f"Successfully exported HDF5 to {output_path}"
+            if skipped_list:
+                message += f", datasets without results skipped: {skipped_list}"
+            return message
+
 
-                    df = df.drop('ignored', axis=1, errors='ignore')
-                    df = df.set_index(["x_pos (mm)", "y_pos (mm)"])
-                    df = df.add_suffix(f"[{dataset_name}]")
-                    if general_df is None:
-                        general_df = df
-                    else:
-                        general_df = general_df.join(df, how='outer')
+    # Rewrite the HDF5 file to give back the space of deleted results and evicted fit results sets
+    @app.callback(
+        Output("hdf5_text_box", "children", allow_duplicate=True),
+        Input("hdf5_repack", "n_clicks"),
+        State("hdf5_path_store", "data"),
+        background=True,
+        running=[(Output("hdf5_repack", "disabled"), True, False)],
+        prevent_initial_call=True
+    )
+    @scheduled("batch")
+    def repack_hdf5_file(n_clicks, hdf5_path):
+        if n_clicks > 0:
+            if hdf5_path is None:
+                raise PreventUpdate
+            # Buffered mask edits are written first, they would be written to the replaced file otherwise
+            flush_mask_edits(hdf5_path)
+            size_before, size_after = repack_hdf5(hdf5_path)
+            return f"Compacted {Path(hdf5_path).name}: {size_before / 2**20:.1f} MB -> {size_after / 2**20:.1f} MB"
 
-            general_df.to_csv(hdf5_path.with_suffix(".csv"), index=True)
 
-            return f"Successfully exported HDF5 to {hdf5_path.with_suffix(".csv")}"
+    # Export every HDF5 file of the data folder, one file per sample in data_folder/export
+    @app.callback(
+        Output("hdf5_text_box", "children", allow_duplicate=True),
+        Input("hdf5_export_folder", "n_clicks"),
+        State("data_path_store", "data"),
+        State("hdf5_export_format", "value"),
+        background=True,
+        progress=Output("hdf5_text_box", "children"),
+        running=[
+            (Output("hdf5_export", "disabled"), True, False),
+            (Output("hdf5_export_folder", "disabled"), True, False),
+            (Output("hdf5_cancel_button", "style"), {"display": "inline-block"}, {"display": "none"}),
+        ],
+        cancel=[Input("hdf5_cancel_button", "n_clicks")],
+        prevent_initial_call=True
+    )
+    @scheduled("batch")
+    def export_folder_results_to_files(set_progress, n_clicks, data_path, file_format):
+        if n_clicks > 0:
+            if data_path is None:
+                return "Select a data folder in the browser tab to export"
+            output_list = export_folder_results(data_path, file_format, progress_callback=set_progress)
+            return f"Successfully exported {len(output_list)} HDF5 files to {Path(data_path) / 'export'}"
 
 
 
@@ -244,7 +294,7 @@ def callbacks_hdf5(app):
         if n_clicks > 0:
             hdf5_path = Path(hdf5_path)
             checklist = []
-            with h5py.File(hdf5_path, "a") as hdf5_file:
+            with open_hdf5(hdf5_path, "a") as hdf5_file:
                 for dataset_name, dataset_group in hdf5_file.items():
                     if dataset_name == "sample":
                         continue
@@ -269,3 +319,21 @@ def callbacks_hdf5(app):
 
 
 
+
+
+
+    # Queue depth and wait times of the scheduler lanes (functions_shared.scheduled) and neighbour prefetch statistics
+    @app.callback(
+        Output("hdf5_scheduler_status", "children"),
+        Input("hdf5_scheduler_interval", "n_intervals"),
+    )
+    def update_scheduler_status(n_intervals):
+        return [format_scheduler_stats(get_scheduler_stats()), html.Br(), format_prefetch_stats(get_prefetch_stats())]
+
+
+    # Write the mask edits buffered for longer than MASK_FLUSH_DELAY (functions_mask.toggle_mask_point)
+    @app.callback(
+        Input("mask_flush_interval", "n_intervals"),
+    )
+    def flush_pending_mask_edits(n_intervals):
+        flush_mask_edits(max_age=MASK_FLUSH_DELAY)
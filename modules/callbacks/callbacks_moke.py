@@ -1,23 +1,22 @@
 from ..hdf5_compilers.hdf5compile_moke import *
+from ..functions.functions_derived import *
+from ..functions.functions_outliers import *
+from ..functions.functions_mask import *
+from ..functions.functions_heatmap import *
+from ..callbacks.callbacks_derived import register_derived_callbacks
+from ..callbacks.callbacks_outliers import register_outlier_callbacks
 
 '''Callbacks for MOKE tab'''
 
 def callbacks_moke(app, children_moke):
 
-    # Callback to update moke plot based on heatmap click position
-    @app.callback(Output('moke_position_store', 'data'),
-                  Input('moke_heatmap', 'clickData'),
-                  prevent_initial_call=True
-                  )
-    def update_position(heatmap_click):
-        if heatmap_click is None:
-            return None
-        target_x = heatmap_click['points'][0]['x']
-        target_y = heatmap_click['points'][0]['y']
-
-        position = (target_x, target_y)
-
-        return position
+    # Callback to update moke plot based on heatmap click position, handled in the browser (assets/clientside.js)
+    app.clientside_callback(
+        ClientsideFunction(namespace="heatmap", function_name="update_position"),
+        Output("moke_position_store", "data"),
+        Input("moke_heatmap", "clickData"),
+        prevent_initial_call=True,
+    )
 
 
     @app.callback(
@@ -27,12 +26,23 @@ def callbacks_moke(app, children_moke):
     )
     @check_conditions(moke_conditions, hdf5_path_index=0)
     def moke_scan_hdf5_for_datasets(hdf5_path):
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             dataset_list = get_hdf5_datasets(hdf5_file, dataset_type='moke')
 
         return dataset_list, dataset_list[0]
 
 
+    # Colour range edits only restyle the displayed heatmap, in the browser (assets/clientside.js)
+    app.clientside_callback(
+        ClientsideFunction(namespace="heatmap", function_name="update_color_range"),
+        Output("moke_heatmap", "figure", allow_duplicate=True),
+        Input("moke_heatmap_min", "value"),
+        Input("moke_heatmap_max", "value"),
+        State("moke_heatmap_precision", "value"),
+        State("moke_heatmap", "figure"),
+        prevent_initial_call=True,
+    )
+
     # Callback for heatmap selection
     @app.callback(
         [
@@ -42,20 +52,31 @@ def callbacks_moke(app, children_moke):
             Output("moke_heatmap_select", "options"),
         ],
         Input("moke_heatmap_select", "value"),
-        Input("moke_heatmap_min", "value"),
-        Input("moke_heatmap_max", "value"),
+        State("moke_heatmap_min", "value"),
+        State("moke_heatmap_max", "value"),
         Input("moke_heatmap_precision", "value"),
         Input("moke_heatmap_edit", "value"),
         Input('hdf5_path_store', 'data'),
         Input("moke_select_dataset", "value"),
+        Input("moke_heatmap_interpolation", "value"),
+        Input("moke_heatmap_resolution", "value"),
+        Input("moke_heatmap_map_options", "value"),
+        Input("moke_heatmap_reference", "value"),
+        Input("moke_heatmap_operation", "value"),
+        Input("moke_outlier_store", "data"),
         prevent_initial_call=True,
     )
     @check_conditions(moke_conditions, hdf5_path_index=5)
-    def moke_update_heatmap(heatmap_select, z_min, z_max, precision, edit_toggle, hdf5_path, selected_dataset):
-        with h5py.File(hdf5_path, 'r') as hdf5_file:
+    @scheduled("interactive")
+    def moke_update_heatmap(heatmap_select, z_min, z_max, precision, edit_toggle, hdf5_path, selected_dataset,
+                            interpolation, resolution, map_options, reference_dataset, operation,
+                            outlier_store):
+        with open_hdf5(hdf5_path, 'r') as hdf5_file:
             moke_group = hdf5_file[selected_dataset]
 
-            if ctx.triggered_id in ["moke_heatmap_select", "moke_heatmap_edit", "moke_heatmap_precision"]:
+            if ctx.triggered_id in ["moke_heatmap_select", "moke_heatmap_edit", "moke_heatmap_precision",
+                                   "moke_heatmap_interpolation", "moke_heatmap_resolution", "moke_heatmap_map_options",
+                                   "moke_heatmap_reference", "moke_heatmap_operation"]:
                 z_min = None
                 z_max = None
 
@@ -64,6 +85,10 @@ def callbacks_moke(app, children_moke):
                 masking = False
 
             moke_df = moke_make_results_dataframe_from_hdf5(moke_group)
+            if reference_dataset is not None:
+                moke_df = get_derived_dataframe_from_hdf5(moke_group, reference_dataset, operation)
+            # Mask layers hold the edits not written yet, derived maps combine the ignored tags of both datasets
+            mask_layers = get_mask_layers(moke_group) if masking and reference_dataset is None else None
 
             if heatmap_select is not None and selected_dataset is not None:
                 plot_title = f"{heatmap_select} MOKE map <br>{selected_dataset}"
@@ -71,10 +96,14 @@ def callbacks_moke(app, children_moke):
             else:
                 plot_title = ""
                 colorbar_title = ""
+            colorbar_title = derived_colorbar_title(colorbar_title, reference_dataset, operation)
 
             fig = make_heatmap_from_dataframe(moke_df, values=heatmap_select, z_min=z_min, z_max=z_max,
                                               plot_title=plot_title, colorbar_title=colorbar_title,
-                                              precision=precision, masking=masking)
+                                              precision=precision, masking=masking, interpolation=interpolation,
+                                              resolution=resolution or HEATMAP_RESOLUTION, map_options=map_options,
+                                              mask_layers=mask_layers, hdf5_group=moke_group)
+            fig = outliers_add_to_heatmap(fig, outlier_store, selected_dataset)
 
             z_min = np.round(fig.data[0].zmin, precision)
             z_max = np.round(fig.data[0].zmax, precision)
@@ -83,7 +112,15 @@ def callbacks_moke(app, children_moke):
             if "default" in options:
                 options.remove("default")
 
-            return fig, z_min, z_max, options
+            return compact_figure(fig), z_min, z_max, options
+
+
+    # Reference dataset selection and export of the derived maps
+    register_derived_callbacks(app, "moke", moke_conditions)
+
+
+    # Outlier detection and review of the candidates
+    register_outlier_callbacks(app, "moke", moke_conditions)
 
 
     # Profile plot
@@ -95,43 +132,68 @@ def callbacks_moke(app, children_moke):
         Input("moke_heatmap_select", "value"),
         Input("moke_select_dataset", "value"),
         State("hdf5_path_store", "data"),
+        Input("moke_plot", "relayoutData"),
     )
     @check_conditions(moke_conditions, hdf5_path_index=5)
-    def moke_update_plot(position, plot_options, treatment_dict, heatmap_select, selected_dataset, hdf5_path):
+    @scheduled("interactive")
+    def moke_update_plot(position, plot_options, treatment_dict, heatmap_select, selected_dataset, hdf5_path,
+                         relayout_data):
         if position is None:
             raise PreventUpdate
 
+        # Zooming re-fetches the full resolution oscilloscope traces within the new x range
+        x_range = None
+        if ctx.triggered_id == "moke_plot":
+            plot_ranges = get_ranges_from_relayout(relayout_data)
+            if plot_options != "oscilloscope" or plot_ranges is None:
+                raise PreventUpdate
+            x_range = plot_ranges[0]
+
         target_x = position[0]
         target_y = position[1]
 
+        # Changing the heatmap selection only changes the vlines, they are patched on the displayed loop
+        if ctx.triggered_id == "moke_heatmap_select":
+            if plot_options != "stored_result":
+                raise PreventUpdate
+
+            with open_hdf5(hdf5_path, 'r') as hdf5_file:
+                results_dict = moke_get_results_from_hdf5(hdf5_file[selected_dataset], target_x, target_y)
+
+            vlines_fig = moke_plot_vlines(go.Figure(), moke_get_vlines_values(results_dict, heatmap_select))
+
+            patched_fig = Patch()
+            patched_fig["layout"]["shapes"] = [shape.to_plotly_json() for shape in vlines_fig.layout.shapes]
+            patched_fig["layout"]["annotations"] = [
+                annotation.to_plotly_json() for annotation in vlines_fig.layout.annotations
+            ]
+            return patched_fig
+
         fig = go.Figure()
 
-        with h5py.File(hdf5_path, 'r') as hdf5_file:
+        with open_hdf5(hdf5_path, 'r') as hdf5_file:
             moke_group = hdf5_file[selected_dataset]
-            measurement_df = moke_get_measurement_from_hdf5(moke_group, target_x, target_y)
+            if ctx.triggered_id == "moke_position_store":
+                record_prefetch_access(moke_get_treated_measurement_from_hdf5, moke_group, target_x, target_y,
+                                       treatment_dict)
+            measurement_df = moke_get_treated_measurement_from_hdf5(moke_group, target_x, target_y, treatment_dict)
             results_dict = moke_get_results_from_hdf5(moke_group, target_x, target_y)
 
-        measurement_df = moke_treat_measurement_dataframe(measurement_df, treatment_dict)
+        if ctx.triggered_id == "moke_position_store":
+            prefetch_neighbours(moke_get_treated_measurement_from_hdf5, hdf5_path, selected_dataset, target_x,
+                                target_y, treatment_dict)
 
         if plot_options == "oscilloscope":
-            fig = moke_plot_oscilloscope_from_dataframe(fig, measurement_df)
+            fig = moke_plot_oscilloscope_from_dataframe(fig, measurement_df, x_range=x_range)
         elif plot_options == "loop":
             fig = moke_plot_loop_from_dataframe(fig, measurement_df)
         elif plot_options == "stored_result":
             fig = moke_plot_loop_from_dataframe(fig, measurement_df)
-            if heatmap_select == "coercivity_m0":
-                fig = moke_plot_vlines(fig, values=[results_dict["coercivity_m0"]["negative"],
-                                              results_dict["coercivity_m0"]["positive"]])
-            if heatmap_select == "coercivity_dmdh":
-                fig = moke_plot_vlines(fig, values=[results_dict["coercivity_dmdh"]["negative"],
-                                              results_dict["coercivity_dmdh"]["positive"]])
-            if heatmap_select == "intercept_field":
-                fig = moke_plot_vlines(fig, values=[results_dict["coercivity_dmdh"]["negative"],
-                                              results_dict["coercivity_dmdh"]["positive"]])
+            fig = moke_plot_vlines(fig, values=moke_get_vlines_values(results_dict, heatmap_select))
 
         fig.update_layout(plot_layout(title=''))
 
-        return fig
+        return compact_figure(fig)
 
 
     @app.callback(
@@ -140,16 +202,32 @@ def callbacks_moke(app, children_moke):
         State("hdf5_path_store", "data"),
         State("moke_data_treatment_store", "data"),
         State("moke_select_dataset", "value"),
+        background=True,
+        progress=Output("moke_text_box", "children"),
+        running=[
+            (Output("moke_make_database_button", "disabled"), True, False),
+            (Output("moke_cancel_button", "style"), {"display": "inline-block"}, {"display": "none"}),
+        ],
+        cancel=[Input("moke_cancel_button", "n_clicks")],
         prevent_initial_call=True,
     )
-    @check_conditions(moke_conditions, hdf5_path_index=1)
-    def moke_make_database(n_clicks, hdf5_path, treatment_dict, selected_dataset):
+    @check_conditions(moke_conditions, hdf5_path_index=2)
+    @scheduled("batch")
+    def moke_make_database(set_progress, n_clicks, hdf5_path, treatment_dict, selected_dataset):
         if n_clicks > 0:
-            with h5py.File(hdf5_path, 'a') as hdf5_file:
+            # The fits only read the file, the write lock is taken for the write-back
+            with open_hdf5(hdf5_path, 'r') as hdf5_file:
                 moke_group = hdf5_file[selected_dataset]
-                results_dict = moke_batch_fit(moke_group, treatment_dict)
-                moke_results_dict_to_hdf5(moke_group, results_dict, treatment_dict)
-                return "Great Success!"
+                fit_keys = moke_make_fit_keys(moke_group, treatment_dict)
+                results_dict = moke_batch_fit(
+                    moke_group, treatment_dict,
+                    progress_callback=lambda done, total: set_progress(f"Fitting position {done + 1}/{total}"),
+                    fit_keys=fit_keys,
+                )
+            with open_hdf5(hdf5_path, 'a') as hdf5_file:
+                moke_results_dict_to_hdf5(hdf5_file[selected_dataset], results_dict, treatment_dict, fit_keys)
+            return (f"Great Success! {len(results_dict)} positions fitted, "
+                    f"{len(fit_keys) - len(results_dict)} reused from previous fits")
 
 
     @app.callback([Output('moke_data_treatment_store', 'data'),
@@ -226,19 +304,31 @@ def callbacks_moke(app, children_moke):
         State('moke_data_treatment_store', 'data'),
         State('moke_loop_map_checklist', 'value'),
         State("moke_select_dataset", "value"),
+        background=True,
+        progress=Output("moke_text_box", "children"),
+        running=[
+            (Output("moke_loop_map_button", "disabled"), True, False),
+            (Output("moke_loop_map_cancel_button", "style"), {"display": "inline-block"}, {"display": "none"}),
+        ],
+        cancel=[Input("moke_loop_map_cancel_button", "n_clicks")],
         prevent_initial_call=True
     )
-    @check_conditions(moke_conditions, hdf5_path_index=1)
-    def make_loop_map(n_clicks, hdf5_path, options_dict, checklist, dataset_select):
+    @check_conditions(moke_conditions, hdf5_path_index=2)
+    @scheduled("batch")
+    def make_loop_map(set_progress, n_clicks, hdf5_path, options_dict, checklist, dataset_select):
         normalize = False
         if "normalize" in checklist:
             normalize = True
 
         if n_clicks>0:
-            with h5py.File(hdf5_path, 'a') as hdf5_file:
+            with open_hdf5(hdf5_path, 'r') as hdf5_file:
                 moke_group = hdf5_file[dataset_select]
-                fig = moke_plot_loop_map(moke_group, options_dict, normalize)
-                return fig
+                fig = moke_plot_loop_map(
+                    moke_group, options_dict, normalize,
+                    progress_callback=lambda done, total: set_progress(f"Treating loop {done + 1}/{total}")
+                )
+                set_progress(f"Loop map done, {len(fig.data[0].x)} points")
+                return compact_figure(fig)
 
 
 
@@ -260,15 +350,10 @@ def callbacks_moke(app, children_moke):
         target_x = heatmap_click['points'][0]['x']
         target_y = heatmap_click['points'][0]['y']
 
-        with h5py.File(hdf5_path, 'a') as hdf5_file:
-            moke_group = hdf5_file[selected_dataset]
-            position_group = get_target_position_group(moke_group, target_x, target_y)
-            if not position_group.attrs["ignored"]:
-                position_group.attrs["ignored"] = True
-                return f"{target_x}, {target_y} ignore set to True"
-            else:
-                position_group.attrs["ignored"] = False
-                return f"{target_x}, {target_y} ignore set to False"
+        point_layers, nb_pending = toggle_mask_point(hdf5_path, selected_dataset, target_x, target_y)
+        if point_layers is None:
+            raise PreventUpdate
+        return format_mask_point(target_x, target_y, point_layers, nb_pending)
 
 
 
@@ -0,0 +1,60 @@
+from ..functions.functions_outliers import *
+
+
+"""Callbacks of the outlier detection, shared by the tabs of the measurement techniques"""
+
+
+def register_outlier_callbacks(app, prefix, conditions):
+    """
+    Register the callbacks of the outlier controls of a tab, see widgets_shared.make_heatmap_outlier_controls
+
+    Parameters:
+        app (dash.Dash): application
+        prefix (str): prefix of the component ids of the tab, e.g. 'edx'
+        conditions (function): conditions of the tab callbacks, see check_conditions
+    """
+
+    # Flag the positions whose results stand out from their neighbours, the candidates are shown on the heatmap
+    @app.callback(
+        Output(f"{prefix}_outlier_store", "data"),
+        Output(f"{prefix}_outlier_select", "options"),
+        Output(f"{prefix}_outlier_select", "value"),
+        Output(f"{prefix}_text_box", "children", allow_duplicate=True),
+        Input(f"{prefix}_outlier_detect", "n_clicks"),
+        State(f"{prefix}_outlier_threshold", "value"),
+        State("hdf5_path_store", "data"),
+        State(f"{prefix}_select_dataset", "value"),
+        prevent_initial_call=True,
+    )
+    @check_conditions(conditions, hdf5_path_index=2)
+    @scheduled("interactive")
+    def detect_outlier_candidates(n_clicks, threshold, hdf5_path, selected_dataset):
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
+            outlier_df = get_outliers_from_hdf5(hdf5_file[selected_dataset], threshold or OUTLIER_THRESHOLD)
+        outlier_store = outliers_make_store(selected_dataset, outlier_df)
+        return (outlier_store, *outliers_make_options(outlier_store),
+                f"{len(outlier_df)} outlier candidates found, select the ones to accept")
+
+
+    # Accept adds the selected candidates to the auto_outlier mask layer, reject drops all the candidates
+    @app.callback(
+        Output(f"{prefix}_outlier_store", "data", allow_duplicate=True),
+        Output(f"{prefix}_outlier_select", "options", allow_duplicate=True),
+        Output(f"{prefix}_outlier_select", "value", allow_duplicate=True),
+        Output(f"{prefix}_text_box", "children", allow_duplicate=True),
+        Input(f"{prefix}_outlier_accept", "n_clicks"),
+        Input(f"{prefix}_outlier_reject", "n_clicks"),
+        State(f"{prefix}_outlier_store", "data"),
+        State(f"{prefix}_outlier_select", "value"),
+        State("hdf5_path_store", "data"),
+        prevent_initial_call=True,
+    )
+    @check_conditions(conditions, hdf5_path_index=4)
+    def review_outlier_candidates(accept_clicks, reject_clicks, outlier_store, selected, hdf5_path):
+        if outlier_store is None:
+            raise PreventUpdate
+        if ctx.triggered_id == f"{prefix}_outlier_reject":
+            return None, [], [], "Outlier candidates rejected"
+        nb_accepted, nb_flagged = outliers_accept(hdf5_path, outlier_store, selected or [])
+        return (None, [], [], f"{nb_accepted} positions flagged as outliers in {outlier_store['dataset']}, "
+                              f"{nb_flagged} in total")
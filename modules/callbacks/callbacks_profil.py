@@ -1,28 +1,25 @@
 from ..functions.functions_profil import *
+from ..functions.functions_derived import *
+from ..functions.functions_outliers import *
+from ..functions.functions_mask import *
+from ..functions.functions_heatmap import *
+from ..callbacks.callbacks_derived import register_derived_callbacks
+from ..callbacks.callbacks_outliers import register_outlier_callbacks
 from dash import html, dcc
 
-from ..hdf5_compilers.hdf5compile_base import safe_create_new_subgroup
 
 """Callbacks for profil tab"""
 
 
 def callbacks_profil(app):
 
-    # Callback to update current position based on heatmap click
-    @app.callback(
+    # Callback to update current position based on heatmap click, handled in the browser (assets/clientside.js)
+    app.clientside_callback(
+        ClientsideFunction(namespace="heatmap", function_name="update_position"),
         Output("profil_position_store", "data"),
         Input("profil_heatmap", "clickData"),
         prevent_initial_call=True,
     )
-    def profil_update_position(heatmap_click):
-        if heatmap_click is None:
-            return None
-        target_x = heatmap_click["points"][0]["x"]
-        target_y = heatmap_click["points"][0]["y"]
-
-        position = (target_x, target_y)
-
-        return position
 
     # Callback to find all relevant datasets in HDF5 file
     @app.callback(
@@ -34,7 +31,7 @@ def callbacks_profil(app):
     )
     @check_conditions(profil_conditions, hdf5_path_index=0)
     def profil_scan_hdf5_for_datasets(hdf5_path):
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             dataset_list = get_hdf5_datasets(hdf5_file, dataset_type="profil")
 
         return dataset_list, dataset_list[0]
@@ -51,12 +48,23 @@ def callbacks_profil(app):
         if selected_dataset is None:
             raise PreventUpdate
 
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             profil_group = hdf5_file[selected_dataset]
             if check_group_for_results(profil_group):
                 return "Found results for all points"
             return "No results found"
 
+    # Colour range edits only restyle the displayed heatmap, in the browser (assets/clientside.js)
+    app.clientside_callback(
+        ClientsideFunction(namespace="heatmap", function_name="update_color_range"),
+        Output("profil_heatmap", "figure", allow_duplicate=True),
+        Input("profil_heatmap_min", "value"),
+        Input("profil_heatmap_max", "value"),
+        State("profil_heatmap_precision", "value"),
+        State("profil_heatmap", "figure"),
+        prevent_initial_call=True,
+    )
+
     # Callback for heatmap plot selection
     @app.callback(
         [
@@ -66,15 +74,22 @@ def callbacks_profil(app):
             Output("profil_heatmap_select", "options"),
         ],
         Input("profil_heatmap_select", "value"),
-        Input("profil_heatmap_min", "value"),
-        Input("profil_heatmap_max", "value"),
+        State("profil_heatmap_min", "value"),
+        State("profil_heatmap_max", "value"),
         Input("profil_heatmap_precision", "value"),
         Input("profil_heatmap_edit", "value"),
         Input("hdf5_path_store", "data"),
         Input("profil_select_dataset", "value"),
+        Input("profil_heatmap_interpolation", "value"),
+        Input("profil_heatmap_resolution", "value"),
+        Input("profil_heatmap_map_options", "value"),
+        Input("profil_heatmap_reference", "value"),
+        Input("profil_heatmap_operation", "value"),
+        Input("profil_outlier_store", "data"),
         prevent_initial_call=True,
     )
     @check_conditions(profil_conditions, hdf5_path_index=5)
+    @scheduled("interactive")
     def profil_update_heatmap(
         heatmap_select,
         z_min,
@@ -83,50 +98,100 @@ def callbacks_profil(app):
         edit_toggle,
         hdf5_path,
         selected_dataset,
+        interpolation,
+        resolution,
+        map_options,
+        reference_dataset,
+        operation,
+        outlier_store,
     ):
         if ctx.triggered_id in [
             "profil_heatmap_select",
             "profil_heatmap_edit",
             "profil_heatmap_precision",
+            "profil_heatmap_interpolation",
+            "profil_heatmap_resolution",
+            "profil_heatmap_map_options",
+            "profil_heatmap_reference",
+            "profil_heatmap_operation",
         ]:
             z_min = None
             z_max = None
 
-        with h5py.File(hdf5_path, "r") as hdf5_file:
-            profil_group = hdf5_file[selected_dataset]
-            profil_df = profil_make_results_dataframe_from_hdf5(profil_group)
-
         masking = True
         if edit_toggle in ["edit", "unfiltered"]:
             masking = False
 
-        fig = make_heatmap_from_dataframe(
-            profil_df,
-            values=heatmap_select,
-            z_min=z_min,
-            z_max=z_max,
-            precision=precision,
-            masking=masking,
-        )
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
+            profil_group = hdf5_file[selected_dataset]
+            profil_df = profil_make_results_dataframe_from_hdf5(profil_group)
+            if reference_dataset is not None:
+                profil_df = get_derived_dataframe_from_hdf5(profil_group, reference_dataset, operation)
+            # Mask layers hold the edits not written yet, derived maps combine the ignored tags of both datasets
+            mask_layers = get_mask_layers(profil_group) if masking and reference_dataset is None else None
+
+            fig = make_heatmap_from_dataframe(
+                profil_df,
+                values=heatmap_select,
+                z_min=z_min,
+                z_max=z_max,
+                precision=precision,
+                masking=masking,
+                colorbar_title=derived_colorbar_title("", reference_dataset, operation),
+                interpolation=interpolation,
+                resolution=resolution or HEATMAP_RESOLUTION,
+                map_options=map_options,
+                mask_layers=mask_layers,
+                hdf5_group=profil_group,
+            )
+
+        fig = outliers_add_to_heatmap(fig, outlier_store, selected_dataset)
 
         z_min = np.round(fig.data[0].zmin, precision)
         z_max = np.round(fig.data[0].zmax, precision)
 
-        return fig, z_min, z_max, profil_df.columns[7:]
+        return compact_figure(fig), z_min, z_max, profil_df.columns[7:]
+
+
+    # Reference dataset selection and export of the derived maps
+    register_derived_callbacks(app, "profil", profil_conditions)
+
+
+    # Outlier detection and review of the candidates
+    register_outlier_callbacks(app, "profil", profil_conditions)
 
     # Profile plot
     @app.callback(
         Output("profil_plot", "figure"),
+        Output("profil_plot_overlay_store", "data"),
         Input("profil_select_dataset", "value"),
         Input("profil_position_store", "data"),
         Input("profil_plot_select", "value"),
         State("hdf5_path_store", "data"),
+        Input("profil_plot", "relayoutData"),
+        State("profil_plot_overlay_store", "data"),
     )
     @check_conditions(profil_conditions, hdf5_path_index=3)
-    def profil_update_plot(selected_dataset, position, plot_options, hdf5_path):
+    @scheduled("interactive")
+    def profil_update_plot(selected_dataset, position, plot_options, hdf5_path, relayout_data, overlay_dict):
         if position is None:
             raise PreventUpdate
 
+        # Plot options only toggle the visibility of the overlay traces already on the figure
+        if ctx.triggered_id == "profil_plot_select" and overlay_dict:
+            patched_fig = Patch()
+            for overlay, index in overlay_dict.items():
+                patched_fig["data"][index]["visible"] = overlay in plot_options
+            return patched_fig, no_update
+
+        # Zooming re-fetches the full resolution profile within the new x range
+        x_range = None
+        if ctx.triggered_id == "profil_plot":
+            plot_ranges = get_ranges_from_relayout(relayout_data)
+            if plot_ranges is None:
+                raise PreventUpdate
+            x_range = plot_ranges[0]
+
         target_x = position[0]
         target_y = position[1]
 
@@ -140,38 +205,28 @@ def callbacks_profil(app):
             vertical_spacing=0.1,
         )
 
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             profil_group = hdf5_file[selected_dataset]
-            measurement_df = profil_get_measurement_from_hdf5(
-                profil_group, target_x, target_y
-            )
-            results_dict = profil_get_results_from_hdf5(
+            if ctx.triggered_id == "profil_position_store":
+                record_prefetch_access(profil_get_treated_measurement_from_hdf5, profil_group, target_x, target_y)
+            measurement_df, results_dict, adjusting_slope = profil_get_treated_measurement_from_hdf5(
                 profil_group, target_x, target_y
             )
 
-        adjusting_slope = None
+        if ctx.triggered_id == "profil_position_store":
+            prefetch_neighbours(profil_get_treated_measurement_from_hdf5, hdf5_path, selected_dataset, target_x,
+                                target_y)
+
         fit_parameters = None
-        measured_height = None
         if results_dict:
-            adjusting_slope = results_dict["adjusting_slope"]
             fit_parameters = results_dict["fit_parameters"]
-            measured_height = results_dict["measured_height"]
 
-        adjusting_slope, measurement_df = profil_measurement_dataframe_treat(
-            measurement_df, adjusting_slope
-        )
-
-        if "adjusting_slope" not in plot_options:
-            adjusting_slope = None
         fig = profil_plot_total_profile_from_dataframe(
-            fig, measurement_df, adjusting_slope
+            fig, measurement_df, adjusting_slope, x_range=x_range
         )
 
-        if "fit_parameters" not in plot_options:
-            fit_parameters = None
-
         fig = profil_plot_adjusted_profile_from_dataframe(
-            fig, measurement_df, fit_parameters
+            fig, measurement_df, fit_parameters, x_range=x_range
         )
 
         if results_dict:
@@ -179,7 +234,14 @@ def callbacks_profil(app):
 
         fig.update_layout(plot_layout(title=""))
 
-        return fig
+        # Overlays are always plotted and hidden if not selected, their indices are stored for later toggles
+        overlay_dict = {}
+        for index, trace in enumerate(fig.data):
+            if trace.name in ["adjusting_slope", "fit_parameters"]:
+                trace.visible = trace.name in plot_options
+                overlay_dict[trace.name] = index
+
+        return compact_figure(fig), overlay_dict
 
     # Refitting results
     @app.callback(
@@ -191,50 +253,55 @@ def callbacks_profil(app):
         State("hdf5_path_store", "data"),
         State("profil_select_dataset", "value"),
         State("profil_position_store", "data"),
+        background=True,
+        progress=Output("profil_text_box", "children"),
+        running=[
+            (Output("profil_fit_button", "disabled"), True, False),
+            (Output("profil_cancel_button", "style"), {"display": "inline-block"}, {"display": "none"}),
+        ],
+        cancel=[Input("profil_cancel_button", "n_clicks")],
         prevent_initial_call=True,
     )
-    @check_conditions(profil_conditions, hdf5_path_index=4)
+    @check_conditions(profil_conditions, hdf5_path_index=5)
+    @scheduled("batch")
     def profil_refit_data(
-        n_clicks, fit_mode, nb_steps, x0, hdf5_path, selected_dataset, target_position
+        set_progress, n_clicks, fit_mode, nb_steps, x0, hdf5_path, selected_dataset, target_position
     ):
         if n_clicks > 0:
+            # The fits only read the file, the write lock is taken for the write-back
             if fit_mode == "Batch fitting":
-                with h5py.File(hdf5_path, "a") as hdf5_file:
+                fit_dict = {}
+                with open_hdf5(hdf5_path, "r") as hdf5_file:
+                    position_list = list(get_position_groups(hdf5_file[selected_dataset]))
+                    for index, (position, position_group) in enumerate(position_list):
+                        set_progress(f"Fitting position {index + 1}/{len(position_list)}")
+                        fit_dict[position] = profil_fit_position(position_group, nb_steps, x0)
+                with open_hdf5(hdf5_path, "a") as hdf5_file:
                     profil_group = hdf5_file[selected_dataset]
-                    for position, position_group in profil_group.items():
-                        results_dict = profil_spot_fit_steps(
-                            position_group, nb_steps, x0
-                        )
-                        write_dektak_results_to_hdf5(
-                            position_group, results_dict, overwrite=True
-                        )
-                return "Successfully refitted data"
+                    for position, (fit_key, results_dict) in fit_dict.items():
+                        profil_write_fit_results(profil_group[position], fit_key, results_dict)
+                nb_reused = sum(results_dict is None for fit_key, results_dict in fit_dict.values())
+                return f"Successfully refitted data, {nb_reused} positions reused from previous fits"
 
             if fit_mode == "Spot fitting":
-                with h5py.File(hdf5_path, "a") as hdf5_file:
-                    profil_group = hdf5_file[selected_dataset]
+                with open_hdf5(hdf5_path, "r") as hdf5_file:
                     position_group = get_target_position_group(
-                        profil_group, target_position[0], target_position[1]
-                    )
-                    results_dict = profil_spot_fit_steps(position_group, nb_steps, x0)
-                    write_dektak_results_to_hdf5(
-                        position_group, results_dict, overwrite=True
+                        hdf5_file[selected_dataset], target_position[0], target_position[1]
                     )
+                    group_name = position_group.name
+                    fit_key, results_dict = profil_fit_position(position_group, nb_steps, x0)
+                with open_hdf5(hdf5_path, "a") as hdf5_file:
+                    profil_write_fit_results(hdf5_file[group_name], fit_key, results_dict)
                 return f"Successfully refitted position {target_position}"
 
             if fit_mode == "Manual":
-                with h5py.File(hdf5_path, "a") as hdf5_file:
+                with open_hdf5(hdf5_path, "a") as hdf5_file:
                     profil_group = hdf5_file[selected_dataset]
                     position_group = get_target_position_group(
                         profil_group, target_position[0], target_position[1]
                     )
-                    results_group = safe_create_new_subgroup(
-                        position_group, new_subgroup_name="results"
-                    )
-                    results_group["measured_height"] = (
-                        nb_steps  # nb_steps input reused for manual height input
-                    )
-                    results_group["measured_height"].attrs["units"] = "nm"
+                    # nb_steps input reused for manual height input
+                    write_dektak_manual_height_to_hdf5(position_group, nb_steps)
                 return f"Manually assigned height to position {target_position}"
 
     # Callback to deal with heatmap edit mode
@@ -254,15 +321,10 @@ def callbacks_profil(app):
         target_x = heatmap_click["points"][0]["x"]
         target_y = heatmap_click["points"][0]["y"]
 
-        with h5py.File(hdf5_path, "a") as hdf5_file:
-            profil_group = hdf5_file[selected_dataset]
-            position_group = get_target_position_group(profil_group, target_x, target_y)
-            if not position_group.attrs["ignored"]:
-                position_group.attrs["ignored"] = True
-                return f"{target_x}, {target_y} ignore set to True"
-            else:
-                position_group.attrs["ignored"] = False
-                return f"{target_x}, {target_y} ignore set to False"
+        point_layers, nb_pending = toggle_mask_point(hdf5_path, selected_dataset, target_x, target_y)
+        if point_layers is None:
+            raise PreventUpdate
+        return format_mask_point(target_x, target_y, point_layers, nb_pending)
 
     # Callback for fit modes
     @app.callback(
@@ -3,28 +3,28 @@
 """
 from array import array
 
-from dash import Input, Output, callback
+from dash import Input, Output, callback, dcc
 from dash.exceptions import PreventUpdate
 from ..functions.functions_xrd import *
 from ..functions.functions_shared import *
+from ..functions.functions_derived import *
+from ..functions.functions_outliers import *
+from ..functions.functions_mask import *
+from ..functions.functions_heatmap import *
+from ..callbacks.callbacks_derived import register_derived_callbacks
+from ..callbacks.callbacks_outliers import register_outlier_callbacks
+from ..hdf5_compilers.hdf5compile_xrd import xrd_peaks_dict_to_hdf5, xrd_roi_dict_to_hdf5, xrd_integrated_dict_to_hdf5
 
 
 def callbacks_xrd(app, children_xrd):
     
-    # Callback to update current position
-    @app.callback(Output('xrd_position_store', 'data'),
-                  Input('xrd_heatmap', 'clickData'),
-                  prevent_initial_call=True
-                  )
-    def update_position(heatmap_click):
-        if heatmap_click is None:
-            return None
-        target_x = heatmap_click['points'][0]['x']
-        target_y = heatmap_click['points'][0]['y']
-
-        position = (target_x, target_y)
-
-        return position
+    # Callback to update current position, handled in the browser (assets/clientside.js)
+    app.clientside_callback(
+        ClientsideFunction(namespace="heatmap", function_name="update_position"),
+        Output("xrd_position_store", "data"),
+        Input("xrd_heatmap", "clickData"),
+        prevent_initial_call=True,
+    )
 
     @app.callback(
         [Output("xrd_select_dataset", "options"),
@@ -33,12 +33,23 @@ def callbacks_xrd(app, children_xrd):
     )
     @check_conditions(xrd_conditions, hdf5_path_index=0)
     def xrd_scan_hdf5_for_datasets(hdf5_path):
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             dataset_list = get_hdf5_datasets(hdf5_file, dataset_type='xrd')
 
         return dataset_list, dataset_list[0]
 
             
+    # Colour range edits only restyle the displayed heatmap, in the browser (assets/clientside.js)
+    app.clientside_callback(
+        ClientsideFunction(namespace="heatmap", function_name="update_color_range"),
+        Output("xrd_heatmap", "figure", allow_duplicate=True),
+        Input("xrd_heatmap_min", "value"),
+        Input("xrd_heatmap_max", "value"),
+        State("xrd_heatmap_precision", "value"),
+        State("xrd_heatmap", "figure"),
+        prevent_initial_call=True,
+    )
+
     # Callback for heatmap selection
     @app.callback(
         [
@@ -48,20 +59,31 @@ def callbacks_xrd(app, children_xrd):
             Output("xrd_heatmap_select", "options"),
         ],
         Input("xrd_heatmap_select", "value"),
-        Input("xrd_heatmap_min", "value"),
-        Input("xrd_heatmap_max", "value"),
+        State("xrd_heatmap_min", "value"),
+        State("xrd_heatmap_max", "value"),
         Input("xrd_heatmap_precision", "value"),
         Input("xrd_heatmap_edit", "value"),
         Input('hdf5_path_store', 'data'),
         Input("xrd_select_dataset", "value"),
+        Input("xrd_heatmap_interpolation", "value"),
+        Input("xrd_heatmap_resolution", "value"),
+        Input("xrd_heatmap_map_options", "value"),
+        Input("xrd_heatmap_reference", "value"),
+        Input("xrd_heatmap_operation", "value"),
+        Input("xrd_outlier_store", "data"),
         prevent_initial_call=True,
     )
     @check_conditions(xrd_conditions, hdf5_path_index=5)
-    def xrd_update_heatmap(heatmap_select, z_min, z_max, precision, edit_toggle, hdf5_path, selected_dataset):
-        with h5py.File(hdf5_path, 'r') as hdf5_file:
+    @scheduled("interactive")
+    def xrd_update_heatmap(heatmap_select, z_min, z_max, precision, edit_toggle, hdf5_path, selected_dataset,
+                           interpolation, resolution, map_options, reference_dataset, operation,
+                           outlier_store):
+        with open_hdf5(hdf5_path, 'r') as hdf5_file:
             xrd_group = hdf5_file[selected_dataset]
 
-            if ctx.triggered_id in ["xrd_heatmap_select", "xrd_heatmap_edit", "xrd_heatmap_precision"]:
+            if ctx.triggered_id in ["xrd_heatmap_select", "xrd_heatmap_edit", "xrd_heatmap_precision",
+                                   "xrd_heatmap_interpolation", "xrd_heatmap_resolution", "xrd_heatmap_map_options",
+                                   "xrd_heatmap_reference", "xrd_heatmap_operation"]:
                 z_min = None
                 z_max = None
 
@@ -70,8 +92,16 @@ def callbacks_xrd(app, children_xrd):
                 masking = False
 
             xrd_df = xrd_make_results_dataframe_from_hdf5(xrd_group)
+            if reference_dataset is not None:
+                xrd_df = get_derived_dataframe_from_hdf5(xrd_group, reference_dataset, operation)
+            # Mask layers hold the edits not written yet, derived maps combine the ignored tags of both datasets
+            mask_layers = get_mask_layers(xrd_group) if masking and reference_dataset is None else None
             fig = make_heatmap_from_dataframe(xrd_df, values=heatmap_select, z_min=z_min, z_max=z_max,
-                                              precision=precision, masking=masking)
+                                              colorbar_title=derived_colorbar_title("", reference_dataset, operation),
+                                              precision=precision, masking=masking, interpolation=interpolation,
+                                              resolution=resolution or HEATMAP_RESOLUTION, map_options=map_options,
+                                              mask_layers=mask_layers, hdf5_group=xrd_group)
+            fig = outliers_add_to_heatmap(fig, outlier_store, selected_dataset)
 
             z_min = np.round(fig.data[0].zmin, precision)
             z_max = np.round(fig.data[0].zmax, precision)
@@ -80,7 +110,15 @@ def callbacks_xrd(app, children_xrd):
             if "default" in options:
                 options.remove("default")
 
-            return fig, z_min, z_max, options
+            return compact_figure(fig), z_min, z_max, options
+
+
+    # Reference dataset selection and export of the derived maps
+    register_derived_callbacks(app, "xrd", xrd_conditions)
+
+
+    # Outlier detection and review of the candidates
+    register_outlier_callbacks(app, "xrd", xrd_conditions)
 
 
 
@@ -99,12 +137,32 @@ def callbacks_xrd(app, children_xrd):
         Input("xrd_image_min", "value"),
         Input("xrd_image_max", "value"),
         Input("hdf5_path_store", "data"),
+        Input("xrd_plot", "relayoutData"),
+        State("xrd_fits_select", "options"),
     )
     @check_conditions(xrd_conditions, hdf5_path_index=6)
-    def xrd_update_plot(position, plot_select, selected_dataset, fits_select, z_min, z_max, hdf5_path):
+    @scheduled("interactive")
+    def xrd_update_plot(position, plot_select, selected_dataset, fits_select, z_min, z_max, hdf5_path,
+                        relayout_data, fits_options):
         if position is None:
             raise PreventUpdate
 
+        # Selecting fits only toggles the visibility of the fit traces already on the figure
+        if ctx.triggered_id == "xrd_fits_select":
+            if plot_select != "fitted" or not fits_options:
+                raise PreventUpdate
+            patched_fig = Patch()
+            for index, fit in enumerate(fits_options):
+                patched_fig["data"][index]["visible"] = not fits_select or fit in fits_select
+            return patched_fig, no_update, fits_select, no_update, no_update
+
+        # Zooming only refreshes the image and the integrated patterns, fetching the data matching the new view
+        plot_ranges = (None, None)
+        if ctx.triggered_id == "xrd_plot":
+            plot_ranges = get_ranges_from_relayout(relayout_data)
+            if plot_select not in ["image", "integrated", "reintegrated"] or plot_ranges is None:
+                raise PreventUpdate
+
         target_x = position[0]
         target_y = position[1]
 
@@ -116,11 +174,13 @@ def callbacks_xrd(app, children_xrd):
             z_min = None
             z_max = None
 
-        with h5py.File(hdf5_path, "r") as hdf5_file:
+        with open_hdf5(hdf5_path, "r") as hdf5_file:
             xrd_group = hdf5_file[selected_dataset]
             if plot_select == "integrated":
+                if ctx.triggered_id == "xrd_position_store":
+                    record_prefetch_access(xrd_get_integrated_from_hdf5, xrd_group, target_x, target_y)
                 measurement_df = xrd_get_integrated_from_hdf5(xrd_group, target_x, target_y)
-                fig = xrd_plot_integrated_from_dataframe(fig, measurement_df)
+                fig = xrd_plot_integrated_from_dataframe(fig, measurement_df, x_range=plot_ranges[0])
                 fig.update_layout(plot_layout(title=""))
 
             if plot_select == "fitted":
@@ -130,11 +190,25 @@ def callbacks_xrd(app, children_xrd):
                 fig.update_layout(plot_layout(title="", showlegend=True))
 
             if plot_select == "image":
-                image_array = xrd_get_image_from_hdf5(xrd_group, target_x, target_y)
-                fig = xrd_plot_image_from_array(image_array, z_min, z_max)
+                pyramid = xrd_get_image_pyramid(xrd_group, target_x, target_y)
+                fig = xrd_plot_image_from_pyramid(pyramid, z_min, z_max, *plot_ranges)
                 z_min = np.round(fig.data[0].zmin, 0)
                 z_max = np.round(fig.data[0].zmax, 0)
 
+            if plot_select == "reintegrated":
+                measurement_df = xrd_get_reintegrated_from_hdf5(xrd_group, target_x, target_y)
+                fig = xrd_plot_integrated_from_dataframe(fig, measurement_df, x_range=plot_ranges[0])
+                fig.update_xaxes(title_text="Radial")
+                fig.update_layout(plot_layout(title=""))
+
+            if plot_select == "caked":
+                radial_array, chi_array, caked_array = xrd_get_caked_from_hdf5(xrd_group, target_x, target_y)
+                fig = xrd_plot_image_from_array(caked_array, None, None, x=radial_array, y=chi_array,
+                                                title="Caked image", x_title="Radial", y_title="chi (°)")
+
+
+        if plot_select == "integrated" and ctx.triggered_id == "xrd_position_store":
+            prefetch_neighbours(xrd_get_integrated_from_hdf5, hdf5_path, selected_dataset, target_x, target_y)
 
         # Prevent resetting of xrd_fits_select
         if ctx.triggered_id in ["xrd_fits_select"]:
@@ -145,9 +219,138 @@ def callbacks_xrd(app, children_xrd):
 
 
 
-        return fig, options, fits_select_value, z_min, z_max
+        return compact_figure(fig), options, fits_select_value, z_min, z_max
         
 
+    # Batch peak search on all integrated patterns
+    @app.callback(
+        Output("xrd_text_box", "children", allow_duplicate=True),
+        Input("xrd_peak_search_button", "n_clicks"),
+        State("hdf5_path_store", "data"),
+        State("xrd_select_dataset", "value"),
+        background=True,
+        running=[(Output("xrd_peak_search_button", "disabled"), True, False)],
+        prevent_initial_call=True,
+    )
+    @check_conditions(xrd_conditions, hdf5_path_index=1)
+    @scheduled("batch")
+    def xrd_peak_search(n_clicks, hdf5_path, selected_dataset):
+        if n_clicks > 0:
+            # The search only reads the file, the write lock is taken for the write-back
+            with open_hdf5(hdf5_path, "r") as hdf5_file:
+                results_dict = xrd_batch_peak_search(hdf5_file[selected_dataset])
+            with open_hdf5(hdf5_path, "a") as hdf5_file:
+                xrd_peaks_dict_to_hdf5(
+                    hdf5_file[selected_dataset], results_dict, parameters_dict={"method": "SNIP + find_peaks"}
+                )
+
+            if not results_dict:
+                return "No integrated patterns found in dataset"
+            nb_peaks = len(next(iter(results_dict.values())))
+            return f"Found {nb_peaks} reference peaks over {len(results_dict)} positions"
+
+
+    # ROI reduction of all 2D images
+    @app.callback(
+        Output("xrd_text_box", "children", allow_duplicate=True),
+        Input("xrd_roi_button", "n_clicks"),
+        State("xrd_roi_name", "value"),
+        State("xrd_roi_type", "value"),
+        State("xrd_roi_param_1", "value"),
+        State("xrd_roi_param_2", "value"),
+        State("xrd_roi_param_3", "value"),
+        State("xrd_roi_param_4", "value"),
+        State("hdf5_path_store", "data"),
+        State("xrd_select_dataset", "value"),
+        background=True,
+        running=[(Output("xrd_roi_button", "disabled"), True, False)],
+        prevent_initial_call=True,
+    )
+    @check_conditions(xrd_conditions, hdf5_path_index=7)
+    @scheduled("batch")
+    def xrd_roi_reduction(n_clicks, roi_name, roi_type, param_1, param_2, param_3, param_4, hdf5_path,
+                          selected_dataset):
+        if n_clicks > 0:
+            if not roi_name or None in [param_1, param_2, param_3, param_4]:
+                return "ROI name and all ROI parameters must be filled"
+
+            if roi_type == "rectangle":
+                roi_dict = {"name": roi_name, "type": roi_type,
+                            "x_min": param_1, "x_max": param_2, "y_min": param_3, "y_max": param_4}
+            else:
+                roi_dict = {"name": roi_name, "type": roi_type,
+                            "center_x": param_1, "center_y": param_2, "r_min": param_3, "r_max": param_4}
+
+            with open_hdf5(hdf5_path, "r") as hdf5_file:
+                results_dict = xrd_batch_roi_reduction(hdf5_file[selected_dataset], [roi_dict])
+            with open_hdf5(hdf5_path, "a") as hdf5_file:
+                xrd_roi_dict_to_hdf5(hdf5_file[selected_dataset], results_dict, [roi_dict])
+
+            return f"Computed ROI {roi_name} over {len(results_dict)} positions"
+
+
+    # Azimuthal integration of all 2D images
+    @app.callback(
+        Output("xrd_text_box", "children", allow_duplicate=True),
+        Input("xrd_integration_button", "n_clicks"),
+        State("xrd_integration_radial_bins", "value"),
+        State("xrd_integration_chi_bins", "value"),
+        State("xrd_integration_unit", "value"),
+        State("hdf5_path_store", "data"),
+        State("xrd_select_dataset", "value"),
+        background=True,
+        running=[(Output("xrd_integration_button", "disabled"), True, False)],
+        prevent_initial_call=True,
+    )
+    @check_conditions(xrd_conditions, hdf5_path_index=4)
+    @scheduled("batch")
+    def xrd_integrate_images(n_clicks, nb_radial_bins, nb_chi_bins, unit, hdf5_path, selected_dataset):
+        if n_clicks > 0:
+            if not nb_radial_bins or not nb_chi_bins:
+                return "Number of radial and chi bins must be filled"
+
+            # New integration matrices are stored with the results, once the images are integrated
+            matrix_dict = {}
+            with open_hdf5(hdf5_path, "r") as hdf5_file:
+                try:
+                    results_dict = xrd_batch_integrate_images(
+                        hdf5_file[selected_dataset], int(nb_radial_bins), int(nb_chi_bins), unit,
+                        matrix_dict=matrix_dict,
+                    )
+                except KeyError as e:
+                    return e.args[0]
+            with open_hdf5(hdf5_path, "a") as hdf5_file:
+                xrd_group = hdf5_file[selected_dataset]
+                xrd_store_integration_matrices(xrd_group, matrix_dict)
+                xrd_integrated_dict_to_hdf5(xrd_group, results_dict)
+
+            return f"Integrated {len(results_dict)} images"
+
+
+    # Callback for ROI inputs
+    @app.callback(
+        Output("xrd_roi_inputs", "children"),
+        Input("xrd_roi_type", "value"),
+    )
+    def xrd_roi_interface(roi_type):
+        if roi_type == "annulus":
+            placeholders = ["Center x (px)", "Center y (px)", "Inner radius (px)", "Outer radius (px)"]
+        else:
+            placeholders = ["x min (px)", "x max (px)", "y min (px)", "y max (px)"]
+
+        new_children = [
+            dcc.Input(
+                id=f"xrd_roi_param_{n + 1}",
+                className="long-item",
+                type="number",
+                placeholder=placeholder,
+                value=None,
+            )
+            for n, placeholder in enumerate(placeholders)
+        ]
+        return new_children
+
+
     # Callback to deal with heatmap edit mode
     @app.callback(
         Output('xrd_text_box', 'children', allow_duplicate=True),
@@ -165,12 +368,7 @@ def callbacks_xrd(app, children_xrd):
         target_x = heatmap_click['points'][0]['x']
         target_y = heatmap_click['points'][0]['y']
 
-        with h5py.File(hdf5_path, 'a') as hdf5_file:
-            xrd_group = hdf5_file[selected_dataset]
-            position_group = get_target_position_group(xrd_group, target_x, target_y)
-            if not position_group.attrs["ignored"]:
-                position_group.attrs["ignored"] = True
-                return f"{target_x}, {target_y} ignore set to True"
-            else:
-                position_group.attrs["ignored"] = False
-                return f"{target_x}, {target_y} ignore set to False"
+        point_layers, nb_pending = toggle_mask_point(hdf5_path, selected_dataset, target_x, target_y)
+        if point_layers is None:
+            raise PreventUpdate
+        return format_mask_point(target_x, target_y, point_layers, nb_pending)
@@ -0,0 +1,359 @@
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from ..functions.functions_shared import *
+from ..functions.functions_export import RESULTS_DATAFRAME_FUNCTIONS, EXPORT_INDEX, export_get_units_from_column
+
+'''Catalogue of a campaign: SQLite index of the samples, datasets and results of a folder of HDF5 files'''
+
+CATALOGUE_OPERATORS = [">", ">=", "<", "<=", "=", "!="]
+CATALOGUE_WORKERS = 4
+# Bumped when the schema changes, older catalogues are rebuilt
+CATALOGUE_VERSION = 2
+
+CATALOGUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    sample_name TEXT,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    indexed_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS datasets (
+    file_path TEXT NOT NULL REFERENCES files(file_path) ON DELETE CASCADE,
+    dataset TEXT NOT NULL,
+    ht_type TEXT,
+    instrument TEXT,
+    nb_positions INTEGER,
+    PRIMARY KEY (file_path, dataset)
+);
+CREATE TABLE IF NOT EXISTS results (
+    file_path TEXT NOT NULL REFERENCES files(file_path) ON DELETE CASCADE,
+    dataset TEXT NOT NULL,
+    x_pos REAL NOT NULL,
+    y_pos REAL NOT NULL,
+    quantity TEXT NOT NULL,
+    units TEXT,
+    value REAL,
+    ignored INTEGER
+);
+CREATE TABLE IF NOT EXISTS summaries (
+    file_path TEXT NOT NULL REFERENCES files(file_path) ON DELETE CASCADE,
+    dataset TEXT NOT NULL,
+    quantity TEXT NOT NULL,
+    units TEXT,
+    count INTEGER,
+    min REAL,
+    max REAL,
+    mean REAL,
+    median REAL,
+    p02 REAL,
+    p98 REAL,
+    PRIMARY KEY (file_path, dataset, quantity)
+);
+CREATE INDEX IF NOT EXISTS results_quantity_value ON results (quantity, value);
+CREATE INDEX IF NOT EXISTS results_position ON results (file_path, x_pos, y_pos);
+CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+"""
+
+
+def catalogue_connect(db_path):
+    """
+    Open the catalogue database, creating the tables if needed
+
+    Parameters:
+        db_path (str, Path): path to the SQLite file
+
+    Returns:
+        sqlite3.Connection
+    """
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA foreign_keys=ON")
+    if connection.execute("PRAGMA user_version").fetchone()[0] < CATALOGUE_VERSION:
+        with connection:
+            for table in ["summaries", "results", "datasets", "files"]:
+                connection.execute(f"DROP TABLE IF EXISTS {table}")
+        connection.execute(f"PRAGMA user_version = {CATALOGUE_VERSION}")
+    connection.executescript(CATALOGUE_SCHEMA)
+    return connection
+
+
+def catalogue_read_hdf5(hdf5_path):
+    """
+    Read the sample name, datasets and per position numerical results of a sample HDF5 file, and summarize every
+    result of every dataset (positions flagged as ignored excluded)
+
+    Parameters:
+        hdf5_path (str, Path): path to the HDF5 file
+
+    Returns:
+        str: sample name
+        list: (dataset, ht_type, instrument, nb_positions) of every dataset
+        list: (dataset, x_pos, y_pos, quantity, units, value, ignored) of every numerical result
+        list: (dataset, quantity, units, count, min, max, mean, median, p02, p98) of every result
+    """
+    try:
+        sample_name = get_sample_info_from_hdf5(hdf5_path)["sample_name"]
+        if isinstance(sample_name, bytes):
+            sample_name = sample_name.decode()
+    except KeyError:
+        sample_name = Path(hdf5_path).stem
+
+    dataset_rows = []
+    result_rows = []
+    summary_rows = []
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        for dataset_name, dataset_group in hdf5_file.items():
+            if dataset_name == "sample" or not isinstance(dataset_group, h5py.Group):
+                continue
+            ht_type = dataset_group.attrs.get("HT_type")
+            instrument = dataset_group.attrs.get("instrument")
+            nb_positions = sum(1 for _ in get_position_groups(dataset_group))
+            dataset_rows.append((dataset_name, None if ht_type is None else str(ht_type),
+                                 None if instrument is None else str(instrument), nb_positions))
+
+            make_results_dataframe = RESULTS_DATAFRAME_FUNCTIONS.get(ht_type)
+            if make_results_dataframe is None:
+                continue
+            df = make_results_dataframe(dataset_group)
+            if df.empty or not set(EXPORT_INDEX).issubset(df.columns):
+                continue
+
+            ignored = df["ignored"].astype(int) if "ignored" in df.columns else pd.Series(0, index=df.index)
+            for column in df.columns.drop(EXPORT_INDEX + ["ignored"], errors="ignore"):
+                values = pd.to_numeric(df[column], errors="coerce")
+                valid = values.notna()
+                units = export_get_units_from_column(column)
+                result_rows.extend(
+                    (dataset_name, float(x), float(y), column, units, float(value), int(flag))
+                    for x, y, value, flag in zip(df.loc[valid, EXPORT_INDEX[0]], df.loc[valid, EXPORT_INDEX[1]],
+                                                  values[valid], ignored[valid])
+                )
+
+                kept_values = values[valid & (ignored == 0)].to_numpy(dtype=np.float64)
+                if kept_values.size == 0:
+                    continue
+                p02, median, p98 = np.percentile(kept_values, [2, 50, 98])
+                summary_rows.append(
+                    (dataset_name, column, units, int(kept_values.size), float(kept_values.min()),
+                     float(kept_values.max()), float(kept_values.mean()), float(median), float(p02), float(p98))
+                )
+
+    return sample_name, dataset_rows, result_rows, summary_rows
+
+
+def catalogue_update(db_path, folderpath, progress_callback=None, max_workers=CATALOGUE_WORKERS):
+    """
+    Update the catalogue with the HDF5 files of a folder, only new or modified files (mtime or size) are read, in
+    parallel, and files removed from the folder are dropped from the catalogue
+
+    Parameters:
+        db_path (str, Path): path to the SQLite file
+        folderpath (str, Path): folder containing the sample HDF5 files
+        progress_callback (function, optional): called with a progress message after each file
+        max_workers (int): number of files read at the same time
+
+    Returns:
+        dict: number of 'added', 'updated', 'unchanged' and 'removed' files
+    """
+    folderpath = Path(folderpath).resolve()
+    counts = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0}
+
+    hdf5_path_list = [path.resolve() for path in safe_glob(folderpath) if h5py.is_hdf5(path)]
+
+    connection = catalogue_connect(db_path)
+    try:
+        indexed = {
+            file_path: (mtime_ns, size)
+            for file_path, mtime_ns, size in connection.execute(
+                "SELECT file_path, mtime_ns, size FROM files WHERE folder = ?", (str(folderpath),)
+            )
+        }
+
+        stale_list = []
+        for hdf5_path in hdf5_path_list:
+            stat = hdf5_path.stat()
+            previous = indexed.pop(str(hdf5_path), None)
+            if previous == (stat.st_mtime_ns, stat.st_size):
+                counts["unchanged"] += 1
+            else:
+                stale_list.append((hdf5_path, stat, previous))
+
+        # Files are read in parallel, SQLite writes stay in this thread
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            read_list = executor.map(catalogue_read_hdf5, [hdf5_path for hdf5_path, stat, previous in stale_list])
+            for index, ((hdf5_path, stat, previous), read) in enumerate(zip(stale_list, read_list)):
+                catalogue_write_file(connection, hdf5_path, folderpath, stat, *read)
+                counts["added" if previous is None else "updated"] += 1
+
+                if progress_callback is not None:
+                    progress_callback(f"Indexed {hdf5_path.name} ({index + 1}/{len(stale_list)})")
+
+        # Files left in indexed are no longer in the folder
+        with connection:
+            connection.executemany("DELETE FROM files WHERE file_path = ?", [(path,) for path in indexed])
+        counts["removed"] = len(indexed)
+    finally:
+        connection.close()
+
+    return counts
+
+
+def catalogue_write_file(connection, hdf5_path, folderpath, stat, sample_name, dataset_rows, result_rows,
+                         summary_rows):
+    """Replace the catalogue rows of one file by the output of catalogue_read_hdf5"""
+    with connection:
+        connection.execute("DELETE FROM files WHERE file_path = ?", (str(hdf5_path),))
+        connection.execute(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            (str(hdf5_path), str(folderpath), sample_name, stat.st_mtime_ns, stat.st_size,
+             datetime.now().isoformat(timespec="seconds")),
+        )
+        connection.executemany(
+            "INSERT INTO datasets VALUES (?, ?, ?, ?, ?)",
+            [(str(hdf5_path),) + row for row in dataset_rows],
+        )
+        connection.executemany(
+            "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(str(hdf5_path),) + row for row in result_rows],
+        )
+        connection.executemany(
+            "INSERT INTO summaries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(str(hdf5_path),) + row for row in summary_rows],
+        )
+
+
+def catalogue_get_quantities(db_path, folderpath=None):
+    """
+    List the result quantities of the catalogue
+
+    Parameters:
+        db_path (str, Path): path to the SQLite file
+        folderpath (str, Path, optional): only list the quantities of the files of this folder
+
+    Returns:
+        list: quantity names, sorted
+    """
+    connection = catalogue_connect(db_path)
+    try:
+        if folderpath is None:
+            rows = connection.execute("SELECT DISTINCT quantity FROM results ORDER BY quantity")
+        else:
+            rows = connection.execute(
+                "SELECT DISTINCT quantity FROM results JOIN files USING (file_path) WHERE folder = ? "
+                "ORDER BY quantity",
+                (str(Path(folderpath).resolve()),),
+            )
+        return [row[0] for row in rows]
+    finally:
+        connection.close()
+
+
+def catalogue_get_summary(db_path, folderpath=None):
+    """
+    Count the samples, datasets and results of the catalogue, by dataset type
+
+    Parameters:
+        db_path (str, Path): path to the SQLite file
+        folderpath (str, Path, optional): only count the files of this folder
+
+    Returns:
+        pd.DataFrame: ht_type, nb_samples, nb_datasets
+    """
+    connection = catalogue_connect(db_path)
+    query = ("SELECT ht_type, COUNT(DISTINCT file_path) AS nb_samples, COUNT(*) AS nb_datasets "
+             "FROM datasets JOIN files USING (file_path)")
+    parameters = ()
+    if folderpath is not None:
+        query += " WHERE folder = ?"
+        parameters = (str(Path(folderpath).resolve()),)
+    try:
+        return pd.read_sql_query(query + " GROUP BY ht_type", connection, params=parameters)
+    finally:
+        connection.close()
+
+
+def catalogue_query(db_path, conditions, folderpath=None, include_ignored=False):
+    """
+    Find the positions of all the catalogued wafers matching every condition, without opening the HDF5 files
+
+    Parameters:
+        db_path (str, Path): path to the SQLite file
+        conditions (list): (quantity, operator, value) tuples, quantity may use SQL LIKE wildcards (%), e.g.
+            [("coercivity_m0", ">", 1), ("%Co%", ">", 30)]
+        folderpath (str, Path, optional): only search the files of this folder
+        include_ignored (bool): also return positions flagged as ignored
+
+    Returns:
+        pd.DataFrame: sample_name, file_path, x_pos, y_pos and one column per condition with the matching value
+    """
+    if not conditions:
+        raise ValueError("At least one condition is required")
+
+    select_list = ["files.sample_name", "c0.file_path", "c0.x_pos", "c0.y_pos"]
+    join_list = []
+    parameters = []
+    for index, (quantity, operator, value) in enumerate(conditions):
+        if operator not in CATALOGUE_OPERATORS:
+            raise ValueError(f"Unknown operator {operator}, expected one of {CATALOGUE_OPERATORS}")
+
+        # Exact match unless wildcards are given, '_' is also a LIKE wildcard and common in quantity names
+        match = "LIKE" if "%" in quantity else "="
+        subquery = (f"(SELECT file_path, x_pos, y_pos, MAX(value) AS value FROM results "
+                    f"WHERE quantity {match} ? AND value {operator} ?"
+                    f"{'' if include_ignored else ' AND NOT ignored'} GROUP BY file_path, x_pos, y_pos) AS c{index}")
+        parameters.extend([quantity, float(value)])
+        if index == 0:
+            join_list.append(subquery)
+        else:
+            join_list.append(f"JOIN {subquery} ON c{index}.file_path = c0.file_path "
+                             f"AND c{index}.x_pos = c0.x_pos AND c{index}.y_pos = c0.y_pos")
+        select_list.append(f"c{index}.value AS 'c{index}'")
+
+    query = (f"SELECT {', '.join(select_list)} FROM {' '.join(join_list)} "
+             f"JOIN files ON files.file_path = c0.file_path")
+    if folderpath is not None:
+        query += " WHERE files.folder = ?"
+        parameters.append(str(Path(folderpath).resolve()))
+    query += " ORDER BY files.sample_name, c0.x_pos, c0.y_pos"
+
+    connection = catalogue_connect(db_path)
+    try:
+        df = pd.read_sql_query(query, connection, params=parameters)
+    finally:
+        connection.close()
+
+    # Repeated conditions keep their index so that their columns stay apart
+    column_dict = {}
+    for index, (quantity, operator, value) in enumerate(conditions):
+        column = f"{quantity} {operator} {value}"
+        column_dict[f"c{index}"] = f"{column} (c{index})" if column in column_dict.values() else column
+    return df.rename(columns=column_dict)
+
+
+def catalogue_plot_matches(df):
+    """
+    Plot the matching positions of every wafer, one trace per sample file
+
+    Parameters:
+        df (pd.DataFrame): output of catalogue_query
+
+    Returns:
+        go.Figure
+    """
+    fig = go.Figure(layout=plot_layout(title="", showlegend=True))
+    fig.update_xaxes(title_text="X (mm)", range=[-50, 50])
+    fig.update_yaxes(title_text="Y (mm)", range=[-50, 50], scaleanchor="x")
+
+    # Files without a sample name are kept, grouping on it would drop their positions
+    for file_path, sample_df in df.groupby("file_path", sort=False):
+        sample_name = sample_df["sample_name"].iloc[0]
+        name = Path(file_path).name if pd.isna(sample_name) else f"{sample_name} ({Path(file_path).name})"
+        fig.add_trace(
+            go.Scattergl(x=sample_df["x_pos"], y=sample_df["y_pos"], mode="markers", name=name,
+                         marker=dict(size=10))
+        )
+    return fig
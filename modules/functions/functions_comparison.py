@@ -0,0 +1,175 @@
+import json
+
+from ..functions.functions_shared import *
+from ..functions.functions_catalogue import catalogue_connect
+
+'''Comparison of one result map over many wafers, read from the catalogue summaries and results tables'''
+
+COMPARISON_RANGE_MODES = ["percentile", "full", "manual"]
+COMPARISON_COLUMNS = 5
+
+
+def comparison_make_entry(file_path, dataset):
+    """Dropdown value of one (file, dataset) map"""
+    return json.dumps([file_path, dataset])
+
+
+def comparison_get_summaries(db_path, quantity, folderpath=None):
+    """
+    List the catalogued datasets holding a quantity, with the summary of its values on every dataset
+
+    Parameters:
+        db_path (str, Path): path to the SQLite file
+        quantity (str): result name, e.g. 'Fe' or 'coercivity_m0'
+        folderpath (str, Path, optional): only list the files of this folder
+
+    Returns:
+        pd.DataFrame: sample_name, file_path, dataset, units, count, min, max, mean, median, p02, p98 and entry, the
+            dropdown value of the map
+    """
+    query = ("SELECT files.sample_name, summaries.* FROM summaries JOIN files USING (file_path) "
+             "WHERE quantity = ?")
+    parameters = [quantity]
+    if folderpath is not None:
+        query += " AND folder = ?"
+        parameters.append(str(Path(folderpath).resolve()))
+    query += " ORDER BY files.sample_name, file_path, dataset"
+
+    connection = catalogue_connect(db_path)
+    try:
+        summary_df = pd.read_sql_query(query, connection, params=parameters)
+    finally:
+        connection.close()
+
+    summary_df = summary_df.drop(columns="quantity")
+    summary_df["entry"] = [comparison_make_entry(file_path, dataset)
+                           for file_path, dataset in zip(summary_df["file_path"], summary_df["dataset"])]
+    return summary_df
+
+
+def comparison_select_entries(summary_df, entry_list=None):
+    """
+    Keep the maps to compare, by default the first dataset of every file
+
+    Parameters:
+        summary_df (pd.DataFrame): output of comparison_get_summaries
+        entry_list (list, optional): dropdown values of the selected maps
+
+    Returns:
+        pd.DataFrame: the selected rows of summary_df
+    """
+    if entry_list:
+        return summary_df[summary_df["entry"].isin(entry_list)]
+    return summary_df.drop_duplicates("file_path")
+
+
+def comparison_get_colour_range(summary_df, mode="percentile", z_min=None, z_max=None):
+    """
+    Colour range shared by all the maps, computed from the summaries only
+
+    Parameters:
+        summary_df (pd.DataFrame): selected rows of comparison_get_summaries
+        mode (str): 'percentile' from the lowest 2nd to the highest 98th percentile, to keep outliers from flattening
+            the maps, 'full' from the lowest to the highest value, 'manual' to use z_min and z_max
+        z_min (float, optional): lower bound in manual mode, the percentile one is used if missing
+        z_max (float, optional): upper bound in manual mode, the percentile one is used if missing
+
+    Returns:
+        float: lower bound of the colour range
+        float: upper bound of the colour range
+    """
+    if mode not in COMPARISON_RANGE_MODES:
+        raise ValueError(f"Unknown range mode {mode}, expected one of {COMPARISON_RANGE_MODES}")
+
+    if mode == "full":
+        range_min, range_max = summary_df["min"].min(), summary_df["max"].max()
+    else:
+        range_min, range_max = summary_df["p02"].min(), summary_df["p98"].max()
+
+    if z_min is not None and mode == "manual":
+        range_min = z_min
+    if z_max is not None and mode == "manual":
+        range_max = z_max
+
+    return float(range_min), float(range_max)
+
+
+def comparison_get_maps(db_path, quantity, summary_df, include_ignored=False):
+    """
+    Read the values of a quantity on the selected maps with a single query on the catalogue results table
+
+    Parameters:
+        db_path (str, Path): path to the SQLite file
+        quantity (str): result name
+        summary_df (pd.DataFrame): selected rows of comparison_get_summaries
+        include_ignored (bool): keep the values of positions flagged as ignored
+
+    Returns:
+        pd.DataFrame: file_path, dataset, x_pos, y_pos, value
+    """
+    file_path_list = summary_df["file_path"].unique().tolist()
+    if not file_path_list:
+        return pd.DataFrame(columns=["file_path", "dataset", "x_pos", "y_pos", "value"])
+
+    query = (f"SELECT file_path, dataset, x_pos, y_pos, value FROM results WHERE quantity = ? "
+             f"AND file_path IN ({', '.join('?' * len(file_path_list))})"
+             f"{'' if include_ignored else ' AND NOT ignored'}")
+
+    connection = catalogue_connect(db_path)
+    try:
+        maps_df = pd.read_sql_query(query, connection, params=[quantity] + file_path_list)
+    finally:
+        connection.close()
+
+    return maps_df.merge(summary_df[["file_path", "dataset"]], on=["file_path", "dataset"])
+
+
+def comparison_plot_maps(summary_df, maps_df, z_min, z_max, nb_columns=COMPARISON_COLUMNS, colorbar_title=""):
+    """
+    Plot the maps in a grid of heatmaps sharing the same colour axis
+
+    Parameters:
+        summary_df (pd.DataFrame): selected rows of comparison_get_summaries, in plotting order
+        maps_df (pd.DataFrame): output of comparison_get_maps
+        z_min (float): lower bound of the colour range
+        z_max (float): upper bound of the colour range
+        nb_columns (int): number of maps per row
+        colorbar_title (str): title of the shared colorbar
+
+    Returns:
+        go.Figure
+    """
+    nb_maps = len(summary_df)
+    nb_columns = max(1, min(int(nb_columns), nb_maps))
+    nb_rows = -(-nb_maps // nb_columns)
+
+    titles = [f"{sample_name} ({dataset})" if summary_df["file_path"].eq(file_path).sum() > 1 else str(sample_name)
+              for sample_name, file_path, dataset in
+              zip(summary_df["sample_name"], summary_df["file_path"], summary_df["dataset"])]
+    fig = make_subplots(rows=nb_rows, cols=nb_columns, subplot_titles=titles, horizontal_spacing=0.02,
+                        vertical_spacing=0.3 / nb_rows)
+
+    grouped = dict(list(maps_df.groupby(["file_path", "dataset"], sort=False)))
+    for index, (file_path, dataset) in enumerate(zip(summary_df["file_path"], summary_df["dataset"])):
+        map_df = grouped.get((file_path, dataset))
+        if map_df is None:
+            continue
+        grid = WaferGrid(map_df["x_pos"], map_df["y_pos"])
+        heatmap_array = grid.to_plane(map_df["value"].to_numpy(dtype=np.float64))
+
+        fig.add_trace(
+            go.Heatmap(x=grid.x_values, y=grid.y_values, z=heatmap_array, coloraxis="coloraxis",
+                       hovertemplate="x: %{x} mm<br>y: %{y} mm<br>value: %{z}<extra></extra>"),
+            row=index // nb_columns + 1, col=index % nb_columns + 1,
+        )
+
+    fig.update_xaxes(range=[-43, 43], showticklabels=False)
+    fig.update_yaxes(range=[-43, 43], showticklabels=False, scaleanchor="x")
+    fig.update_layout(
+        height=max(400, 280 * nb_rows),
+        margin=dict(l=20, r=20, t=40, b=20),
+        coloraxis=dict(colorscale="Plasma", cmin=z_min, cmax=z_max,
+                       colorbar=dict(title=colorbar_title, len=min(1, 600 / max(400, 280 * nb_rows)))),
+    )
+
+    return fig
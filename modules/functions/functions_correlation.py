@@ -0,0 +1,194 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from ..functions.functions_shared import *
+from ..functions.functions_export import RESULTS_DATAFRAME_FUNCTIONS, EXPORT_INDEX
+
+'''Spatial join of the results of different techniques measured on the same wafer, for correlation plots'''
+
+CORRELATION_TOLERANCE = 2.0
+CORRELATION_WORKERS = 4
+CORRELATION_JOIN_MODES = ["inner", "left"]
+
+
+def correlation_conditions(hdf5_path, *args, **kwargs):
+    if hdf5_path is None:
+        return False
+    if not h5py.is_hdf5(hdf5_path):
+        return False
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        for dataset_group in hdf5_file.values():
+            if dataset_group.attrs.get("HT_type") in RESULTS_DATAFRAME_FUNCTIONS:
+                return True
+    return False
+
+
+def correlation_read_dataset_results(hdf5_path, dataset_name):
+    """
+    Read the numerical results of one dataset, positions flagged as ignored are removed
+
+    Parameters:
+        hdf5_path (str, Path): path to the HDF5 file
+        dataset_name (str): name of the dataset group
+
+    Returns:
+        pd.DataFrame: x_pos (mm), y_pos (mm) and one column per result, suffixed by [dataset], None if the dataset has
+            no numerical results
+    """
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        dataset_group = hdf5_file[dataset_name]
+        make_results_dataframe = RESULTS_DATAFRAME_FUNCTIONS.get(dataset_group.attrs.get("HT_type"))
+        if make_results_dataframe is None:
+            return None
+        df = make_results_dataframe(dataset_group)
+
+    if df.empty or not set(EXPORT_INDEX).issubset(df.columns):
+        return None
+    if "ignored" in df.columns:
+        df = df[df["ignored"] == False]
+
+    value_columns = [column for column in df.select_dtypes(include="number").columns
+                     if column not in EXPORT_INDEX and column != "ignored"]
+    if not value_columns:
+        return None
+
+    df = df[EXPORT_INDEX + value_columns].reset_index(drop=True)
+    return df.rename(columns={column: f"{column}[{dataset_name}]" for column in value_columns})
+
+
+def correlation_read_results(hdf5_path, max_workers=CORRELATION_WORKERS):
+    """
+    Read the numerical results of all the datasets of an HDF5 file in parallel
+
+    Parameters:
+        hdf5_path (str, Path): path to the HDF5 file
+        max_workers (int): number of datasets read at the same time
+
+    Returns:
+        dict: {dataset name: output of correlation_read_dataset_results}, datasets without results are left out
+    """
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        dataset_names = [name for name, group in hdf5_file.items()
+                         if group.attrs.get("HT_type") in RESULTS_DATAFRAME_FUNCTIONS]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        df_list = executor.map(lambda name: correlation_read_dataset_results(hdf5_path, name), dataset_names)
+        return {name: df for name, df in zip(dataset_names, df_list) if df is not None}
+
+
+def correlation_spatial_join(df_dict, reference, tolerance=CORRELATION_TOLERANCE, how="inner"):
+    """
+    Align the results of several datasets on the positions of a reference dataset, every reference position is matched
+    with the nearest position of each other dataset if it is closer than the tolerance
+
+    Parameters:
+        df_dict (dict): {dataset name: output of correlation_read_dataset_results}
+        reference (str): name of the dataset giving the positions
+        tolerance (float): maximum distance between matched positions, in mm
+        how (str): 'inner' keeps the reference positions matched in every dataset, 'left' keeps all the reference
+            positions with NaN for unmatched datasets
+
+    Returns:
+        pd.DataFrame: reference positions, the results of all the datasets and one 'distance (mm)[dataset]' column per
+            matched dataset
+        dict: {dataset name: number of matched reference positions}
+    """
+    if how not in CORRELATION_JOIN_MODES:
+        raise ValueError(f"Unknown join mode {how}, expected one of {CORRELATION_JOIN_MODES}")
+
+    reference_df = df_dict[reference]
+    reference_positions = reference_df[EXPORT_INDEX].to_numpy(dtype=np.float64)
+
+    column_dict = {column: reference_df[column].to_numpy() for column in reference_df.columns}
+    match_counts = {reference: len(reference_df)}
+    matched_all = np.ones(len(reference_df), dtype=bool)
+    for dataset_name, df in df_dict.items():
+        if dataset_name == reference:
+            continue
+        tree = get_kdtree(df[EXPORT_INDEX].to_numpy(dtype=np.float64))
+        distances, indices = tree.query(reference_positions, k=1, distance_upper_bound=tolerance)
+        # Unmatched positions get an infinite distance and the out of range index len(df)
+        matched = np.isfinite(distances)
+        matched_all &= matched
+        match_counts[dataset_name] = int(matched.sum())
+
+        column_dict[f"distance (mm)[{dataset_name}]"] = np.where(matched, distances, np.nan)
+        for column in df.columns.drop(EXPORT_INDEX):
+            values = np.full(len(reference_df), np.nan)
+            values[matched] = df[column].to_numpy(dtype=np.float64)[indices[matched]]
+            column_dict[column] = values
+
+    joined_df = pd.DataFrame(column_dict)
+    if how == "inner":
+        joined_df = joined_df[matched_all].reset_index(drop=True)
+
+    return joined_df, match_counts
+
+
+def correlation_get_quantities(df):
+    """List the result columns of a joined dataframe, positions and match distances left out"""
+    return [column for column in df.columns if column not in EXPORT_INDEX and not column.startswith("distance (mm)")]
+
+
+def correlation_plot_scatter(df, x_column, y_column, color_column=None):
+    """
+    Plot two quantities of a joined dataframe against each other, WebGL rendered for large tables
+
+    Parameters:
+        df (pd.DataFrame): output of correlation_spatial_join
+        x_column (str): quantity on the x axis
+        y_column (str): quantity on the y axis
+        color_column (str, optional): quantity giving the marker colour
+
+    Returns:
+        go.Figure
+    """
+    fig = go.Figure(layout=plot_layout(title=""))
+    fig.update_xaxes(title_text=x_column)
+    fig.update_yaxes(title_text=y_column)
+
+    marker = dict(size=8)
+    if color_column is not None:
+        marker.update(color=df[color_column], colorscale="Plasma", showscale=True,
+                      colorbar=dict(title=color_column))
+
+    fig.add_trace(
+        go.Scattergl(
+            x=df[x_column],
+            y=df[y_column],
+            mode="markers",
+            marker=marker,
+            customdata=df[EXPORT_INDEX].to_numpy(),
+            hovertemplate="x: %{customdata[0]} mm<br>y: %{customdata[1]} mm<br>"
+                          f"{x_column}: %{{x}}<br>{y_column}: %{{y}}<extra></extra>",
+        )
+    )
+    return fig
+
+
+def correlation_plot_matrix(df, quantity_list):
+    """
+    Plot the Pearson correlation coefficients between quantities of a joined dataframe
+
+    Parameters:
+        df (pd.DataFrame): output of correlation_spatial_join
+        quantity_list (list): quantities to correlate
+
+    Returns:
+        go.Figure
+    """
+    correlation_df = df[quantity_list].corr()
+
+    fig = go.Figure(layout=plot_layout(title=""))
+    fig.add_trace(
+        go.Heatmap(
+            x=correlation_df.columns,
+            y=correlation_df.index,
+            z=correlation_df.to_numpy(),
+            colorscale="RdBu_r",
+            zmin=-1,
+            zmax=1,
+            colorbar=dict(title="r"),
+        )
+    )
+    fig.update_yaxes(autorange="reversed")
+    return fig
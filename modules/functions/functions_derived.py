@@ -0,0 +1,132 @@
+from ..functions.functions_shared import *
+from ..functions.functions_export import (RESULTS_DATAFRAME_FUNCTIONS, EXPORT_FORMATS, export_get_units_from_column,
+                                          export_write_results)
+
+'''Derived maps between two datasets of the same technique: difference, ratio and z-score of the difference'''
+
+# Operation: prefix of the colorbar title
+DERIVED_OPERATIONS = {"difference": "Δ", "ratio": "Ratio", "zscore": "z-score Δ"}
+# Positions are matched once rounded to this number of decimals (mm)
+DERIVED_POSITION_DECIMALS = 3
+
+
+def make_derived_dataframe(df, reference_df, operation="difference"):
+    """
+    Compute a derived map for every numerical result shared by two results dataframes, in one vectorized pass.
+    The rows are aligned by position, the output keeps the structure of df so it can be plotted like it.
+
+    Parameters:
+        df (pd.DataFrame): results dataframe of the dataset
+        reference_df (pd.DataFrame): results dataframe of the reference dataset, same technique
+        operation (str): 'difference' df - reference, 'ratio' df / reference or 'zscore' the difference standardized
+            over the wafer
+
+    Returns:
+        pd.DataFrame: copy of df with the shared results replaced by the derived values, NaN for positions missing
+            in the reference and for the results missing in the reference. Positions ignored in either dataset are
+            ignored
+    """
+    if operation not in DERIVED_OPERATIONS:
+        raise ValueError(f"Unknown operation {operation}, expected one of {list(DERIVED_OPERATIONS)}")
+
+    position_columns = ["x_pos (mm)", "y_pos (mm)"]
+    value_columns = [column for column in df.select_dtypes(include="number").columns
+                     if column not in position_columns and column != "ignored"]
+    shared_columns = [column for column in value_columns
+                      if column in reference_df.columns and pd.api.types.is_numeric_dtype(reference_df[column])]
+
+    # Row of the reference matching every row of df, -1 if the position is missing
+    reference_index = pd.MultiIndex.from_arrays(
+        [reference_df[column].round(DERIVED_POSITION_DECIMALS) for column in position_columns]
+    )
+    indexer = reference_index.get_indexer(
+        pd.MultiIndex.from_arrays([df[column].round(DERIVED_POSITION_DECIMALS) for column in position_columns])
+    )
+    matched = indexer >= 0
+
+    values = df[shared_columns].to_numpy(dtype=np.float64)
+    reference_values = np.full_like(values, np.nan)
+    reference_values[matched] = reference_df[shared_columns].to_numpy(dtype=np.float64)[indexer[matched]]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if operation == "ratio":
+            derived = np.where(reference_values != 0, values / reference_values, np.nan)
+        else:
+            derived = values - reference_values
+            if operation == "zscore":
+                derived = (derived - np.nanmean(derived, axis=0)) / np.nanstd(derived, axis=0)
+
+    derived_df = df.copy()
+    derived_df[shared_columns] = derived
+    derived_df[[column for column in value_columns if column not in shared_columns]] = np.nan
+    if "ignored" in derived_df.columns and "ignored" in reference_df.columns:
+        reference_ignored = np.zeros(len(df), dtype=bool)
+        reference_ignored[matched] = reference_df["ignored"].to_numpy(dtype=bool)[indexer[matched]]
+        derived_df["ignored"] = derived_df["ignored"].to_numpy(dtype=bool) | reference_ignored
+
+    return derived_df
+
+
+@shared_cached
+def get_derived_dataframe_from_hdf5(hdf5_group, reference_name, operation="difference"):
+    """
+    Derived map of a dataset against a reference dataset of the same file, see make_derived_dataframe
+
+    Parameters:
+        hdf5_group (h5py.Group): dataset group
+        reference_name (str): name of the reference dataset group
+        operation (str): 'difference', 'ratio' or 'zscore'
+
+    Returns:
+        pd.DataFrame: derived results dataframe
+    """
+    reference_group = hdf5_group.file[reference_name]
+    ht_type = hdf5_group.attrs.get("HT_type")
+    if reference_group.attrs.get("HT_type") != ht_type:
+        raise ValueError(f"{reference_name} is not a {ht_type} dataset")
+
+    make_results_dataframe = RESULTS_DATAFRAME_FUNCTIONS[ht_type]
+    return make_derived_dataframe(make_results_dataframe(hdf5_group), make_results_dataframe(reference_group),
+                                  operation)
+
+
+def derived_colorbar_title(colorbar_title, reference_name, operation):
+    """Prefix the colorbar title of a derived map with the operation, unchanged if there is no reference"""
+    if reference_name is None:
+        return colorbar_title
+    return f"{DERIVED_OPERATIONS[operation]} {colorbar_title}"
+
+
+def derived_export(hdf5_path, dataset_name, reference_name, operation="difference", file_format="csv"):
+    """
+    Export the derived map of a dataset against a reference dataset, next to the HDF5 file
+
+    Parameters:
+        hdf5_path (str, Path): path to the HDF5 file
+        dataset_name (str): name of the dataset group
+        reference_name (str): name of the reference dataset group
+        operation (str): 'difference', 'ratio' or 'zscore'
+        file_format (str): 'csv', 'parquet' or 'arrow'
+
+    Returns:
+        Path: output path
+    """
+    hdf5_path = Path(hdf5_path)
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        derived_df = get_derived_dataframe_from_hdf5(hdf5_file[dataset_name], reference_name, operation)
+        ht_type = hdf5_file[dataset_name].attrs.get("HT_type")
+
+    derived_df = derived_df.dropna(axis=1, how="all")
+    column_metadata = {
+        column: {"units": export_get_units_from_column(column)
+                 if operation == "difference" or column in ["x_pos (mm)", "y_pos (mm)"] else "",
+                 "dataset": dataset_name, "reference": reference_name, "operation": operation, "HT_type": ht_type}
+        for column in derived_df.columns
+    }
+    file_metadata = {"source_file": hdf5_path.name, "dataset": dataset_name, "reference": reference_name,
+                     "operation": operation}
+    output_path = hdf5_path.with_name(
+        f"{hdf5_path.stem}_{dataset_name}_{operation}_{reference_name}{EXPORT_FORMATS[file_format]}"
+    )
+
+    return export_write_results(derived_df, column_metadata, output_path, file_format, file_metadata)
@@ -0,0 +1,241 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ..functions.functions_shared import *
+from ..functions.functions_mask import flush_mask_edits
+from ..functions.functions_edx import edx_make_results_dataframe_from_hdf5
+from ..functions.functions_moke import moke_make_results_dataframe_from_hdf5
+from ..functions.functions_profil import profil_make_results_dataframe_from_hdf5
+from ..functions.functions_xrd import xrd_make_results_dataframe_from_hdf5
+
+'''Export of the results of HDF5 files to CSV, Parquet or Arrow IPC'''
+
+EXPORT_FORMATS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+EXPORT_INDEX = ["x_pos (mm)", "y_pos (mm)"]
+EXPORT_WORKERS = 4
+# Positions measured several times in a dataset are numbered, the n-th measurements of the datasets are aligned
+EXPORT_REPEAT = "measurement"
+
+RESULTS_DATAFRAME_FUNCTIONS = {
+    "edx": edx_make_results_dataframe_from_hdf5,
+    "moke": moke_make_results_dataframe_from_hdf5,
+    "profil": profil_make_results_dataframe_from_hdf5,
+    "xrd": xrd_make_results_dataframe_from_hdf5,
+    "esrf": xrd_make_results_dataframe_from_hdf5,
+}
+
+
+def export_get_units_from_column(column):
+    """
+    Extract the units written at the end of a results column name, 'x_pos (mm)' or '[roi box]_sum_(counts)'
+
+    Parameters:
+        column (str): column name
+
+    Returns:
+        str: units, empty string if the column has no units
+    """
+    match = re.search(r"[ _]\(([^()]*)\)$", column)
+    if match is None:
+        return ""
+    return match.group(1)
+
+
+def export_read_dataset_results(hdf5_path, dataset_name):
+    """
+    Read the results of one dataset, indexed by position and measurement number (EXPORT_REPEAT) and with the dataset
+    name appended to the columns
+
+    Parameters:
+        hdf5_path (str, Path): path to the HDF5 file
+        dataset_name (str): name of the dataset group
+
+    Returns:
+        pd.DataFrame: results, None if the dataset has no results or an unknown HT_type
+        dict: {column: {'units', 'dataset', 'HT_type'}}
+    """
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        dataset_group = hdf5_file[dataset_name]
+        ht_type = dataset_group.attrs.get("HT_type")
+        make_results_dataframe = RESULTS_DATAFRAME_FUNCTIONS.get(ht_type)
+        if make_results_dataframe is None:
+            return None, {}
+        df = make_results_dataframe(dataset_group)
+
+    if df.empty or not set(EXPORT_INDEX).issubset(df.columns):
+        return None, {}
+
+    df = df.drop("ignored", axis=1, errors="ignore")
+    df = df.set_index(EXPORT_INDEX)
+    df = df.set_index(df.groupby(level=EXPORT_INDEX).cumcount().rename(EXPORT_REPEAT), append=True)
+    # Text results are stored as bytes in the HDF5 file
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].map(lambda value: value.decode() if isinstance(value, bytes) else value)
+    df = df.add_suffix(f"[{dataset_name}]")
+
+    column_metadata = {
+        column: {"units": export_get_units_from_column(column[: -len(f"[{dataset_name}]")]),
+                 "dataset": dataset_name, "HT_type": ht_type}
+        for column in df.columns
+    }
+
+    return df, column_metadata
+
+
+def export_make_results_dataframe(hdf5_path, progress_callback=None):
+    """
+    Read the results of all the datasets of an HDF5 file one after the other and align them by position with a single
+    concat. The reads are not threaded, h5py serializes all the calls to the HDF5 library
+
+    Parameters:
+        hdf5_path (str, Path): path to the HDF5 file
+        progress_callback (function, optional): called with a progress message after each dataset
+
+    Returns:
+        pd.DataFrame: results of all the datasets, x_pos (mm) and y_pos (mm) as columns
+        dict: {column: {'units', 'dataset', 'HT_type'}}
+        list: names of the skipped datasets (no results or unknown HT_type)
+    """
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        dataset_names = [name for name in hdf5_file.keys() if name != "sample"]
+
+    df_list = []
+    column_metadata = {}
+    skipped_list = []
+    for index, name in enumerate(dataset_names):
+        df, metadata = export_read_dataset_results(hdf5_path, name)
+        if df is None:
+            skipped_list.append(name)
+        else:
+            df_list.append(df)
+            column_metadata.update(metadata)
+        if progress_callback is not None:
+            progress_callback(f"Read {name} ({index + 1}/{len(dataset_names)})")
+
+    if not df_list:
+        return pd.DataFrame(columns=EXPORT_INDEX), {}, skipped_list
+
+    general_df = pd.concat(df_list, axis=1, join="outer").sort_index()
+    # The measurement number is only exported if a position was measured several times
+    if (general_df.index.get_level_values(EXPORT_REPEAT) == 0).all():
+        general_df = general_df.droplevel(EXPORT_REPEAT)
+
+    return general_df.reset_index(), column_metadata, skipped_list
+
+
+def export_write_results(df, column_metadata, output_path, file_format="csv", file_metadata=None):
+    """
+    Write the results dataframe, Parquet and Arrow IPC keep the column types and store the units in the field metadata
+
+    Parameters:
+        df (pd.DataFrame): output of export_make_results_dataframe
+        column_metadata (dict): {column: {'units', 'dataset', 'HT_type'}}
+        output_path (str, Path): path of the output file
+        file_format (str): 'csv', 'parquet' or 'arrow'
+        file_metadata (dict, optional): metadata of the whole table (sample name, source file...)
+
+    Returns:
+        Path: output path
+    """
+    output_path = Path(output_path)
+    if file_format == "csv":
+        df.to_csv(output_path, index=False)
+        return output_path
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    fields = []
+    for field in table.schema:
+        metadata = column_metadata.get(field.name, {"units": export_get_units_from_column(field.name)})
+        fields.append(field.with_metadata({key: str(value) for key, value in metadata.items()}))
+    schema = pa.schema(fields, metadata={key: str(value) for key, value in (file_metadata or {}).items()})
+    table = table.cast(schema)
+
+    if file_format == "parquet":
+        pq.write_table(table, output_path)
+    elif file_format == "arrow":
+        with pa.ipc.new_file(output_path, schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f"Unknown export format {file_format}, expected one of {list(EXPORT_FORMATS)}")
+
+    return output_path
+
+
+def export_hdf5_results(hdf5_path, file_format="csv", output_path=None, progress_callback=None, sample_column=False):
+    """
+    Export the results of all the datasets of an HDF5 file to a single table
+
+    Parameters:
+        hdf5_path (str, Path): path to the HDF5 file
+        file_format (str): 'csv', 'parquet' or 'arrow'
+        output_path (str, Path, optional): path of the output file, next to the HDF5 file by default
+        progress_callback (function, optional): called with a progress message after each dataset
+        sample_column (bool): add the sample name as first column, to tell the samples apart once tables are combined
+
+    Returns:
+        Path: output path
+        list: names of the skipped datasets
+    """
+    hdf5_path = Path(hdf5_path)
+    if output_path is None:
+        output_path = hdf5_path.with_suffix(EXPORT_FORMATS[file_format])
+
+    # Buffered heatmap edit mode toggles must be in the file to be left out of the export
+    flush_mask_edits(hdf5_path)
+    df, column_metadata, skipped_list = export_make_results_dataframe(hdf5_path, progress_callback)
+    try:
+        sample_name = get_sample_info_from_hdf5(hdf5_path)["sample_name"]
+    except KeyError:
+        sample_name = hdf5_path.stem
+    if isinstance(sample_name, bytes):
+        sample_name = sample_name.decode()
+    file_metadata = {"source_file": hdf5_path.name, "sample_name": sample_name}
+    if sample_column:
+        df.insert(0, "sample", sample_name)
+
+    return export_write_results(df, column_metadata, output_path, file_format, file_metadata), skipped_list
+
+
+def export_folder_results(folderpath, file_format="parquet", output_folder=None, progress_callback=None,
+                          max_workers=EXPORT_WORKERS):
+    """
+    Export the results of every HDF5 file of a folder, one output file per sample. Files are exported in parallel
+    processes, each taking the read lock of its file, and every sample is written by its process so that only
+    max_workers samples are held in memory. A folder of Parquet files is read back as a single table with
+    pyarrow.dataset
+
+    Parameters:
+        folderpath (str, Path): folder containing the HDF5 files
+        file_format (str): 'csv', 'parquet' or 'arrow'
+        output_folder (str, Path, optional): output folder, folderpath/export by default
+        progress_callback (function, optional): called with a progress message after each file
+        max_workers (int): number of files exported at the same time
+
+    Returns:
+        list: output paths
+    """
+    folderpath = Path(folderpath)
+    output_folder = folderpath / "export" if output_folder is None else Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    hdf5_path_list = [path for path in safe_glob(folderpath) if h5py.is_hdf5(path)]
+
+    output_list = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        future_dict = {
+            executor.submit(
+                export_hdf5_results, hdf5_path, file_format,
+                output_folder / f"{hdf5_path.stem}{EXPORT_FORMATS[file_format]}", sample_column=True,
+            ): hdf5_path
+            for hdf5_path in hdf5_path_list
+        }
+        for future in as_completed(future_dict):
+            output_path, skipped_list = future.result()
+            output_list.append(output_path)
+            if progress_callback is not None:
+                progress_callback(
+                    f"Exported {future_dict[future].name} ({len(output_list)}/{len(hdf5_path_list)})"
+                )
+
+    return sorted(output_list)
@@ -0,0 +1,266 @@
+from scipy.interpolate import RBFInterpolator
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+from scipy.optimize import minimize
+
+from ..functions.functions_shared import *
+
+
+'''Heatmaps of the results on the wafer, on the measured grid or interpolated on a dense grid'''
+
+
+# Interpolated heatmaps: a smooth surface is fitted on the measured values and evaluated on a dense grid. Fits and
+# evaluated grids are kept in the shared cache, keyed by dataset revision and by the measured positions and values, so
+# a new revision or result column is refit while colour range and contour changes are not
+HEATMAP_INTERPOLATIONS = ["rbf", "kriging"]
+HEATMAP_RESOLUTION = 1.0
+# Above this number of points, RBF interpolation only uses the nearest neighbours of every evaluated point
+RBF_NEIGHBOURS_THRESHOLD = 1000
+RBF_NEIGHBOURS = 64
+# Number of grid points evaluated at once by the kriging predictor, bounding the memory used
+KRIGING_CHUNK_SIZE = 4096
+# Kriging builds and factorizes an n x n covariance matrix, above this number of points it is fitted on an evenly
+# spread subset of the measured points
+KRIGING_MAX_POINTS = 1000
+
+
+def _kriging_negative_log_likelihood(log_parameters, distances_squared, values):
+    length_scale, noise = np.exp(log_parameters)
+    covariance = np.exp(-distances_squared / (2 * length_scale**2)) + noise * np.eye(len(values))
+    try:
+        factor = cho_factor(covariance, lower=True)
+    except np.linalg.LinAlgError:
+        return np.inf
+    alpha = cho_solve(factor, values)
+    return 0.5 * values @ alpha + np.sum(np.log(np.diag(factor[0])))
+
+
+def _fit_kriging(positions, values):
+    if len(values) > KRIGING_MAX_POINTS:
+        subset = np.round(np.linspace(0, len(values) - 1, KRIGING_MAX_POINTS)).astype(int)
+        positions, values = positions[subset], values[subset]
+
+    # Values are standardized, the length scale (mm) and the noise variance are fitted by maximum likelihood
+    mean, scale = values.mean(), values.std() or 1.0
+    standardized = (values - mean) / scale
+    distances_squared = np.sum((positions[:, None, :] - positions[None, :, :]) ** 2, axis=-1)
+
+    result = minimize(
+        _kriging_negative_log_likelihood,
+        x0=np.log([10.0, 0.01]),
+        args=(distances_squared, standardized),
+        method="L-BFGS-B",
+        bounds=[(np.log(1.0), np.log(100.0)), (np.log(1e-6), np.log(1.0))],
+    )
+    length_scale, noise = np.exp(result.x)
+    covariance = np.exp(-distances_squared / (2 * length_scale**2)) + noise * np.eye(len(values))
+    lower = np.linalg.cholesky(covariance)
+    alpha = cho_solve((lower, True), standardized)
+
+    return {"positions": positions, "lower": lower, "alpha": alpha, "length_scale": length_scale,
+            "mean": mean, "scale": scale}
+
+
+def _predict_kriging(model, points):
+    mean_list = []
+    std_list = []
+    for start in range(0, len(points), KRIGING_CHUNK_SIZE):
+        chunk = points[start: start + KRIGING_CHUNK_SIZE]
+        distances_squared = np.sum((chunk[:, None, :] - model["positions"][None, :, :]) ** 2, axis=-1)
+        cross_covariance = np.exp(-distances_squared / (2 * model["length_scale"]**2))
+        mean_list.append(cross_covariance @ model["alpha"])
+        v = solve_triangular(model["lower"], cross_covariance.T, lower=True)
+        std_list.append(np.sqrt(np.clip(1 - np.sum(v**2, axis=0), 0, None)))
+
+    mean = np.concatenate(mean_list) * model["scale"] + model["mean"]
+    std = np.concatenate(std_list) * model["scale"]
+    return mean, std
+
+
+@shared_cached
+def _fit_wafer_surface(hdf5_group, x_array, y_array, value_array, method):
+    # The dataset group of the values only keys the cache
+    positions = np.column_stack([x_array, y_array])
+    values = value_array
+    if method == "rbf":
+        neighbours = RBF_NEIGHBOURS if len(values) > RBF_NEIGHBOURS_THRESHOLD else None
+        return RBFInterpolator(positions, values, kernel="thin_plate_spline", neighbors=neighbours)
+    if method == "kriging":
+        return _fit_kriging(positions, values)
+    raise ValueError(f"Unknown interpolation {method}, expected one of {HEATMAP_INTERPOLATIONS}")
+
+
+@shared_cached
+def _make_dense_map(hdf5_group, x_array, y_array, value_array, method, resolution):
+    positions = np.column_stack([x_array, y_array])
+    surface = _fit_wafer_surface(hdf5_group, x_array, y_array, value_array, method)
+
+    x_dense = np.arange(positions[:, 0].min(), positions[:, 0].max() + resolution / 2, resolution)
+    y_dense = np.arange(positions[:, 1].min(), positions[:, 1].max() + resolution / 2, resolution)
+    grid_x, grid_y = np.meshgrid(x_dense, y_dense)
+    points = np.column_stack([grid_x.ravel(), grid_y.ravel()])
+
+    if method == "rbf":
+        mean, std = surface(points), np.full(len(points), np.nan)
+    else:
+        mean, std = _predict_kriging(surface, points)
+
+    # Points farther than one measurement step from the measured positions are not extrapolated
+    distances, _ = get_kdtree(positions).query(points, k=1)
+    outside = distances > WaferGrid(positions[:, 0], positions[:, 1]).step_x
+    mean[outside] = np.nan
+    std[outside] = np.nan
+
+    return x_dense, y_dense, mean.reshape(grid_x.shape), std.reshape(grid_x.shape)
+
+
+def can_interpolate_wafer_map(x_array, y_array, value_array):
+    """
+    Check that the measured positions with a value span a plane: surfaces cannot be fitted on fewer than four points
+    or on points along a single line
+
+    Parameters:
+        x_array (array like): x position of every point
+        y_array (array like): y position of every point
+        value_array (array like): measured value of every point
+
+    Returns:
+        bool
+    """
+    valid = np.isfinite(np.asarray(value_array, dtype=np.float64))
+    if valid.sum() <= 3:
+        return False
+    positions = np.column_stack([np.asarray(x_array, dtype=np.float64)[valid],
+                                 np.asarray(y_array, dtype=np.float64)[valid]])
+    return np.linalg.matrix_rank(positions - positions.mean(axis=0)) == 2
+
+
+def interpolate_wafer_map(hdf5_group, x_array, y_array, value_array, method="rbf", resolution=HEATMAP_RESOLUTION):
+    """
+    Fit a smooth surface on the measured values of a wafer and evaluate it on a dense grid. Positions with NaN values
+    are left out of the fit. Fits and evaluated grids are kept in the shared cache. Raises np.linalg.LinAlgError when
+    the surface cannot be fitted, see can_interpolate_wafer_map.
+
+    Parameters:
+        hdf5_group (h5py.Group): dataset group the values are read from, keys the cache with its file and revision
+        x_array (array like): x position of every point
+        y_array (array like): y position of every point
+        value_array (array like): measured value of every point
+        method (str): 'rbf' for a thin plate spline, 'kriging' for a Gaussian process also giving the uncertainty
+        resolution (float): step of the dense grid, in mm
+
+    Returns:
+        np.array: x values of the dense grid
+        np.array: y values of the dense grid
+        np.array: (len(y), len(x)) interpolated values, NaN away from the measured positions
+        np.array: (len(y), len(x)) standard deviation of the interpolated values, NaN for RBF interpolation
+    """
+    x_array = np.asarray(x_array, dtype=np.float64)
+    y_array = np.asarray(y_array, dtype=np.float64)
+    value_array = np.asarray(value_array, dtype=np.float64)
+    valid = np.isfinite(value_array)
+
+    return _make_dense_map(hdf5_group, x_array[valid], y_array[valid], value_array[valid], method, float(resolution))
+
+
+def make_heatmap_from_dataframe(
+    df,
+    values=None,
+    z_min=None,
+    z_max=None,
+    precision=2,
+    plot_title="",
+    colorbar_title="",
+    masking=False,
+    interpolation=None,
+    resolution=HEATMAP_RESOLUTION,
+    map_options=None,
+    mask_layers=None,
+    hdf5_group=None,
+):
+    wafer_map = WaferMap.from_dataframe(df)
+    grid = wafer_map.grid
+    x_array, y_array = grid.x, grid.y
+
+    if values is None:
+        heatmap_array = grid.to_plane(x_array + y_array)
+        plot_title = "No heatmap selected, default values"
+    else:
+        heatmap_array = wafer_map.plane(values)
+
+    # If mask is set, hide points that have an ignore tag in the database, or that are masked in any of the mask layers
+    if masking:
+        ignored = wafer_map.ignored if mask_layers is None else mask_layers.on_grid(grid)
+        heatmap_array = np.where(ignored, np.nan, heatmap_array)
+    value_array = grid.from_plane(heatmap_array)
+    x_values, y_values = grid.x_values, grid.y_values
+
+    map_options = map_options or []
+    # Interpolated maps are cached on the dataset group of df, the file must still be open
+    if (interpolation in HEATMAP_INTERPOLATIONS and hdf5_group is not None
+            and can_interpolate_wafer_map(x_array, y_array, value_array)):
+        try:
+            x_values, y_values, heatmap_array, std_array = interpolate_wafer_map(
+                hdf5_group, x_array, y_array, value_array, interpolation, resolution
+            )
+        except np.linalg.LinAlgError:
+            # Singular systems, e.g. repeated positions, the measured grid is shown instead
+            interpolation = None
+        else:
+            if "uncertainty" in map_options and interpolation == "kriging":
+                heatmap_array = std_array
+                colorbar_title = f"σ {colorbar_title}"
+    else:
+        interpolation = None
+
+    if z_min is None:
+        z_min = np.nanmin(heatmap_array)
+    if z_max is None:
+        z_max = np.nanmax(heatmap_array)
+
+    heatmap = go.Heatmap(
+        x=x_values,
+        y=y_values,
+        z=heatmap_array,
+        colorscale="Plasma",
+        # Set ticks for the colorbar
+        colorbar=colorbar_layout(z_min, z_max, precision, title=colorbar_title),
+    )
+
+    # Make and show figure
+    fig = go.Figure(data=[heatmap], layout=heatmap_layout(title=plot_title))
+
+    if interpolation is not None:
+        # Clicks must give measured positions: the dense heatmap is not clickable, the measured points are
+        fig.data[0].update(hoverinfo="skip")
+        measured = np.isfinite(value_array)
+        fig.add_trace(
+            go.Scatter(
+                x=x_array[measured],
+                y=y_array[measured],
+                mode="markers",
+                marker=dict(size=5, color="black", opacity=0.4),
+                customdata=value_array[measured],
+                hovertemplate="x: %{x} mm<br>y: %{y} mm<br>measured: %{customdata}<extra></extra>",
+                showlegend=False,
+            )
+        )
+
+    if "contours" in map_options:
+        fig.add_trace(
+            go.Contour(
+                x=x_values,
+                y=y_values,
+                z=heatmap_array,
+                contours=dict(coloring="none", showlabels=True),
+                line=dict(color="white", width=1),
+                showscale=False,
+                hoverinfo="skip",
+            )
+        )
+
+    if z_min is not None:
+        fig.data[0].update(zmin=z_min)
+    if z_max is not None:
+        fig.data[0].update(zmax=z_max)
+
+    return fig
@@ -0,0 +1,310 @@
+from ..functions.functions_shared import *
+
+
+'''Mask layers of the datasets and buffer of the heatmap edit mode toggles'''
+
+
+# Mask layers: every dataset stores one boolean array per layer, bit packed in an attribute of the dataset group and
+# indexed like get_dataset_positions. Edit mode toggles are buffered (on disk when configured, so that all the server
+# workers see them) and written in batches, the per position 'ignored' attributes read by the results dataframes are
+# updated at the same time
+MASK_LAYERS = ["user_ignored", "outside_wafer", "auto_outlier", "failed_fit"]
+# Layers copied to the 'ignored' attribute of the positions
+MASK_IGNORED_LAYERS = ["user_ignored", "auto_outlier", "failed_fit"]
+MASK_FLUSH_SIZE = 32
+MASK_FLUSH_DELAY = 30
+_mask_edits = {"cache": None}
+_mask_edits_local = {}
+_mask_edits_guard = threading.Lock()
+
+
+def configure_mask_edits(cache_folder):
+    """
+    Open the mask edit buffer in cache_folder, edits are buffered in the process until this is called. Pending edits
+    are never evicted, unlike the entries of the shared cache
+
+    Parameters:
+        cache_folder (str, Path): folder where the buffer is stored
+
+    Returns:
+        diskcache.Cache: the buffer cache
+    """
+    cache = diskcache.Cache(str(cache_folder), eviction_policy="none")
+    _mask_edits["cache"] = cache
+    return cache
+
+
+class MaskLayers:
+    """
+    Mask layers of a dataset, one boolean array per layer indexed like the WaferGrid of the dataset positions
+    """
+
+    __slots__ = ("grid", "layers")
+
+    def __init__(self, positions, layers):
+        self.grid = WaferGrid(positions[:, 0], positions[:, 1])
+        self.layers = layers
+
+    def combined(self, layers=None):
+        """
+        Combine layers with a logical or
+
+        Parameters:
+            layers (list, optional): names of the layers, all the layers by default
+
+        Returns:
+            np.array: True for the masked points
+        """
+        layers = MASK_LAYERS if layers is None else layers
+        return np.logical_or.reduce([self.layers[layer] for layer in layers] + [np.zeros(len(self.grid), dtype=bool)])
+
+    def index(self, target_x, target_y):
+        """Index of a position in the layers, None if the position is not in the dataset"""
+        match = np.flatnonzero((self.grid.x == target_x) & (self.grid.y == target_y))
+        return int(match[0]) if len(match) else None
+
+    def on_grid(self, grid, layers=None):
+        """
+        Combined mask on the plane of another grid of the same positions, e.g. the grid of a results dataframe
+
+        Parameters:
+            grid (WaferGrid): target grid
+            layers (list, optional): names of the layers, all the layers by default
+
+        Returns:
+            np.array: (rows, cols) boolean plane
+        """
+        mask = self.combined(layers)
+        cols = np.clip(np.searchsorted(grid.x_values, self.grid.x), 0, len(grid.x_values) - 1)
+        rows = np.clip(np.searchsorted(grid.y_values, self.grid.y), 0, len(grid.y_values) - 1)
+        found = (grid.x_values[cols] == self.grid.x) & (grid.y_values[rows] == self.grid.y)
+
+        plane = np.zeros(grid.shape, dtype=bool)
+        plane[rows[found], cols[found]] = mask[found]
+        return plane
+
+
+@shared_cached
+def read_stored_mask_layers(hdf5_group):
+    """
+    Read the mask layers written in a dataset group. Files written before the mask layers get the user_ignored layer
+    from the 'ignored' attribute of every position and the outside_wafer layer from the positions
+
+    Parameters:
+        hdf5_group (h5py.Group): dataset group
+
+    Returns:
+        dict: {layer: boolean array indexed like get_dataset_positions}
+    """
+    positions = get_dataset_positions(hdf5_group)
+    nb_points = len(positions)
+
+    layers = {}
+    if hdf5_group.attrs.get("mask_length") == nb_points:
+        for layer in MASK_LAYERS:
+            if f"mask_{layer}" in hdf5_group.attrs:
+                packed = np.asarray(hdf5_group.attrs[f"mask_{layer}"], dtype=np.uint8)
+                layers[layer] = np.unpackbits(packed, count=nb_points).astype(bool)
+
+    if "user_ignored" not in layers:
+        layers["user_ignored"] = np.array(
+            [bool(position_group.attrs.get("ignored", False))
+             for position, position_group in get_position_groups(hdf5_group)],
+            dtype=bool,
+        )
+    if "outside_wafer" not in layers:
+        layers["outside_wafer"] = ~is_on_wafer(positions[:, 0], positions[:, 1])
+    for layer in MASK_LAYERS:
+        layers.setdefault(layer, np.zeros(nb_points, dtype=bool))
+
+    return layers
+
+
+def _mask_edits_key(hdf5_path, dataset_name):
+    return "mask_edits", os.path.abspath(hdf5_path), dataset_name
+
+
+@contextlib.contextmanager
+def _mask_edits_transaction():
+    # Yields (read, write, remove) functions on the edit buffer, the disk buffer if configured
+    cache = _mask_edits["cache"]
+    if cache is None:
+        with _mask_edits_guard:
+            yield _mask_edits_local.get, _mask_edits_local.__setitem__, lambda key: _mask_edits_local.pop(key, None)
+    else:
+        with cache.transact(retry=True):
+            yield (lambda key, default=None: cache.get(key, default=default, retry=True),
+                   lambda key, value: cache.set(key, value, retry=True),
+                   lambda key: cache.delete(key, retry=True))
+
+
+def get_pending_mask_edits(hdf5_path, dataset_name):
+    """
+    Edits of the mask layers of a dataset not written to the file yet
+
+    Parameters:
+        hdf5_path (str, Path): path to the HDF5 file
+        dataset_name (str): name of the dataset group
+
+    Returns:
+        dict: {(layer, x, y): value}
+    """
+    with _mask_edits_transaction() as (read, write, remove):
+        return dict(read(_mask_edits_key(hdf5_path, dataset_name), {"edits": {}})["edits"])
+
+
+def get_mask_layers(hdf5_group):
+    """
+    Mask layers of a dataset, pending edits included
+
+    Parameters:
+        hdf5_group (h5py.Group): dataset group
+
+    Returns:
+        MaskLayers
+    """
+    positions = get_dataset_positions(hdf5_group)
+    layers = {layer: mask.copy() for layer, mask in read_stored_mask_layers(hdf5_group).items()}
+    mask_layers = MaskLayers(positions, layers)
+
+    for (layer, x, y), value in get_pending_mask_edits(hdf5_group.file.filename, hdf5_group.name.strip("/")).items():
+        index = mask_layers.index(x, y)
+        if index is not None:
+            mask_layers.layers[layer][index] = value
+
+    return mask_layers
+
+
+def write_mask_layers(hdf5_group, layers):
+    """
+    Write the mask layers of a dataset and copy the MASK_IGNORED_LAYERS to the 'ignored' attribute of every position.
+    The file must be open in a write mode
+
+    Parameters:
+        hdf5_group (h5py.Group): dataset group
+        layers (dict): {layer: boolean array indexed like get_dataset_positions}, missing layers are kept
+    """
+    stored_layers = read_stored_mask_layers(hdf5_group)
+    stored_layers.update(layers)
+    nb_points = len(stored_layers["user_ignored"])
+
+    hdf5_group.attrs["mask_length"] = nb_points
+    for layer in MASK_LAYERS:
+        hdf5_group.attrs[f"mask_{layer}"] = np.packbits(np.asarray(stored_layers[layer], dtype=bool))
+
+    if any(layer in layers for layer in MASK_IGNORED_LAYERS):
+        ignored_list = np.logical_or.reduce([stored_layers[layer] for layer in MASK_IGNORED_LAYERS])
+        for (position, position_group), ignored in zip(get_position_groups(hdf5_group), ignored_list):
+            if bool(position_group.attrs.get("ignored", False)) != bool(ignored):
+                position_group.attrs["ignored"] = bool(ignored)
+
+
+def flush_mask_edits(hdf5_path=None, max_age=None):
+    """
+    Write the buffered mask edits, one file opening per file
+
+    Parameters:
+        hdf5_path (str, Path, optional): only flush the edits of this file
+        max_age (float, optional): only flush the datasets whose oldest edit is older than this, in seconds
+
+    Returns:
+        int: number of edits written
+    """
+    now = time.time()
+    with _mask_edits_transaction() as (read, write, remove):
+        index = read("mask_edits_index", set())
+        flushed = {}
+        for key in list(index):
+            if hdf5_path is not None and key[1] != os.path.abspath(hdf5_path):
+                continue
+            entry = read(key)
+            if entry is None:
+                index.discard(key)
+                continue
+            if max_age is not None and now - entry["since"] < max_age:
+                continue
+            flushed[key] = entry["edits"]
+            remove(key)
+            index.discard(key)
+        write("mask_edits_index", index)
+
+    nb_edits = 0
+    for file_path in {key[1] for key in flushed}:
+        with open_hdf5(file_path, "a") as hdf5_file:
+            for (_, path, dataset_name), edits in flushed.items():
+                if path != file_path:
+                    continue
+                dataset_group = hdf5_file[dataset_name]
+                mask_layers = MaskLayers(get_dataset_positions(dataset_group),
+                                         {layer: mask.copy() for layer, mask in
+                                          read_stored_mask_layers(dataset_group).items()})
+                for (layer, x, y), value in edits.items():
+                    point_index = mask_layers.index(x, y)
+                    if point_index is not None:
+                        mask_layers.layers[layer][point_index] = value
+                write_mask_layers(dataset_group, mask_layers.layers)
+                nb_edits += len(edits)
+
+    return nb_edits
+
+
+def toggle_mask_point(hdf5_path, dataset_name, target_x, target_y, layer="user_ignored"):
+    """
+    Toggle one point of a mask layer. The edit is buffered, the buffer of the file is written once it holds
+    MASK_FLUSH_SIZE edits or its oldest edit is older than MASK_FLUSH_DELAY
+
+    Parameters:
+        hdf5_path (str, Path): path to the HDF5 file
+        dataset_name (str): name of the dataset group
+        target_x (float): x position
+        target_y (float): y position
+        layer (str): name of the layer
+
+    Returns:
+        dict: {layer: value of the point} for all the layers after the toggle, None if the position is not in
+            the dataset
+        int: number of edits of the file still buffered
+    """
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        mask_layers = get_mask_layers(hdf5_file[dataset_name])
+    point_index = mask_layers.index(target_x, target_y)
+    if point_index is None:
+        return None, 0
+    value = not mask_layers.layers[layer][point_index]
+
+    key = _mask_edits_key(hdf5_path, dataset_name)
+    with _mask_edits_transaction() as (read, write, remove):
+        entry = read(key, {"edits": {}, "since": time.time()})
+        entry["edits"][(layer, float(target_x), float(target_y))] = bool(value)
+        write(key, entry)
+        index = read("mask_edits_index", set())
+        index.add(key)
+        write("mask_edits_index", index)
+        nb_pending = len(entry["edits"])
+
+    if nb_pending >= MASK_FLUSH_SIZE or time.time() - entry["since"] >= MASK_FLUSH_DELAY:
+        flush_mask_edits(hdf5_path)
+        nb_pending = 0
+
+    point_layers = {name: bool(mask[point_index]) for name, mask in mask_layers.layers.items()}
+    point_layers[layer] = bool(value)
+    return point_layers, nb_pending
+
+
+def format_mask_point(target_x, target_y, point_layers, nb_pending):
+    """
+    Format the state of a toggled point for the text box of a tab
+
+    Parameters:
+        target_x (float): x position
+        target_y (float): y position
+        point_layers (dict): {layer: value of the point}, see toggle_mask_point
+        nb_pending (int): number of edits of the file still buffered
+
+    Returns:
+        str
+    """
+    masked = any(point_layers[layer] for layer in MASK_IGNORED_LAYERS)
+    layers_state = ", ".join(f"{layer} {'on' if value else 'off'}" for layer, value in point_layers.items())
+    return (f"{target_x}, {target_y} {'ignored' if masked else 'not ignored'}: {layers_state} "
+            f"({nb_pending} edits not written yet)")
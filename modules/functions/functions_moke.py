@@ -10,13 +10,14 @@ def moke_conditions(hdf5_path, *args, **kwargs):
         return False
     if not h5py.is_hdf5(hdf5_path):
         return False
-    with h5py.File(hdf5_path, "r") as hdf5_file:
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
         dataset_list = get_hdf5_datasets(hdf5_file, dataset_type="moke")
         if len(dataset_list) == 0:
             return False
     return True
 
 
+@shared_cached
 def moke_get_measurement_from_hdf5(moke_group, target_x, target_y, index=1):
     position_group = get_target_position_group(moke_group, target_x, target_y)
     measurement_group = position_group.get("measurement")
@@ -54,6 +55,24 @@ def moke_get_measurement_from_hdf5(moke_group, target_x, target_y, index=1):
         return measurement_dataframe
 
 
+@shared_cached
+def moke_get_treated_measurement_from_hdf5(moke_group, target_x, target_y, treatment_dict):
+    """
+    Read the measurement at a position and apply the data treatment, the output is cached and prefetched after clicks
+
+    Parameters:
+        moke_group (h5py.Group): moke dataset group
+        target_x (float): x position
+        target_y (float): y position
+        treatment_dict (dict): data treatment options, see moke_treat_measurement_dataframe
+
+    Returns:
+        pd.DataFrame: treated measurement
+    """
+    measurement_df = moke_get_measurement_from_hdf5(moke_group, target_x, target_y)
+    return moke_treat_measurement_dataframe(measurement_df, treatment_dict)
+
+
 def moke_get_results_from_hdf5(moke_group, target_x, target_y):
     position_group = get_target_position_group(moke_group, target_x, target_y)
     results_group = position_group.get("results")
@@ -98,58 +117,52 @@ def moke_treat_measurement_dataframe(measurement_df, options_dict):
             "check compatibility between callbacks_moke.store_data_treatment and functions_moke.treat_data"
         )
 
-    # Set field using coil parameters
+    # Set field using coil parameters, column operations are vectorized as the treatment is applied to every loop
+    # of the wafer when building maps
     midpoint = len(measurement_df) // 2
     max_field = pulse_voltage * coil_factor / 100
 
-    measurement_df.loc[:midpoint, "field"] = measurement_df.loc[:midpoint, "integrated_pulse"].apply(
-        lambda x: -x * max_field / np.abs(measurement_df["integrated_pulse"].min())
-    )
-    measurement_df.loc[midpoint:, "field"] = measurement_df.loc[midpoint:, "integrated_pulse"].apply(
-        lambda x: -x * max_field / np.abs(measurement_df["integrated_pulse"].max())
+    integrated_pulse = measurement_df["integrated_pulse"].to_numpy()
+    labels = measurement_df.index.to_numpy()
+    measurement_df["field"] = np.where(
+        labels < midpoint,
+        -integrated_pulse * max_field / np.abs(np.nanmin(integrated_pulse)),
+        -integrated_pulse * max_field / np.abs(np.nanmax(integrated_pulse)),
     )
 
     # Vertically center the loop
     if correct_offset:
-        magnetization_offset = measurement_df["magnetization"].mean()
-        measurement_df.loc[:, "magnetization"] = measurement_df.loc[:, "magnetization"].apply(
-            lambda x: x - magnetization_offset
-        )
+        measurement_df["magnetization"] = measurement_df["magnetization"] - measurement_df["magnetization"].mean()
 
     # Remove oddities around H=0 by forcing points in the positive(negative) loop to be over(under) a threshold
     if filter_zero:
         length = len(measurement_df)
-        measurement_df = measurement_df[measurement_df["field"].notna()]
+        measurement_df = measurement_df[measurement_df["field"].notna()].copy()
 
-        measurement_df.loc[: length // 2, "field"] = measurement_df.loc[: length // 2, "field"].where(
-            measurement_df["field"] > 1e-2
-        )
-        measurement_df.loc[length // 2 :, "field"] = measurement_df.loc[length // 2 :, "field"].where(
-            measurement_df["field"] < -1e-2
-        )
+        # Both halves include the point at length // 2, the second threshold is applied after the first
+        field = measurement_df["field"].to_numpy()
+        labels = measurement_df.index.to_numpy()
+        field = np.where((labels <= length // 2) & ~(field > 1e-2), np.nan, field)
+        field = np.where((labels >= length // 2) & ~(field < -1e-2), np.nan, field)
+        measurement_df["field"] = field
 
     if connect_loops:
         # Step 1: Remove NaNs (if filtering left them)
         measurement_df = measurement_df[measurement_df["field"].notna()]
 
         # Step 2: Split into two halves (assuming they're in time order)
-        midpoint = len(measurement_df) // 2
-        first_pulse = measurement_df.iloc[:midpoint]  # 0 → -X → 0
-        second_pulse = measurement_df.iloc[midpoint:]  # 0 → +X → 0
-
         # Step 3: Rearrange: +X → 0 → -X → 0 → +X (start from end of second pulse)
-        reordered = pd.concat([second_pulse, first_pulse], ignore_index=True)
-
-        # Step 4 (optional): Loop continuity — duplicate first few points at end
-        wrap_points = 1  # number of points to "wrap"
-        if len(reordered) >= wrap_points:
-            reordered = pd.concat([reordered, reordered.iloc[:wrap_points]], ignore_index=True)
+        # Step 4: Loop continuity, duplicate the first point at the end
+        midpoint = len(measurement_df) // 2
+        order = np.r_[midpoint:len(measurement_df), 0:midpoint]
+        if len(order) > 0:
+            order = np.append(order, midpoint)
 
-        measurement_df = reordered
+        measurement_df = measurement_df.iloc[order].reset_index(drop=True)
 
     # Smoothing
     if smoothing:
-        measurement_df.loc[:, "magnetization"] = savgol_filter(
+        measurement_df["magnetization"] = savgol_filter(
             measurement_df["magnetization"], smoothing_range, smoothing_polyorder
         )
 
@@ -338,10 +351,49 @@ def moke_fit_intercept(data: pd.DataFrame, treatment_dict: dict):
 
     return float(positive_intercept_field), float(negative_intercept_field), fit_dict
 
-def moke_batch_fit(moke_group, treatment_dict):
+# Version of the MOKE treatment and fits, part of the fit keys: bump it when the results of the same inputs change
+MOKE_FIT_VERSION = "1"
+MOKE_FIT_ARRAYS = ["magnetization_mean", "pulse_mean", "reflectivity_mean", "integrated_pulse_mean"]
+
+
+def moke_make_fit_keys(moke_group, treatment_dict):
+    """
+    Fit key of every position of a MOKE dataset, see make_fit_key
+
+    Parameters:
+        moke_group (h5py.Group): MOKE dataset group
+        treatment_dict (dict): content of moke_data_treatment_store
+
+    Returns:
+        dict: {position: fit key}
+    """
+    fit_keys = {}
+    for position, position_group in get_position_groups(moke_group):
+        mean_shot_group = position_group.get("measurement/shot_mean")
+        raw_arrays = [mean_shot_group[name][()] for name in MOKE_FIT_ARRAYS]
+        fit_keys[position] = make_fit_key(treatment_dict, raw_arrays, MOKE_FIT_VERSION)
+    return fit_keys
+
+
+def moke_batch_fit(moke_group, treatment_dict, progress_callback=None, fit_keys=None):
+    """
+    Treat and fit the loops of every position of a MOKE dataset
+
+    Parameters:
+        moke_group (h5py.Group): MOKE dataset group
+        treatment_dict (dict): content of moke_data_treatment_store
+        progress_callback (function, optional): called with (position index, number of positions) before each fit
+        fit_keys (dict, optional): {position: fit key}, positions with results stored under their key are skipped
+
+    Returns:
+        dict: {position: results} of the fitted positions
+    """
     results_dict = {}
-    for position, position_group in moke_group.items():
-        if "scan_parameters" in position:
+    position_list = list(get_position_groups(moke_group))
+    for index, (position, position_group) in enumerate(position_list):
+        if progress_callback is not None:
+            progress_callback(index, len(position_list))
+        if fit_keys is not None and has_fit_results(position_group, fit_keys[position]):
             continue
 
         mean_shot_group = position_group.get("measurement/shot_mean")
@@ -373,16 +425,17 @@ def moke_batch_fit(moke_group, treatment_dict):
     return results_dict
 
 
+@shared_cached
 def moke_make_results_dataframe_from_hdf5(moke_group):
     data_dict_list = []
-    for position, position_group in moke_group.items():
+    for position, position_group in get_position_groups(moke_group):
 
         if "scan_parameters" in position:
             continue
 
         instrument_group = position_group.get("instrument")
         # Exclude spots outside the wafer
-        if np.abs(instrument_group["x_pos"][()]) + np.abs(instrument_group["y_pos"][()]) <= 60:
+        if is_on_wafer(instrument_group["x_pos"][()], instrument_group["y_pos"][()]):
 
             results_group = position_group.get("results")
 
@@ -413,7 +466,7 @@ def moke_make_results_dataframe_from_hdf5(moke_group):
     return result_dataframe
 
 
-def moke_plot_oscilloscope_from_dataframe(fig, df):
+def moke_plot_oscilloscope_from_dataframe(fig, df, x_range=None):
     pulse_shift_factor = df["pulse"].mean()
     magnetization_shift_factor = df["magnetization"].mean() - 0.5
     reflectivity_shift_factor = df["reflectivity"].mean() - 1
@@ -421,32 +474,22 @@ def moke_plot_oscilloscope_from_dataframe(fig, df):
     fig.update_xaxes(title_text="Time (units)")
     fig.update_yaxes(title_text="Voltage (V)")
 
-    fig.add_trace(
-        go.Scatter(
-            x=df["time"],
-            y=df["magnetization"].apply(lambda x: x - magnetization_shift_factor),
-            mode="lines",
-            line=dict(color="SlateBlue", width=2),
-        )
-    )
-
-    fig.add_trace(
-        go.Scatter(
-            x=df["time"],
-            y=df["reflectivity"].apply(lambda x: x - reflectivity_shift_factor),
-            mode="lines",
-            line=dict(color="Crimson", width=2),
+    for column, shift_factor, color in [
+        ("magnetization", magnetization_shift_factor, "SlateBlue"),
+        ("reflectivity", reflectivity_shift_factor, "Crimson"),
+        ("pulse", pulse_shift_factor, "Green"),
+    ]:
+        # Decimate every channel to the screen resolution, keeping only the zoomed range if specified
+        time, voltage = decimate_trace(df["time"], df[column] - shift_factor, x_range=x_range)
+        fig.add_trace(
+            go.Scatter(
+                x=time,
+                y=voltage,
+                mode="lines",
+                line=dict(color=color, width=2),
+            )
         )
-    )
 
-    fig.add_trace(
-        go.Scatter(
-            x=df["time"],
-            y=df["pulse"].apply(lambda x: x - pulse_shift_factor),
-            mode="lines",
-            line=dict(color="Green", width=2),
-        )
-    )
     return fig
 
 
@@ -465,6 +508,26 @@ def moke_plot_loop_from_dataframe(fig, df):
     return fig
 
 
+def moke_get_vlines_values(results_dict, heatmap_select):
+    """
+    Return the fields to mark on the loop for the selected heatmap value
+
+    Parameters:
+        results_dict (dict): position results, see moke_get_results_from_hdf5
+        heatmap_select (str): selected heatmap value
+
+    Returns:
+        list: [negative field, positive field], empty if the selected value has no field to mark
+    """
+    if heatmap_select == "coercivity_m0":
+        return [results_dict["coercivity_m0"]["negative"], results_dict["coercivity_m0"]["positive"]]
+    if heatmap_select == "coercivity_dmdh":
+        return [results_dict["coercivity_dmdh"]["negative"], results_dict["coercivity_dmdh"]["positive"]]
+    if heatmap_select == "intercept_field":
+        return [results_dict["coercivity_dmdh"]["negative"], results_dict["coercivity_dmdh"]["positive"]]
+    return []
+
+
 def moke_plot_vlines(fig, values):
     for value in values:
         if value > 0:
@@ -485,30 +548,99 @@ def moke_plot_vlines(fig, values):
     return fig
 
 
-def moke_plot_loop_map(hdf5_file, options_dict, normalize = False):
-    results_dataframe = moke_make_results_dataframe_from_hdf5(hdf5_file)
-    instrument_dict = moke_get_instrument_dict_from_hdf5(hdf5_file)
+@shared_cached
+def moke_get_all_mean_shots_from_hdf5(moke_group):
+    """
+    Read the mean shot of every position on the wafer in a single pass over the dataset
 
-    x_min, x_max = results_dataframe["x_pos (mm)"].min(), results_dataframe["x_pos (mm)"].max()
-    y_min, y_max = results_dataframe["y_pos (mm)"].min(), results_dataframe["y_pos (mm)"].max()
+    Parameters:
+        moke_group (h5py.Group): MOKE dataset group
 
-    x_dim, y_dim = int(instrument_dict["number_of_points_x"]), int(instrument_dict["number_of_points_y"])
+    Returns:
+        list: [(x_pos, y_pos, measurement_dataframe), ...] for every position with a mean shot
+    """
+    measurement_list = []
+    for position, position_group in get_position_groups(moke_group):
+        instrument_group = position_group.get("instrument")
+        x_pos = instrument_group["x_pos"][()]
+        y_pos = instrument_group["y_pos"][()]
 
-    if x_dim == 1:
-        step_x = 1
-    else:
-        step_x = (np.abs(x_max) + np.abs(x_min)) / (x_dim - 1)
+        # Exclude spots outside the wafer
+        mean_shot_group = position_group.get("measurement/shot_mean")
+        if not is_on_wafer(x_pos, y_pos) or mean_shot_group is None:
+            continue
 
-    if y_dim == 1:
-        step_y = 1
-    else:
-        step_y = (np.abs(y_max) + np.abs(y_min)) / (y_dim - 1)
+        measurement_dataframe = pd.DataFrame(
+            {"magnetization": mean_shot_group["magnetization_mean"][()],
+             "pulse": mean_shot_group["pulse_mean"][()],
+             "reflectivity": mean_shot_group["reflectivity_mean"][()],
+             "integrated_pulse": mean_shot_group["integrated_pulse_mean"][()]})
+
+        measurement_list.append((x_pos, y_pos, measurement_dataframe))
+
+    return measurement_list
+
+
+def moke_plot_loop_map(hdf5_file, options_dict, normalize = False, progress_callback=None):
+    """
+    Plot the loops of every position at their location on the wafer. All loops are drawn in a single WebGL trace,
+    each loop being scaled to fit its cell and separated from the next one by NaN values.
 
-    fig = make_subplots(
-        rows=y_dim, cols=x_dim, horizontal_spacing=0.001, vertical_spacing=0.001
+    Parameters:
+        hdf5_file (h5py.Group): MOKE dataset group
+        options_dict (dict): data treatment dictionary, see callbacks_moke.store_data_treatment
+        normalize (bool): if True, each loop fills its cell, otherwise all loops share the same Kerr rotation scale
+        progress_callback (callable): called as progress_callback(done, total) while loops are treated
+
+    Returns:
+        go.Figure: loop map figure
+    """
+    measurement_list = moke_get_all_mean_shots_from_hdf5(hdf5_file)
+
+    grid = WaferGrid([x_pos for x_pos, y_pos, data in measurement_list],
+                     [y_pos for x_pos, y_pos, data in measurement_list])
+    step_x, step_y = grid.step_x, grid.step_y
+
+    loop_list = []
+    for index, (x_pos, y_pos, data) in enumerate(measurement_list):
+        if progress_callback is not None:
+            progress_callback(index, len(measurement_list))
+        data = moke_treat_measurement_dataframe(data, options_dict)
+        loop_list.append((x_pos, y_pos, data["field"].to_numpy(), data["magnetization"].to_numpy()))
+
+    # Scales of 0 (flat or empty loops) are replaced by 1, the loops are then drawn as flat lines
+    max_field = max((np.nanmax(np.abs(field), initial=0) for x_pos, y_pos, field, magnetization in loop_list),
+                    default=0) or 1
+    max_magnetization = max((np.nanmax(np.abs(magnetization), initial=0)
+                             for x_pos, y_pos, field, magnetization in loop_list), default=0) or 1
+
+    # Each loop fills 90% of its cell, the NaN appended to every loop breaks the line between two cells
+    x_segments = [np.empty(0)]
+    y_segments = [np.empty(0)]
+    for x_pos, y_pos, field, magnetization in loop_list:
+        if normalize:
+            loop_min, loop_max = np.nanmin(magnetization, initial=np.inf), np.nanmax(magnetization, initial=-np.inf)
+            if loop_max > loop_min:
+                magnetization = 2 * (magnetization - loop_min) / (loop_max - loop_min) - 1
+            else:
+                magnetization = np.zeros_like(magnetization)
+        else:
+            magnetization = magnetization / max_magnetization
+
+        x_segments.extend([x_pos + field / max_field * 0.45 * step_x, [np.nan]])
+        y_segments.extend([y_pos + magnetization * 0.45 * step_y, [np.nan]])
+
+    fig = go.Figure(
+        go.Scattergl(
+            x=np.concatenate(x_segments),
+            y=np.concatenate(y_segments),
+            mode="lines",
+            line=dict(color="Black", width=1),
+            hoverinfo="skip",
+        )
     )
 
-    # Update layout to hide axis lines, grid, and ticks for each subplot
+    # Hide axis lines, grid, and ticks
     fig.update_xaxes(showgrid=False, zeroline=False, showticklabels=False)
     fig.update_yaxes(showgrid=False, zeroline=False, showticklabels=False)
 
@@ -521,56 +653,4 @@ def moke_plot_loop_map(hdf5_file, options_dict, normalize = False):
         plot_bgcolor="white",
     )
 
-    for index, row in results_dataframe.iterrows():
-        target_x = row["x_pos (mm)"]
-        target_y = row["y_pos (mm)"]
-
-        data = moke_get_measurement_from_hdf5(hdf5_file, target_x, target_y)
-        data = moke_treat_measurement_dataframe(data, options_dict)
-
-        fig_col = int((target_x // step_x + (x_dim + 1) // 2))
-        fig_row = int((-target_y // step_y + (y_dim + 1) // 2))
-
-        fig.add_trace(
-            go.Scatter(
-                x=data["field"],
-                y=data["magnetization"],
-                mode="lines",
-                line=dict(color="Black", width=1),
-            ),
-            row=fig_row,
-            col=fig_col,
-        )
-
-        if normalize:
-            fig.update_yaxes(
-                range=[data["magnetization"].min(), data["magnetization"].max()],
-                row=fig_row,
-                col=fig_col,
-            )
-        if not normalize:
-            y_max = results_dataframe["max_kerr_rotation"].max()
-            fig.update_yaxes(range=[-y_max, y_max], row=fig_row, col=fig_col)
-
     return fig
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,215 @@
+import warnings
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+from ..functions.functions_shared import *
+from ..functions.functions_mask import MaskLayers, get_mask_layers, write_mask_layers, flush_mask_edits
+from ..functions.functions_export import RESULTS_DATAFRAME_FUNCTIONS
+
+'''Spatial outlier detection: positions whose results stand out from their grid neighbours are proposed for the
+auto_outlier mask layer, the user accepts or rejects every candidate'''
+
+# Robust z-score above which a position is flagged
+OUTLIER_THRESHOLD = 3.5
+# Half width of the neighbourhood window, in grid steps (1 gives the 8 neighbours)
+OUTLIER_RADIUS = 1
+# Positions with fewer valid neighbours are never flagged
+OUTLIER_MIN_NEIGHBOURS = 3
+# MAD of a normal distribution to its standard deviation
+OUTLIER_MAD_SCALE = 1.4826
+# Neighbourhood MADs are floored to this fraction of the median absolute residual (value minus neighbourhood median) of
+# the wafer. The MAD of a few neighbours often underestimates the noise, and flat neighbourhoods would flag any noise
+OUTLIER_MAD_FLOOR = 1.0
+# Scores are capped, a value differing from a flat neighbourhood would score infinity otherwise
+OUTLIER_MAX_SCORE = 1000
+# Positions masked in these layers are left out of the neighbourhood statistics
+OUTLIER_EXCLUDED_LAYERS = ["user_ignored", "failed_fit"]
+
+
+def neighbourhood_median_mad(planes, radius=OUTLIER_RADIUS):
+    """
+    Median and median absolute deviation of the neighbours of every grid point, for several planes at once. The point
+    itself is left out of its neighbourhood and NaN values are skipped
+
+    Parameters:
+        planes (np.array): (n, rows, cols) stack of planes, NaN where there is no value
+        radius (int): half width of the neighbourhood window, in grid steps
+
+    Returns:
+        np.array: (n, rows, cols) neighbourhood medians
+        np.array: (n, rows, cols) neighbourhood MADs
+        np.array: (n, rows, cols) number of valid neighbours
+    """
+    width = 2 * radius + 1
+    padded = np.pad(planes, ((0, 0), (radius, radius), (radius, radius)), constant_values=np.nan)
+    windows = sliding_window_view(padded, (width, width), axis=(1, 2))
+    windows = windows.reshape(planes.shape + (width * width,))
+    windows = np.delete(windows, width * width // 2, axis=-1)
+
+    with warnings.catch_warnings():
+        # Neighbourhoods without any value give NaN, they are never flagged
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        median = np.nanmedian(windows, axis=-1)
+        mad = np.nanmedian(np.abs(windows - median[..., np.newaxis]), axis=-1)
+
+    return median, mad, np.isfinite(windows).sum(axis=-1)
+
+
+def detect_outliers(df, threshold=OUTLIER_THRESHOLD, radius=OUTLIER_RADIUS, columns=None, mask_layers=None):
+    """
+    Flag the positions where at least one result is further than threshold robust standard deviations from the median
+    of its neighbours, all the results are treated in one vectorized pass
+
+    Parameters:
+        df (pd.DataFrame): output of a *_make_results_dataframe_from_hdf5 function
+        threshold (float): robust z-score above which a position is flagged
+        radius (int): half width of the neighbourhood window, in grid steps
+        columns (list, optional): results to check, all the numerical results by default
+        mask_layers (MaskLayers, optional): positions masked in OUTLIER_EXCLUDED_LAYERS are left out, the ignored
+            column of df is used otherwise
+
+    Returns:
+        pd.DataFrame: x_pos (mm), y_pos (mm), column and score (robust z-score) of the flagged positions, the column
+            is the result standing out the most
+    """
+    wafer_map = WaferMap.from_dataframe(df)
+    grid = wafer_map.grid
+    columns = wafer_map.names if columns is None else columns
+    if not columns:
+        return pd.DataFrame(columns=["x_pos (mm)", "y_pos (mm)", "column", "score"])
+
+    excluded = wafer_map.ignored
+    if mask_layers is not None:
+        excluded = mask_layers.on_grid(grid, OUTLIER_EXCLUDED_LAYERS)
+    planes = np.stack([np.where(excluded, np.nan, wafer_map.plane(column)) for column in columns])
+
+    median, mad, nb_neighbours = neighbourhood_median_mad(planes, radius)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        residual_mad = np.nanmedian(np.abs(planes - median), axis=(1, 2), keepdims=True)
+    mad = np.fmax(mad, OUTLIER_MAD_FLOOR * residual_mad)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = np.abs(planes - median) / (OUTLIER_MAD_SCALE * mad)
+    scores = np.where((nb_neighbours >= OUTLIER_MIN_NEIGHBOURS) & ~np.isnan(scores),
+                      np.fmin(scores, OUTLIER_MAX_SCORE), 0)
+
+    # One score per point, the worst result
+    point_scores = scores[:, grid.row_index, grid.col_index]
+    worst = np.argmax(point_scores, axis=0)
+    score = point_scores[worst, np.arange(len(grid))]
+    flagged = score > threshold
+
+    return pd.DataFrame({
+        "x_pos (mm)": grid.x[flagged],
+        "y_pos (mm)": grid.y[flagged],
+        "column": np.asarray(columns, dtype=object)[worst[flagged]],
+        "score": score[flagged],
+    }).sort_values("score", ascending=False, ignore_index=True)
+
+
+def get_outliers_from_hdf5(hdf5_group, threshold=OUTLIER_THRESHOLD, radius=OUTLIER_RADIUS):
+    """
+    Outlier candidates of a dataset, see detect_outliers. Positions masked by the user or failed fits, pending edit
+    mode toggles included, are left out of the statistics
+
+    Parameters:
+        hdf5_group (h5py.Group): dataset group
+        threshold (float): robust z-score above which a position is flagged
+        radius (int): half width of the neighbourhood window, in grid steps
+
+    Returns:
+        pd.DataFrame: flagged positions
+    """
+    make_results_dataframe = RESULTS_DATAFRAME_FUNCTIONS[hdf5_group.attrs.get("HT_type")]
+    df = make_results_dataframe(hdf5_group)
+    return detect_outliers(df, threshold, radius, mask_layers=get_mask_layers(hdf5_group))
+
+
+def outliers_make_store(dataset_name, outlier_df):
+    """Content of the outlier store of a tab: the dataset name and the flagged positions"""
+    return {"dataset": dataset_name, "candidates": outlier_df.to_dict("records")}
+
+
+def outliers_make_options(outlier_store):
+    """
+    Options of the candidate selection of a tab, one per candidate, the values are the indices of the candidates
+
+    Parameters:
+        outlier_store (dict): see outliers_make_store, no options if it is None
+
+    Returns:
+        list: dropdown options
+        list: indices of all the candidates, they are all selected by default
+    """
+    if not outlier_store:
+        return [], []
+    options = [
+        {"label": f"{candidate['x_pos (mm)']}, {candidate['y_pos (mm)']}: {candidate['column']} "
+                  f"({candidate['score']:.1f})",
+         "value": index}
+        for index, candidate in enumerate(outlier_store["candidates"])
+    ]
+    return options, [option["value"] for option in options]
+
+
+def outliers_add_to_heatmap(fig, outlier_store, dataset_name):
+    """
+    Mark the outlier candidates waiting for review on a heatmap
+
+    Parameters:
+        fig (go.Figure): output of make_heatmap_from_dataframe
+        outlier_store (dict): see outliers_make_store, nothing is drawn if it is None or for another dataset
+        dataset_name (str): dataset shown on the heatmap
+
+    Returns:
+        go.Figure
+    """
+    if not outlier_store or outlier_store["dataset"] != dataset_name or not outlier_store["candidates"]:
+        return fig
+
+    outlier_df = pd.DataFrame(outlier_store["candidates"])
+    fig.add_trace(
+        go.Scatter(
+            x=outlier_df["x_pos (mm)"],
+            y=outlier_df["y_pos (mm)"],
+            mode="markers",
+            marker=dict(symbol="x-thin-open", size=14, color="red", line=dict(width=3, color="red")),
+            customdata=outlier_df[["column", "score"]].to_numpy(),
+            hovertemplate="x: %{x} mm<br>y: %{y} mm<br>%{customdata[0]}<br>score: %{customdata[1]:.1f}"
+                          "<extra>Outlier candidate</extra>",
+            showlegend=False,
+        )
+    )
+    return fig
+
+
+def outliers_accept(hdf5_path, outlier_store, selected=None):
+    """
+    Add the selected outlier candidates to the auto_outlier mask layer of their dataset, the positions already in the
+    layer stay in it
+
+    Parameters:
+        hdf5_path (str, Path): path to the HDF5 file
+        outlier_store (dict): see outliers_make_store
+        selected (list, optional): indices of the accepted candidates, all the candidates by default
+
+    Returns:
+        int: number of accepted positions
+        int: number of positions in the auto_outlier layer
+    """
+    candidate_list = outlier_store["candidates"]
+    if selected is not None:
+        candidate_list = [candidate_list[index] for index in selected]
+    candidates = {(candidate["x_pos (mm)"], candidate["y_pos (mm)"]) for candidate in candidate_list}
+
+    # The buffered toggles go first, write_mask_layers recomputes the ignored attributes from all the layers
+    flush_mask_edits(hdf5_path)
+    with open_hdf5(hdf5_path, "a") as hdf5_file:
+        dataset_group = hdf5_file[outlier_store["dataset"]]
+        positions = get_dataset_positions(dataset_group)
+        accepted = np.array([(x, y) in candidates for x, y in positions], dtype=bool)
+        mask = get_mask_layers(dataset_group).layers["auto_outlier"] | accepted
+        write_mask_layers(dataset_group, {"auto_outlier": mask})
+
+    return int(accepted.sum()), int(mask.sum())
@@ -4,8 +4,8 @@ import plotly.graph_objs as go
 from sklearn.linear_model import RANSACRegressor, LinearRegression
 from sklearn.preprocessing import PolynomialFeatures
 from sklearn.linear_model import HuberRegressor
-from functions_shared import *
-from modules.hdf5_compilers.hdf5compile_profil import write_dektak_results_to_hdf5
+from ..functions.functions_shared import *
+from modules.hdf5_compilers.hdf5compile_profil import write_dektak_results_to_hdf5, write_dektak_manual_height_to_hdf5
 
 
 def profil_conditions(hdf5_path, *args, **kwargs):
@@ -13,15 +13,16 @@ def profil_conditions(hdf5_path, *args, **kwargs):
         return False
     if not h5py.is_hdf5(hdf5_path):
         return False
-    with h5py.File(hdf5_path, "r") as hdf5_file:
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
         dataset_list = get_hdf5_datasets(hdf5_file, dataset_type="profil")
         if len(dataset_list) == 0:
             return False
     return True
 
 
+@shared_cached
 def profil_get_measurement_from_hdf5(profil_group, target_x, target_y):
-    for position, position_group in profil_group.items():
+    for position, position_group in get_position_groups(profil_group):
         instrument_group = position_group.get("instrument")
         if instrument_group["x_pos"][()] == target_x and instrument_group["y_pos"][()] == target_y:
             measurement_group = position_group.get("measurement")
@@ -37,7 +38,7 @@ def profil_get_measurement_from_hdf5(profil_group, target_x, target_y):
 def profil_get_results_from_hdf5(profil_group, target_x, target_y):
     data_dict = {}
 
-    for position, position_group in profil_group.items():
+    for position, position_group in get_position_groups(profil_group):
         instrument_group = position_group.get("instrument")
         if instrument_group["x_pos"][()] == target_x and instrument_group["y_pos"][()] == target_y:
             results_group = position_group.get("results")
@@ -50,6 +51,31 @@ def profil_get_results_from_hdf5(profil_group, target_x, target_y):
     return data_dict
 
 
+@shared_cached
+def profil_get_treated_measurement_from_hdf5(profil_group, target_x, target_y):
+    """
+    Read the profile and results at a position and remove the profile slope, the output is cached and prefetched
+    after clicks
+
+    Parameters:
+        profil_group (h5py.Group): profil dataset group
+        target_x (float): x position
+        target_y (float): y position
+
+    Returns:
+        pd.DataFrame: measurement with the adjusted profile
+        dict: results, None if the position was not fitted
+        np.array: coefficients of the removed slope
+    """
+    measurement_df = profil_get_measurement_from_hdf5(profil_group, target_x, target_y)
+    results_dict = profil_get_results_from_hdf5(profil_group, target_x, target_y)
+
+    adjusting_slope = results_dict["adjusting_slope"] if results_dict else None
+    adjusting_slope, measurement_df = profil_measurement_dataframe_treat(measurement_df, adjusting_slope)
+
+    return measurement_df, results_dict, adjusting_slope
+
+
 def multi_step_function(x, *params):
     # Generate function with multiple steps
     # Even indices are the x positions of the steps,
@@ -154,6 +180,27 @@ def profil_measurement_dataframe_fit_steps(df, n_steps, x0_guess):
 
     return results_dict
 
+# Version of the step fits, part of the fit keys: bump it when the results of the same inputs change
+PROFIL_FIT_VERSION = "1"
+
+
+def profil_make_fit_key(position_group, nb_steps, x0):
+    """
+    Fit key of a profilometry position, see make_fit_key
+
+    Parameters:
+        position_group (h5py.Group): position group
+        nb_steps (int): number of steps fitted
+        x0 (float): initial guess of the first step position
+
+    Returns:
+        str: fit key
+    """
+    measurement_group = position_group.get("measurement")
+    raw_arrays = [measurement_group["distance"][()], measurement_group["profile"][()]]
+    return make_fit_key({"nb_steps": nb_steps, "x0": x0}, raw_arrays, PROFIL_FIT_VERSION)
+
+
 def profil_spot_fit_steps(position_group, nb_steps, x0):
     measurement_group = position_group.get("measurement")
 
@@ -167,13 +214,51 @@ def profil_spot_fit_steps(position_group, nb_steps, x0):
     return results_dict
 
 
+def profil_fit_position(position_group, nb_steps, x0):
+    """
+    Fit the steps of a position, positions fitted before with the same steps and raw data are not fitted again. Only
+    reads the file, the results are written by profil_write_fit_results
+
+    Parameters:
+        position_group (h5py.Group): position group
+        nb_steps (int): number of steps fitted
+        x0 (float): initial guess of the first step position
+
+    Returns:
+        str: fit key
+        dict or None: fit results, None if stored results can be reused
+    """
+    fit_key = profil_make_fit_key(position_group, nb_steps, x0)
+    if has_fit_results(position_group, fit_key):
+        return fit_key, None
+    return fit_key, profil_spot_fit_steps(position_group, nb_steps, x0)
+
+
+def profil_write_fit_results(position_group, fit_key, results_dict):
+    """
+    Write the results of profil_fit_position, or get back the stored results of the same fit. The file must be open in
+    a write mode
+
+    Parameters:
+        position_group (h5py.Group): position group
+        fit_key (str): fit key
+        results_dict (dict or None): fit results, None to reuse the stored results
+    """
+    if results_dict is None:
+        activate_fit_results(position_group, fit_key)
+    else:
+        write_dektak_results_to_hdf5(position_group, results_dict, overwrite=True, fit_key=fit_key)
+    return None
+
+
+@shared_cached
 def profil_make_results_dataframe_from_hdf5(profil_group):
     data_dict_list = []
 
-    for position, position_group in profil_group.items():
+    for position, position_group in get_position_groups(profil_group):
         instrument_group = position_group.get("instrument")
         # Exclude spots outside the wafer
-        if np.abs(instrument_group["x_pos"][()]) + np.abs(instrument_group["y_pos"][()]) <= 60:
+        if is_on_wafer(instrument_group["x_pos"][()], instrument_group["y_pos"][()]):
 
             results_group = position_group.get("results")
 
@@ -196,16 +281,19 @@ def profil_make_results_dataframe_from_hdf5(profil_group):
     return result_dataframe
 
 
-def profil_plot_total_profile_from_dataframe(fig, df, adjusting_slope = None, position=(1,1)):
+def profil_plot_total_profile_from_dataframe(fig, df, adjusting_slope = None, position=(1,1), x_range=None):
     # First plot for raw measurement and linear component
     fig.update_xaxes(title_text="Distance_(um)", row=1, col=1)
     fig.update_yaxes(title_text="Profile_(nm)", row=1, col=1)
 
+    # Decimate the profile to the screen resolution, keeping only the zoomed range if specified
+    distance, total_profile = decimate_trace(df["distance_(um)"], df["total_profile_(nm)"], x_range=x_range)
+
     # Add measurement trace
     fig.add_trace(
         go.Scatter(
-            x=df["distance_(um)"],
-            y=df["total_profile_(nm)"],
+            x=distance,
+            y=total_profile,
             mode="lines",
             line=dict(color="SlateBlue", width=3),
         ), row = position[0], col = position[1]
@@ -215,26 +303,29 @@ def profil_plot_total_profile_from_dataframe(fig, df, adjusting_slope = None, po
     if adjusting_slope is not None:
         fig.add_trace(
             go.Scatter(
-                x=df["distance_(um)"],
-                y=parabola(df["distance_(um)"], adjusting_slope[0], adjusting_slope[1], adjusting_slope[2]),
+                x=distance,
+                y=parabola(distance, adjusting_slope[0], adjusting_slope[1], adjusting_slope[2]),
                 mode="lines",
                 line=dict(color="Crimson", width=2),
+                name="adjusting_slope",
             ), row = position[0], col = position[1]
         )
 
     return fig
 
 
-def profil_plot_adjusted_profile_from_dataframe(fig, df, fit_parameters = None, position=(2,1)):
+def profil_plot_adjusted_profile_from_dataframe(fig, df, fit_parameters = None, position=(2,1), x_range=None):
     # Second plot for adjusted profile and fits
     fig.update_xaxes(title_text="Distance_(um)", row=2, col=1)
     fig.update_yaxes(title_text="Thickness_(nm)", row=2, col=1)
 
+    distance, adjusted_profile = decimate_trace(df["distance_(um)"], df["adjusted_profile_(nm)"], x_range=x_range)
+
     # Plot the profile after linear adjustment
     fig.add_trace(
         go.Scatter(
-            x=df["distance_(um)"],
-            y=df["adjusted_profile_(nm)"],
+            x=distance,
+            y=adjusted_profile,
             mode="lines",
             line=dict(color="SlateBlue", width=3),
         ), row=position[0], col=position[1]
@@ -244,10 +335,11 @@ def profil_plot_adjusted_profile_from_dataframe(fig, df, fit_parameters = None,
     if fit_parameters is not None:
         fig.add_trace(
             go.Scatter(
-                x=df["distance_(um)"],
-                y=multi_step_function(df["distance_(um)"], *fit_parameters),
+                x=distance,
+                y=multi_step_function(distance, *fit_parameters),
                 mode="lines",
                 line=dict(color="Crimson", width=2),
+                name="fit_parameters",
             ), row=position[0], col=position[1]
         )
 
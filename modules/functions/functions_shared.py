@@ -9,10 +9,33 @@ import shutil
 from dash.exceptions import PreventUpdate
 import functools
 from plotly.subplots import make_subplots
-from dash import Input, Output, State, ctx
+from dash import Input, Output, State, ctx, ClientsideFunction, Patch, no_update
 from datetime import datetime
 import re
 import stringcase
+import base64
+import struct
+import zlib
+import hashlib
+import json
+import time
+import uuid
+import flask
+import diskcache
+import psutil
+import contextlib
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from plotly.colors import sample_colorscale
+from scipy.spatial import cKDTree
+
+from ..functions.functions_wafer import *
+
+try:
+    import fcntl
+except ImportError:  # Windows, only served by a single process
+    fcntl = None
 
 
 # Decorator function to check conditions before executing callbacks, preventing errors
@@ -32,6 +55,505 @@ def check_conditions(conditions_function, hdf5_path_index):
     return decorator
 
 
+# Scheduler lanes and their number of concurrent slots. Interactive reads (heatmaps, plots) have their own reserved
+# slots so that they never wait behind batch work (imports, batch fits, exports, loop maps), which is queued with
+# a bounded concurrency. The batch lane is only for background callbacks, its waiters are background processes and
+# never server threads. The slots are counted in a diskcache, shared by the server threads and the background processes,
+# waiters are served in arrival order
+SCHEDULER_LANES = {"interactive": 8, "batch": 2}
+SCHEDULER_POLL_INTERVAL = 0.05
+_scheduler = {"cache": None}
+
+
+def configure_scheduler(cache_folder, lanes=None):
+    """
+    Open the scheduler state in cache_folder, callbacks decorated with scheduled are run unscheduled until this is called
+
+    Parameters:
+        cache_folder (str, Path): folder where the scheduler state is stored
+        lanes (dict, optional): {lane: number of concurrent slots}, overrides SCHEDULER_LANES
+
+    Returns:
+        diskcache.Cache: the scheduler cache
+    """
+    if lanes is not None:
+        SCHEDULER_LANES.update(lanes)
+    cache = diskcache.Cache(str(cache_folder))
+    with cache.transact():
+        for lane in SCHEDULER_LANES:
+            cache.add(f"{lane}_holders", {})
+            cache.add(f"{lane}_waiting", {})
+            cache.add(f"{lane}_stats", {"completed": 0, "total_wait": 0.0, "max_wait": 0.0, "last_wait": 0.0})
+    _scheduler["cache"] = cache
+    return cache
+
+
+def _scheduler_alive(entries):
+    """Drop the slots and queue entries of dead processes (cancelled background jobs are killed)"""
+    return {token: pid for token, pid in entries.items() if psutil.pid_exists(pid)}
+
+
+def _scheduler_try_acquire(cache, lane, token):
+    """
+    Take a slot in lane if one is free and token is among the first waiters, otherwise register token at the end of the
+    lane queue. The queue is a dict, its insertion order is the order of arrival
+    """
+    with cache.transact():
+        holders = _scheduler_alive(cache.get(f"{lane}_holders", {}))
+        waiting = _scheduler_alive(cache.get(f"{lane}_waiting", {}))
+        waiting.setdefault(token, os.getpid())
+        free_slots = SCHEDULER_LANES[lane] - len(holders)
+        acquired = token in list(waiting)[:max(free_slots, 0)]
+        if acquired:
+            holders[token] = waiting.pop(token)
+        cache.set(f"{lane}_holders", holders)
+        cache.set(f"{lane}_waiting", waiting)
+    return acquired
+
+
+def _scheduler_release(cache, lane, token, wait_time):
+    with cache.transact():
+        holders = cache.get(f"{lane}_holders", {})
+        holders.pop(token, None)
+        cache.set(f"{lane}_holders", holders)
+
+        stats = cache.get(f"{lane}_stats")
+        stats["completed"] += 1
+        stats["total_wait"] += wait_time
+        stats["max_wait"] = max(stats["max_wait"], wait_time)
+        stats["last_wait"] = wait_time
+        cache.set(f"{lane}_stats", stats)
+
+
+def scheduled(lane):
+    """
+    Decorator running a callback in a scheduler lane, the callback waits for a free slot of its lane before running.
+    Batch callbacks must be background callbacks, they would hold a server thread while waiting otherwise
+
+    Parameters:
+        lane (str): 'interactive' or 'batch', see SCHEDULER_LANES
+
+    Returns:
+        decorator
+    """
+    if lane not in SCHEDULER_LANES:
+        raise ValueError(f"Unknown scheduler lane {lane}, expected one of {list(SCHEDULER_LANES)}")
+
+    def decorator(callback_function):
+        @functools.wraps(callback_function)
+        def wrapper(*args, **kwargs):
+            cache = _scheduler["cache"]
+            if cache is None:
+                return callback_function(*args, **kwargs)
+            if lane == "batch" and flask.has_request_context():
+                raise RuntimeError(f"Batch lane callback {callback_function.__name__} must be a background callback")
+
+            token = uuid.uuid4().hex
+            start = time.perf_counter()
+            while not _scheduler_try_acquire(cache, lane, token):
+                time.sleep(SCHEDULER_POLL_INTERVAL)
+            wait_time = time.perf_counter() - start
+
+            try:
+                return callback_function(*args, **kwargs)
+            finally:
+                _scheduler_release(cache, lane, token, wait_time)
+
+        return wrapper
+
+    return decorator
+
+
+def get_scheduler_stats():
+    """
+    Read the state of the scheduler lanes
+
+    Returns:
+        dict: {lane: {'slots', 'running', 'waiting', 'completed', 'mean_wait', 'max_wait', 'last_wait'}}, wait times in s
+    """
+    cache = _scheduler["cache"]
+    if cache is None:
+        return {}
+
+    stats_dict = {}
+    for lane, slots in SCHEDULER_LANES.items():
+        stats = cache.get(f"{lane}_stats")
+        stats_dict[lane] = {
+            "slots": slots,
+            "running": len(_scheduler_alive(cache.get(f"{lane}_holders", {}))),
+            "waiting": len(_scheduler_alive(cache.get(f"{lane}_waiting", {}))),
+            "completed": stats["completed"],
+            "mean_wait": stats["total_wait"] / stats["completed"] if stats["completed"] else 0.0,
+            "max_wait": stats["max_wait"],
+            "last_wait": stats["last_wait"],
+        }
+    return stats_dict
+
+
+def format_scheduler_stats(stats_dict):
+    """
+    Format the output of get_scheduler_stats as a one line status
+
+    Parameters:
+        stats_dict (dict): output of get_scheduler_stats
+
+    Returns:
+        str
+    """
+    if not stats_dict:
+        return "Scheduler not configured"
+    return " | ".join(
+        f"{lane}: {stats['running']}/{stats['slots']} running, {stats['waiting']} queued, "
+        f"wait mean {stats['mean_wait']:.2f} s / max {stats['max_wait']:.2f} s"
+        for lane, stats in stats_dict.items()
+    )
+
+
+# HDF5 files are shared by the server workers and the background job processes. Each open takes a lock on a hidden
+# sidecar file: readers share it and are opened in SWMR mode, writers hold it exclusively so that writes are serialized
+_hdf5_held_locks = threading.local()
+_hdf5_process_locks = {}
+_hdf5_process_locks_guard = threading.Lock()
+
+
+@contextlib.contextmanager
+def _lock_hdf5(hdf5_path, exclusive=False):
+    # Lock on the sidecar file of an HDF5 file, shared or exclusive, reentrant for the thread already holding it
+    held = getattr(_hdf5_held_locks, "paths", None)
+    if held is None:
+        held = _hdf5_held_locks.paths = set()
+    # The thread already holds the lock on this file, reopening must not wait for itself
+    if hdf5_path in held:
+        yield
+        return
+
+    lock_path = hdf5_path.with_name(f".{hdf5_path.name}.lock")
+    with open(lock_path, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            process_lock = contextlib.nullcontext()
+        else:
+            with _hdf5_process_locks_guard:
+                process_lock = _hdf5_process_locks.setdefault(hdf5_path, threading.Lock())
+
+        with process_lock:
+            held.add(hdf5_path)
+            try:
+                yield
+            finally:
+                held.discard(hdf5_path)
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def open_hdf5(hdf5_path, mode="r", **kwargs):
+    """
+    Open an HDF5 file behind a file lock shared between processes, drop-in replacement for h5py.File as context manager
+
+    Parameters:
+        hdf5_path (str, Path): path to the HDF5 file
+        mode (str): h5py file mode, 'r' takes a shared lock, any other mode an exclusive lock
+        **kwargs: passed to h5py.File
+
+    Returns:
+        h5py.File
+    """
+    hdf5_path = Path(hdf5_path).resolve()
+    if mode == "r":
+        kwargs.setdefault("swmr", True)
+
+    with _lock_hdf5(hdf5_path, exclusive=mode != "r"):
+        with h5py.File(hdf5_path, mode, **kwargs) as hdf5_file:
+            try:
+                yield hdf5_file
+            finally:
+                if mode != "r":
+                    bump_hdf5_revision(hdf5_file)
+
+
+def repack_hdf5(hdf5_path):
+    """
+    Rewrite an HDF5 file to give back the space of deleted objects (replaced results, evicted fit results sets), which
+    HDF5 never reuses once the file is closed. The copy is written next to the file and replaces it under the
+    exclusive lock
+
+    Parameters:
+        hdf5_path (str, Path): path to the HDF5 file
+
+    Returns:
+        int: size before repacking, in bytes
+        int: size after repacking, in bytes
+    """
+    hdf5_path = Path(hdf5_path).resolve()
+    temp_path = hdf5_path.with_name(f".{hdf5_path.name}.repack")
+
+    with _lock_hdf5(hdf5_path, exclusive=True):
+        size_before = os.path.getsize(hdf5_path)
+        try:
+            with h5py.File(hdf5_path, "r") as hdf5_file, h5py.File(temp_path, "w") as repacked_file:
+                for key, value in hdf5_file.attrs.items():
+                    repacked_file.attrs[key] = value
+                # Soft links (results of the positions) are copied as links, not expanded
+                for name in hdf5_file:
+                    hdf5_file.copy(hdf5_file[name], repacked_file, name=name)
+                bump_hdf5_revision(repacked_file)
+            os.replace(temp_path, hdf5_path)
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+
+    return size_before, os.path.getsize(hdf5_path)
+
+
+def bump_hdf5_revision(hdf5_file):
+    """Increment the modification counter of an HDF5 file opened for writing, invalidates the shared cache entries"""
+    hdf5_file.attrs["revision"] = int(hdf5_file.attrs.get("revision", 0)) + 1
+
+
+def get_hdf5_revision(hdf5_file):
+    """
+    Get the modification state of an open HDF5 file, the revision counter bumped by open_hdf5 writers and the file mtime
+    so that writes from outside the app are also detected
+
+    Parameters:
+        hdf5_file (h5py.File): open HDF5 file
+
+    Returns:
+        tuple: (revision, mtime in ns)
+    """
+    return int(hdf5_file.attrs.get("revision", 0)), os.stat(hdf5_file.filename).st_mtime_ns
+
+
+# Results dataframes and measurement arrays read from the HDF5 files are cached on disk, shared by all the server
+# workers and bounded in size (least recently used entries are evicted). Entries are keyed by file, group and revision
+SHARED_CACHE_SIZE_LIMIT = 2**30
+_shared_cache = {"cache": None}
+
+
+def configure_shared_cache(cache_folder, size_limit=SHARED_CACHE_SIZE_LIMIT):
+    """
+    Open the shared cache in cache_folder, functions decorated with shared_cached are not cached until this is called
+
+    Parameters:
+        cache_folder (str, Path): folder where the cache is stored
+        size_limit (int): maximum size of the cache in bytes
+
+    Returns:
+        diskcache.Cache: the shared cache
+    """
+    cache = diskcache.Cache(str(cache_folder), size_limit=size_limit, eviction_policy="least-recently-used")
+    _shared_cache["cache"] = cache
+    return cache
+
+
+def _shared_cache_arg(arg):
+    # Positions may come as int or float from the browser, they must give the same key. Arrays are keyed by their
+    # content, their repr is truncated above 1000 elements
+    if isinstance(arg, (int, float, np.number)) and not isinstance(arg, bool):
+        return float(arg)
+    if isinstance(arg, np.ndarray):
+        return arg.dtype.str, arg.shape, hashlib.md5(np.ascontiguousarray(arg).tobytes()).hexdigest()
+    return arg
+
+
+def _shared_cache_key(function, hdf5_group, args, kwargs):
+    args = tuple(_shared_cache_arg(arg) for arg in args)
+    hdf5_file = hdf5_group.file
+    return (function.__module__.split(".")[-1], function.__name__, os.path.abspath(hdf5_file.filename),
+            hdf5_group.name, get_hdf5_revision(hdf5_file), repr(args), repr(sorted(kwargs.items())))
+
+
+def shared_cached(function):
+    """
+    Decorator caching the output of a function reading an HDF5 group in the shared cache, the first argument must be
+    the h5py group, the other arguments are part of the key
+
+    Parameters:
+        function: function(hdf5_group, *args, **kwargs), its output must be picklable
+
+    Returns:
+        decorated function
+    """
+    @functools.wraps(function)
+    def wrapper(hdf5_group, *args, **kwargs):
+        cache = _shared_cache["cache"]
+        hdf5_file = hdf5_group.file
+        # Files open for writing may hold changes not counted in the revision yet
+        if cache is None or hdf5_file.mode != "r":
+            return function(hdf5_group, *args, **kwargs)
+
+        key = _shared_cache_key(function, hdf5_group, args, kwargs)
+        result = cache.get(key, default=diskcache.ENOVAL, retry=True)
+        if result is diskcache.ENOVAL:
+            result = function(hdf5_group, *args, **kwargs)
+            cache.set(key, result, retry=True)
+        return result
+
+    return wrapper
+
+
+# After a click on a heatmap, the measurements of the 8 neighbouring positions are read and treated in the background,
+# through shared_cached functions, so that clicking the next position is served from the shared cache
+PREFETCH_WORKERS = 2
+_prefetch_logger = logging.getLogger(__name__)
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+_prefetch_futures = {}
+_prefetch_futures_guard = threading.Lock()
+
+
+@shared_cached
+def get_dataset_positions(hdf5_group):
+    """
+    Read the (x, y) position of every point of a dataset
+
+    Parameters:
+        hdf5_group (h5py.Group): dataset group
+
+    Returns:
+        np.array: (n, 2) array of positions
+    """
+    positions = [
+        (position_group["instrument/x_pos"][()], position_group["instrument/y_pos"][()])
+        for position, position_group in get_position_groups(hdf5_group)
+    ]
+    return np.array(positions, dtype=np.float64).reshape(-1, 2)
+
+
+def get_grid_neighbours(positions, target_x, target_y):
+    """
+    Find the (up to) 8 neighbours of a position on the grid of the dataset positions
+
+    Parameters:
+        positions (np.array): (n, 2) array of positions, see get_dataset_positions
+        target_x (float): x position
+        target_y (float): y position
+
+    Returns:
+        list: (x, y) of the neighbours existing in the dataset
+    """
+    return WaferGrid(positions[:, 0], positions[:, 1]).neighbours(target_x, target_y)
+
+
+def _prefetch_new_stats():
+    return {"hits": 0, "misses": 0, "saved_time": 0.0, "prefetched": 0, "failed": 0}
+
+
+def _prefetch_update_stats(cache, hit=None, saved=0.0, prefetched=0, failed=0):
+    with cache.transact():
+        stats = _prefetch_new_stats() | cache.get("prefetch_stats", {})
+        if hit is not None:
+            stats["hits" if hit else "misses"] += 1
+        stats["saved_time"] += saved
+        stats["prefetched"] += prefetched
+        stats["failed"] += failed
+        cache.set("prefetch_stats", stats)
+
+
+def _prefetch_done(future):
+    # Prefetches run unattended, their errors would be lost with the future otherwise
+    if future.cancelled() or future.exception() is None:
+        return
+    _prefetch_logger.warning("Prefetch failed", exc_info=future.exception())
+    cache = _shared_cache["cache"]
+    if cache is not None:
+        _prefetch_update_stats(cache, failed=1)
+
+
+def _prefetch_task(function, hdf5_path, dataset, target_x, target_y, args):
+    cache = _shared_cache["cache"]
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        hdf5_group = hdf5_file[dataset]
+        for x, y in get_grid_neighbours(get_dataset_positions(hdf5_group), target_x, target_y):
+            key = _shared_cache_key(function.__wrapped__, hdf5_group, (x, y) + args, {})
+            if key in cache:
+                continue
+            start = time.perf_counter()
+            function(hdf5_group, x, y, *args)
+            cache.set(("prefetched",) + key, time.perf_counter() - start)
+            _prefetch_update_stats(cache, prefetched=1)
+
+
+def prefetch_neighbours(function, hdf5_path, dataset, target_x, target_y, *args):
+    """
+    Compute function for the grid neighbours of (target_x, target_y) in the background, pending prefetches for
+    the same function and dataset are dropped since the user has moved on. Failed prefetches are logged and counted
+
+    Parameters:
+        function: shared_cached function(hdf5_group, target_x, target_y, *args)
+        hdf5_path (str, Path): path to the HDF5 file
+        dataset (str): name of the dataset group
+        target_x (float): x position of the clicked point
+        target_y (float): y position of the clicked point
+        *args: other arguments passed to function
+    """
+    if _shared_cache["cache"] is None:
+        return
+
+    future_key = (function.__module__, function.__name__, os.path.abspath(hdf5_path), dataset)
+    with _prefetch_futures_guard:
+        previous_future = _prefetch_futures.get(future_key)
+        if previous_future is not None:
+            previous_future.cancel()
+        future = _prefetch_executor.submit(_prefetch_task, function, hdf5_path, dataset, target_x, target_y, args)
+        future.add_done_callback(_prefetch_done)
+        _prefetch_futures[future_key] = future
+
+
+def record_prefetch_access(function, hdf5_group, target_x, target_y, *args):
+    """
+    Count a click as a prefetch hit (and the time saved) or miss, call before function(hdf5_group, target_x, ...)
+
+    Parameters:
+        function: shared_cached function(hdf5_group, target_x, target_y, *args)
+        hdf5_group (h5py.Group): dataset group
+        target_x (float): x position of the clicked point
+        target_y (float): y position of the clicked point
+        *args: other arguments passed to function
+    """
+    cache = _shared_cache["cache"]
+    if cache is None:
+        return
+
+    key = _shared_cache_key(function.__wrapped__, hdf5_group, (target_x, target_y) + args, {})
+    saved_time = cache.pop(("prefetched",) + key, default=None)
+    _prefetch_update_stats(cache, hit=saved_time is not None, saved=saved_time or 0.0)
+
+
+def get_prefetch_stats():
+    """
+    Read the prefetch statistics
+
+    Returns:
+        dict: {'hits', 'misses', 'hit_rate', 'saved_time', 'prefetched', 'failed'}, saved_time in s
+    """
+    cache = _shared_cache["cache"]
+    if cache is None:
+        return {}
+
+    stats = _prefetch_new_stats() | cache.get("prefetch_stats", {})
+    nb_clicks = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / nb_clicks if nb_clicks else 0.0
+    return stats
+
+
+def format_prefetch_stats(stats_dict):
+    """
+    Format the output of get_prefetch_stats as a one line status
+
+    Parameters:
+        stats_dict (dict): output of get_prefetch_stats
+
+    Returns:
+        str
+    """
+    if not stats_dict:
+        return "Prefetch disabled"
+    return (f"prefetch: {stats_dict['hits']}/{stats_dict['hits'] + stats_dict['misses']} clicks hit "
+            f"({100 * stats_dict['hit_rate']:.0f} %), {stats_dict['saved_time']:.2f} s saved, "
+            f"{stats_dict['prefetched']} positions prefetched, {stats_dict['failed']} failed")
+
+
 def cleanup_file(path):
     try:
         os.remove(path)
@@ -39,14 +561,25 @@ def cleanup_file(path):
         pass
 
 
-def cleanup_directory(folderpath):
+def cleanup_directory(folderpath, max_age=None):
+    """
+    Remove the subfolders of folderpath, the folder is created if it does not exist
+
+    Parameters:
+        folderpath (str, Path): folder to clean
+        max_age (float, optional): only remove subfolders last modified more than max_age seconds ago, so that folders
+            in use by other server workers are kept
+    """
     try:
         for folder in os.listdir(folderpath):
             full_path = os.path.join(folderpath, folder)
-            if os.path.isdir(full_path):
-                shutil.rmtree(full_path)
+            if not os.path.isdir(full_path):
+                continue
+            if max_age is not None and time.time() - os.path.getmtime(full_path) < max_age:
+                continue
+            shutil.rmtree(full_path, ignore_errors=max_age is not None)
     except FileNotFoundError:
-        os.makedirs(folderpath)
+        os.makedirs(folderpath, exist_ok=True)
 
 
 def get_version(tag: str):
@@ -60,7 +593,7 @@ def get_version(tag: str):
         version (str): version of selected item
     """
 
-    version_file_path = Path(os.path.abspath("./config/versions.txt"))
+    version_file_path = Path(__file__).resolve().parents[2] / "config" / "versions.txt"
     with open(version_file_path, "r") as version_file:
         for line in version_file:
             if line.startswith(tag.strip()):
@@ -143,7 +676,7 @@ def detect_measurement(filename_list: list):
 def get_sample_info_from_hdf5(hdf5_path):
     info_dict = {}
 
-    with h5py.File(hdf5_path, "r") as f:
+    with open_hdf5(hdf5_path, "r") as f:
         sample_group = f["/sample"]
 
         info_dict["sample_name"] = sample_group["sample_name"][()]
@@ -288,6 +821,60 @@ def plot_layout(title="", showlegend=False):
     return layout
 
 
+def compact_array(values):
+    """
+    Convert plot data to the smallest numpy dtype that keeps it visually exact, so that plotly serializes it as a
+    compact base64 typed array instead of a JSON number list.
+    Floats are sent as float32 when the rounding error stays far below the data span.
+
+    Parameters:
+        values: list, pd.Series or np.array of plot data
+
+    Returns:
+        np.array or the original values if they are not numeric
+    """
+    try:
+        array = np.asarray(values)
+    except ValueError:
+        return values
+
+    if array.dtype.kind == "b" or array.dtype.kind not in "iuf" or array.size == 0:
+        return values
+
+    if array.dtype.kind in "iu":
+        if np.iinfo(np.int32).min <= array.min() and array.max() <= np.iinfo(np.int32).max:
+            return array.astype(np.int32)
+        return array
+
+    with np.errstate(invalid="ignore", over="ignore"):
+        compact = array.astype(np.float32)
+        span = np.nanmax(array) - np.nanmin(array) if not np.all(np.isnan(array)) else 0
+        error = np.nanmax(np.abs(compact - array)) if not np.all(np.isnan(array)) else 0
+
+    if np.isfinite(error) and error <= 1e-5 * max(span, np.finfo(np.float32).tiny):
+        return compact
+    return array.astype(np.float64)
+
+
+def compact_figure(fig):
+    """
+    Encode the x/y/z data of every trace of a figure as compact typed arrays, see compact_array.
+    Used by the callbacks before returning figures to the browser.
+
+    Parameters:
+        fig (go.Figure): figure to compact, modified in place
+
+    Returns:
+        go.Figure: the same figure
+    """
+    for trace in fig.data:
+        for key in ["x", "y", "z"]:
+            if key in trace and trace[key] is not None:
+                trace[key] = compact_array(trace[key])
+
+    return fig
+
+
 def colorbar_layout(z_min, z_max, precision=0, title=""):
     """
     Generates a standardized colorbar.
@@ -389,68 +976,126 @@ def calc_poly(coefficient_list, x_end, x_start=0, x_step=1):
     return result
 
 
-def make_heatmap_from_dataframe(
-    df,
-    values=None,
-    z_min=None,
-    z_max=None,
-    precision=2,
-    plot_title="",
-    colorbar_title="",
-    masking=False,
-):
-    if values is None:
-        df["default"] = df["x_pos (mm)"] + df["y_pos (mm)"]
-        values = "default"
-        plot_title = "No heatmap selected, default values"
-
-    heatmap_data = df.pivot_table(
-        index="y_pos (mm)",
-        columns="x_pos (mm)",
-        values=values,
-    )
+@functools.lru_cache(maxsize=32)
+def _make_kdtree(positions_bytes):
+    return cKDTree(np.frombuffer(positions_bytes).reshape(-1, 2))
 
-    if "default" in df.columns:
-        df.drop("default", axis="columns", inplace=True)
-
-    # If mask is set, hide points that have an ignore tag in the database
-    if masking:
-        # Create a mask to hide ignored points
-        mask_data = df.pivot_table(
-            index="y_pos (mm)", columns="x_pos (mm)", values="ignored"
-        )
-        # Ignore points
-        mask = mask_data == False
-
-        heatmap_data = heatmap_data.where(mask, np.nan)
-
-    if z_min is None:
-        z_min = np.nanmin(heatmap_data.values)
-    if z_max is None:
-        z_max = np.nanmax(heatmap_data.values)
-
-    heatmap = go.Heatmap(
-        x=heatmap_data.columns,
-        y=heatmap_data.index,
-        z=heatmap_data.values,
-        colorscale="Plasma",
-        # Set ticks for the colorbar
-        colorbar=colorbar_layout(z_min, z_max, precision, title=colorbar_title),
-    )
 
-    # Make and show figure
-    fig = go.Figure(data=[heatmap], layout=heatmap_layout(title=plot_title))
+def get_kdtree(positions):
+    """
+    Build the KD-tree of the positions of a dataset. Trees are cached, so that they are only built once per dataset.
 
-    if z_min is not None:
-        fig.data[0].update(zmin=z_min)
-    if z_max is not None:
-        fig.data[0].update(zmax=z_max)
+    Parameters:
+        positions (array like): (n, 2) array of positions
+
+    Returns:
+        cKDTree
+    """
+    positions = np.ascontiguousarray(positions, dtype=np.float64)
+    return _make_kdtree(positions.tobytes())
+
+
+# Fit results are stored per position in FIT_RESULTS_SETS/<fit key>, the key hashing the fit parameters, the raw data
+# and the fit code version. The 'results' of the position is a soft link to the active set, so that the readers are
+# unchanged, and refitting with parameters used before only moves the link. HDF5 does not give back the space of
+# evicted sets, the file keeps growing with every new parameter set until it is rewritten by repack_hdf5
+FIT_RESULTS_SETS = "results_sets"
+FIT_RESULTS_SETS_KEPT = 8
+
+
+def make_fit_key(parameters, raw_arrays, version):
+    """
+    Key of the fit results of a position
+
+    Parameters:
+        parameters (dict): fit or treatment parameters, must be JSON serializable
+        raw_arrays (list): arrays of raw data fitted
+        version (str): version of the fit code, bumped when the results of the same inputs change
+
+    Returns:
+        str: hexadecimal digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps(parameters, sort_keys=True, default=str).encode())
+    for raw_array in raw_arrays:
+        raw_array = np.ascontiguousarray(raw_array)
+        digest.update(str(raw_array.dtype).encode() + str(raw_array.shape).encode())
+        digest.update(raw_array.tobytes())
+    digest.update(str(version).encode())
+    return digest.hexdigest()
 
-    return fig
+
+def has_fit_results(position_group, fit_key):
+    """Check if fit results are stored for this key"""
+    return fit_key in position_group.get(FIT_RESULTS_SETS, {})
+
+
+def _link_fit_results(position_group, results_group):
+    if position_group.get("results", getlink=True) is not None:
+        # Only the link is removed for a stored set, a plain results group is deleted like a refit always did
+        del position_group["results"]
+    position_group["results"] = h5py.SoftLink(f"{FIT_RESULTS_SETS}/{results_group.name.split('/')[-1]}")
+    results_group.attrs["last_used"] = time.time()
+
+
+def activate_fit_results(position_group, fit_key):
+    """
+    Make the stored results of a key the results of the position, the file must be open in a write mode
+
+    Parameters:
+        position_group (h5py.Group): position group
+        fit_key (str): see make_fit_key
+
+    Returns:
+        bool: False if no results are stored for this key
+    """
+    if not has_fit_results(position_group, fit_key):
+        return False
+    _link_fit_results(position_group, position_group[FIT_RESULTS_SETS][fit_key])
+    return True
+
+
+def create_fit_results_group(position_group, fit_key=None, overwrite=True):
+    """
+    Create the results group of a position, the file must be open in a write mode
+
+    Parameters:
+        position_group (h5py.Group): position group
+        fit_key (str, optional): see make_fit_key, the group is stored under this key and linked as the results of the
+            position. Without key a plain results group is created, the stored sets are kept unchanged
+        overwrite (bool): without key, replace the current results instead of completing them
+
+    Returns:
+        h5py.Group: empty results group, or a plain group holding the current results if overwrite is False
+    """
+    if fit_key is None:
+        if isinstance(position_group.get("results", getlink=True), h5py.SoftLink):
+            stored_group = position_group["results"]
+            del position_group["results"]
+            if not overwrite:
+                # The active set is copied so that completing the results leaves the stored set as it was fitted
+                position_group.copy(stored_group, position_group, name="results")
+                position_group["results"].attrs.pop("last_used", None)
+        elif overwrite and "results" in position_group:
+            del position_group["results"]
+        return position_group.require_group("results")
+
+    sets_group = position_group.require_group(FIT_RESULTS_SETS)
+    if fit_key in sets_group:
+        del sets_group[fit_key]
+    results_group = sets_group.create_group(fit_key)
+    _link_fit_results(position_group, results_group)
+
+    # Least recently used sets beyond FIT_RESULTS_SETS_KEPT are removed
+    stored_list = sorted(sets_group.items(), key=lambda item: item[1].attrs.get("last_used", 0), reverse=True)
+    for name, group in stored_list[FIT_RESULTS_SETS_KEPT:]:
+        del sets_group[name]
+
+    return results_group
 
 
 def check_group_for_results(hdf5_group):
-    for position, position_group in hdf5_group.items():
+    for position, position_group in get_position_groups(hdf5_group):
         if "results" not in position_group:
             return False
     return True
@@ -485,8 +1130,24 @@ def save_dict_to_hdf5(hdf5_group, results_dict):
                 hdf5_group.create_dataset(key, data=str(value))
 
 
+def get_position_groups(hdf5_group):
+    """
+    Iterate over the position groups of a dataset, skipping dataset level groups (scan parameters, alignment scans,
+    cached data...). A position group is identified by its instrument subgroup.
+
+    Parameters:
+        hdf5_group (h5py.Group): dataset group
+
+    Yields:
+        tuple: (position name, position group)
+    """
+    for position, position_group in hdf5_group.items():
+        if isinstance(position_group, h5py.Group) and "instrument" in position_group:
+            yield position, position_group
+
+
 def get_target_position_group(measurement_group, target_x, target_y):
-    for position, position_group in measurement_group.items():
+    for position, position_group in get_position_groups(measurement_group):
         instrument_group = position_group.get("instrument")
         if (
             instrument_group["x_pos"][()] == target_x
@@ -520,3 +1181,120 @@ def convert_bytes(target):
         return float(target)
     except ValueError:
         return target.decode("utf-8")
+
+
+def array_to_png(array, z_min, z_max, colorscale="Plasma"):
+    """
+    Colour map a 2D array on the server and encode it as a PNG data URI, to be displayed with go.Image instead of
+    sending the raw values to the browser. NaN values are transparent.
+
+    Parameters:
+        array (np.array): 2D array to encode, first row is written first
+        z_min (float): value mapped to the bottom of the colorscale
+        z_max (float): value mapped to the top of the colorscale
+        colorscale (str): name of a plotly colorscale
+
+    Returns:
+        str: "data:image/png;base64,..." string
+    """
+    array = np.asarray(array, dtype=np.float64)
+    height, width = array.shape
+
+    lookup_table = np.round(np.array(sample_colorscale(colorscale, np.linspace(0, 1, 256), colortype="tuple")) * 255)
+    scale = 255 / (z_max - z_min) if z_max > z_min else 0
+    with np.errstate(invalid="ignore"):
+        index_array = np.nan_to_num(np.clip((array - z_min) * scale, 0, 255)).astype(np.uint8)
+
+    rgba = np.empty((height, width, 4), dtype=np.uint8)
+    rgba[..., :3] = lookup_table[index_array]
+    rgba[..., 3] = np.where(np.isnan(array), 0, 255)
+
+    # Every PNG scanline starts with its filter type, 0 for none
+    raw_data = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, -1)], axis=1)
+
+    def png_chunk(chunk_type, data):
+        return (struct.pack(">I", len(data)) + chunk_type + data
+                + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+    png_bytes = (
+        b"\x89PNG\r\n\x1a\n"
+        + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        + png_chunk(b"IDAT", zlib.compress(raw_data.tobytes(), 6))
+        + png_chunk(b"IEND", b"")
+    )
+
+    return "data:image/png;base64," + base64.b64encode(png_bytes).decode("ascii")
+
+
+def get_ranges_from_relayout(relayout_data):
+    """
+    Extract the axes ranges from the relayoutData of a dcc.Graph after a zoom or pan.
+
+    Parameters:
+        relayout_data (dict): relayoutData property of a dcc.Graph
+
+    Returns:
+        tuple: (x_range, y_range), each range is a [min, max] list or None when the axis is autoscaled
+        None if relayout_data does not describe an axes change
+    """
+    if not relayout_data:
+        return None
+
+    ranges = []
+    for axis in ["xaxis", "yaxis"]:
+        axis_range = None
+        # Subplots with shared axes report their range as xaxis2, xaxis3...
+        for key, value in relayout_data.items():
+            if re.fullmatch(rf"{axis}\d*\.range\[0\]", key):
+                axis_range = sorted([value, relayout_data[key.replace("[0]", "[1]")]])
+            elif re.fullmatch(rf"{axis}\d*\.range", key):
+                axis_range = sorted(value)
+        ranges.append(axis_range)
+
+    if ranges == [None, None] and not any(key.endswith("autorange") for key in relayout_data):
+        return None
+
+    return tuple(ranges)
+
+
+def decimate_trace(x, y, nb_points=2000, x_range=None):
+    """
+    Reduce a 1D signal to a pixel budget while keeping its visible features. The signal is split in buckets and the
+    minimum and maximum of every bucket are kept, so that peaks and steps survive the decimation.
+
+    Parameters:
+        x (array like): x values, sorted in increasing order
+        y (array like): y values
+        nb_points (int): maximum number of points returned
+        x_range (list): [min, max] displayed x range, only points within this range are returned. Whole signal if None
+
+    Returns:
+        np.array: decimated x values
+        np.array: decimated y values
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+
+    if x_range is not None:
+        # Keep one point on each side of the range so that lines reach the plot edges
+        start = max(np.searchsorted(x, x_range[0]) - 1, 0)
+        stop = min(np.searchsorted(x, x_range[1], side="right") + 1, len(x))
+        x = x[start:stop]
+        y = y[start:stop]
+
+    if len(x) <= nb_points:
+        return x, y
+
+    # The first and last points are always kept, the buckets share the rest of the budget
+    nb_buckets = max((nb_points - 2) // 2, 1)
+    bucket_size = int(np.ceil(len(y) / nb_buckets))
+    padded_y = np.pad(y, (0, nb_buckets * bucket_size - len(y)), mode="edge").reshape(nb_buckets, bucket_size)
+    bucket_start = np.arange(nb_buckets) * bucket_size
+
+    with np.errstate(invalid="ignore"):
+        min_index = bucket_start + np.argmin(np.where(np.isnan(padded_y), np.inf, padded_y), axis=1)
+        max_index = bucket_start + np.argmax(np.where(np.isnan(padded_y), -np.inf, padded_y), axis=1)
+
+    index = np.unique(np.clip(np.concatenate([[0, len(y) - 1], min_index, max_index]), 0, len(y) - 1))
+
+    return x[index], y[index]
@@ -0,0 +1,198 @@
+import functools
+
+import numpy as np
+
+
+'''Wafer geometry: grid of the measurement positions of a dataset and results scattered on it'''
+
+
+@functools.lru_cache(maxsize=32)
+def _make_position_grid(x_bytes, y_bytes):
+    x_array = np.frombuffer(x_bytes)
+    y_array = np.frombuffer(y_bytes)
+    x_values, col_index = np.unique(x_array, return_inverse=True)
+    y_values, row_index = np.unique(y_array, return_inverse=True)
+
+    return x_values, y_values, row_index, col_index
+
+
+def get_position_grid(x_array, y_array):
+    """
+    Map every (x, y) position of a dataset to its (row, col) index on the heatmap grid. Mappings are cached, so that
+    they are only computed once per dataset.
+
+    Parameters:
+        x_array (array like): x position of every point
+        y_array (array like): y position of every point
+
+    Returns:
+        np.array: sorted unique x values (grid columns)
+        np.array: sorted unique y values (grid rows)
+        np.array: row index of every point
+        np.array: column index of every point
+    """
+    x_array = np.ascontiguousarray(x_array, dtype=np.float64)
+    y_array = np.ascontiguousarray(y_array, dtype=np.float64)
+
+    return _make_position_grid(x_array.tobytes(), y_array.tobytes())
+
+
+# Wafer geometry: measurement grids start at -40 mm with 5 mm steps, positions with |x| + |y| above 60 mm are outside
+# the wafer
+WAFER_GRID_START = -40
+WAFER_GRID_STEP = 5
+WAFER_EDGE = 60
+
+
+def is_on_wafer(x_pos, y_pos):
+    """
+    Check if positions are on the wafer, works with arrays
+
+    Parameters:
+        x_pos (float, np.array): x position (mm)
+        y_pos (float, np.array): y position (mm)
+
+    Returns:
+        bool, np.array: True for positions on the wafer
+    """
+    return np.abs(x_pos) + np.abs(y_pos) <= WAFER_EDGE
+
+
+def _grid_step(values):
+    steps = np.diff(values)
+    if len(steps) == 0:
+        return float(WAFER_GRID_STEP)
+    return float(steps.min())
+
+
+class WaferGrid:
+    """
+    Geometry of the measurement positions of a dataset: coordinates of every point, sorted grid columns and rows,
+    (row, col) index of every point on the grid and grid steps. Plotting and analysis functions use it to scatter point
+    values on dense grid planes without building dataframes.
+    """
+
+    __slots__ = ("x", "y", "x_values", "y_values", "row_index", "col_index", "step_x", "step_y")
+
+    def __init__(self, x_array, y_array):
+        self.x = np.ascontiguousarray(x_array, dtype=np.float64)
+        self.y = np.ascontiguousarray(y_array, dtype=np.float64)
+        self.x_values, self.y_values, self.row_index, self.col_index = get_position_grid(self.x, self.y)
+        self.step_x = _grid_step(self.x_values)
+        self.step_y = _grid_step(self.y_values)
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def shape(self):
+        return len(self.y_values), len(self.x_values)
+
+    @property
+    def positions(self):
+        return np.column_stack([self.x, self.y])
+
+    def to_plane(self, values):
+        """
+        Scatter one value per point on the grid
+
+        Parameters:
+            values (array like): value of every point, in the order of the grid points
+
+        Returns:
+            np.array: (rows, cols) plane, NaN where there is no point
+        """
+        plane = np.full(self.shape, np.nan)
+        plane[self.row_index, self.col_index] = values
+        return plane
+
+    def from_plane(self, plane):
+        """Gather the value of every point from a (rows, cols) plane, inverse of to_plane"""
+        return plane[self.row_index, self.col_index]
+
+    def neighbours(self, target_x, target_y):
+        """
+        Find the (up to) 8 neighbours of a position on the grid
+
+        Parameters:
+            target_x (float): x position
+            target_y (float): y position
+
+        Returns:
+            list: (x, y) of the neighbours existing in the dataset
+        """
+        col = np.searchsorted(self.x_values, target_x)
+        row = np.searchsorted(self.y_values, target_y)
+        if (col >= len(self.x_values) or row >= len(self.y_values) or self.x_values[col] != target_x
+                or self.y_values[row] != target_y):
+            return []
+
+        occupied = np.zeros(self.shape, dtype=bool)
+        occupied[self.row_index, self.col_index] = True
+        neighbours = []
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                neighbour_row, neighbour_col = row + d_row, col + d_col
+                if ((d_row, d_col) != (0, 0) and 0 <= neighbour_row < self.shape[0]
+                        and 0 <= neighbour_col < self.shape[1] and occupied[neighbour_row, neighbour_col]):
+                    neighbours.append((float(self.x_values[neighbour_col]), float(self.y_values[neighbour_row])))
+        return neighbours
+
+
+class WaferMap:
+    """
+    Results of a dataset on its WaferGrid: one dense NaN padded plane per numerical result and the plane of the
+    positions flagged as ignored
+    """
+
+    __slots__ = ("grid", "planes", "ignored")
+
+    def __init__(self, grid, planes, ignored=None):
+        self.grid = grid
+        self.planes = planes
+        self.ignored = np.zeros(grid.shape, dtype=bool) if ignored is None else ignored
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """
+        Build the map of a results dataframe (x_pos (mm), y_pos (mm), ignored and one column per result)
+
+        Parameters:
+            df (pd.DataFrame): output of a *_make_results_dataframe_from_hdf5 function
+
+        Returns:
+            WaferMap
+        """
+        grid = WaferGrid(df["x_pos (mm)"], df["y_pos (mm)"])
+        value_columns = [column for column in df.select_dtypes(include="number").columns
+                         if column not in ["x_pos (mm)", "y_pos (mm)", "ignored"]]
+        planes = {column: grid.to_plane(df[column].to_numpy(dtype=np.float64)) for column in value_columns}
+        ignored = None
+        if "ignored" in df.columns:
+            ignored = grid.to_plane(df["ignored"].to_numpy(dtype=np.float64)) == 1
+
+        return cls(grid, planes, ignored)
+
+    @property
+    def names(self):
+        return list(self.planes)
+
+    def plane(self, name, masking=False):
+        """
+        Plane of one result
+
+        Parameters:
+            name (str): result name
+            masking (bool): hide the positions flagged as ignored
+
+        Returns:
+            np.array: (rows, cols) plane
+        """
+        plane = self.planes[name]
+        if masking:
+            plane = np.where(self.ignored, np.nan, plane)
+        return plane
+
+    def values(self, name, masking=False):
+        """Value of one result at every point of the grid, see plane"""
+        return self.grid.from_plane(self.plane(name, masking))
@@ -6,7 +6,11 @@ Internal use for Institut Néel and within the MaMMoS project, to export and rea
 """
 
 import plotly.express as px
-from itertools import cycle
+from itertools import cycle, repeat
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scipy import sparse
+from scipy.signal import find_peaks, peak_widths
 
 from ..functions.functions_shared import *
 
@@ -16,13 +20,14 @@ def xrd_conditions(hdf5_path, *args, **kwargs):
         return False
     if not h5py.is_hdf5(hdf5_path):
         return False
-    with h5py.File(hdf5_path, "r") as hdf5_file:
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
         dataset_list = get_hdf5_datasets(hdf5_file, dataset_type="xrd")
         if len(dataset_list) == 0:
             return False
     return True
 
 
+@shared_cached
 def xrd_get_integrated_from_hdf5(xrd_group, target_x, target_y):
     position_group = get_target_position_group(xrd_group, target_x, target_y)
     measurement_group = position_group.get("measurement")
@@ -64,6 +69,525 @@ def xrd_get_image_from_hdf5(xrd_group, target_x, target_y):
     return image_array
 
 
+def xrd_make_image_pyramid(image_array, min_size=256):
+    """
+    Build a multi-resolution pyramid of a 2D image, each level being the 2x2 block mean of the previous one
+
+    Parameters:
+        image_array (np.array): full resolution 2D image
+        min_size (int): the pyramid stops once the largest dimension of a level is below this size
+
+    Returns:
+        list: [full resolution image, 1/2 image, 1/4 image, ...]
+    """
+    pyramid = [np.asarray(image_array)]
+    while max(pyramid[-1].shape) > min_size:
+        level = pyramid[-1].astype(np.float32)
+        # Pad odd dimensions with the edge values so that the level keeps covering the whole detector
+        level = np.pad(level, ((0, level.shape[0] % 2), (0, level.shape[1] % 2)), mode="edge")
+        pyramid.append(level.reshape(level.shape[0] // 2, 2, level.shape[1] // 2, 2).mean(axis=(1, 3)))
+
+    return pyramid
+
+
+@shared_cached
+def xrd_get_image_pyramid(xrd_group, target_x, target_y):
+    """
+    Return the image pyramid of a position. Pyramids are built on first view and kept in the shared cache, which is
+    bounded in size and keyed by the file revision, later views of an unchanged file only read the cache.
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group
+        target_x (float): x position
+        target_y (float): y position
+
+    Returns:
+        list: see xrd_make_image_pyramid
+    """
+    position_group = get_target_position_group(xrd_group, target_x, target_y)
+    image_dataset = xrd_get_image_dataset_from_hdf5(position_group, xrd_group.attrs["instrument"])
+
+    # ESRF datasets hold several frames, only the first one is displayed
+    image_array = image_dataset[0] if image_dataset.ndim == 3 else image_dataset[()]
+    return xrd_make_image_pyramid(image_array)
+
+
+def xrd_get_image_tile(pyramid, x_range=None, y_range=None, viewport_size=700):
+    """
+    Select the coarsest pyramid level that still fills the viewport for the requested area, and crop it
+
+    Parameters:
+        pyramid (list): see xrd_make_image_pyramid
+        x_range (list): [min, max] displayed range in full resolution pixels, whole image if None
+        y_range (list): [min, max] displayed range in full resolution pixels, whole image if None
+        viewport_size (int): size of the plot area in screen pixels
+
+    Returns:
+        np.array: cropped image tile
+        int: downsampling factor of the tile
+        tuple: (x, y) full resolution coordinates of the first pixel of the tile
+    """
+    height, width = pyramid[0].shape
+    if x_range is None:
+        x_range = [-0.5, width - 0.5]
+    if y_range is None:
+        y_range = [-0.5, height - 0.5]
+
+    span = min(x_range[1] - x_range[0], y_range[1] - y_range[0])
+    level = int(np.clip(np.floor(np.log2(max(span / viewport_size, 1))), 0, len(pyramid) - 1))
+    factor = 2 ** level
+
+    level_height, level_width = pyramid[level].shape
+    x_start = int(np.clip(np.floor((x_range[0] + 0.5) / factor), 0, level_width - 1))
+    x_stop = int(np.clip(np.ceil((x_range[1] + 0.5) / factor), x_start + 1, level_width))
+    y_start = int(np.clip(np.floor((y_range[0] + 0.5) / factor), 0, level_height - 1))
+    y_stop = int(np.clip(np.ceil((y_range[1] + 0.5) / factor), y_start + 1, level_height))
+
+    tile = pyramid[level][y_start:y_stop, x_start:x_stop]
+    origin = ((x_start + 0.5) * factor - 0.5, (y_start + 0.5) * factor - 0.5)
+
+    return tile, factor, origin
+
+
+def xrd_get_image_dataset_from_hdf5(position_group, instrument):
+    """
+    Return the 2D detector dataset of a position without reading it, so that it can be read by chunks
+
+    Parameters:
+        position_group (h5py.Group): position group within an XRD dataset
+        instrument (str): instrument attribute of the XRD dataset
+
+    Returns:
+        h5py.Dataset: (frames, y, x) stack for bm02 - esrf, (y, x) image for Rigaku Smartlab
+    """
+    measurement_group = position_group.get("measurement")
+
+    if instrument == "bm02 - esrf":
+        return measurement_group["CdTe"]
+    elif instrument == "Rigaku Smartlab":
+        return measurement_group["2Dimage"]
+    else:
+        raise KeyError(
+            "XRD instrument is neither bm02 - esrf nor Rigaku Smartlab, can not retrieve 2D image."
+        )
+
+
+def xrd_make_roi_mask(image_shape, roi_dict):
+    """
+    Make the boolean mask of a region of interest, cropped to the ROI bounding box
+
+    Parameters:
+        image_shape (tuple): (y, x) shape of the detector image
+        roi_dict (dict): {"type": "rectangle", "x_min", "x_max", "y_min", "y_max"}
+            or {"type": "annulus", "center_x", "center_y", "r_min", "r_max"}, in pixels
+
+    Returns:
+        tuple: (y slice, x slice) of the bounding box
+        np.array: boolean mask within the bounding box
+    """
+    y_size, x_size = image_shape[-2], image_shape[-1]
+
+    if roi_dict["type"] == "rectangle":
+        x_min, x_max = sorted([roi_dict["x_min"], roi_dict["x_max"]])
+        y_min, y_max = sorted([roi_dict["y_min"], roi_dict["y_max"]])
+    elif roi_dict["type"] == "annulus":
+        x_min, x_max = roi_dict["center_x"] - roi_dict["r_max"], roi_dict["center_x"] + roi_dict["r_max"]
+        y_min, y_max = roi_dict["center_y"] - roi_dict["r_max"], roi_dict["center_y"] + roi_dict["r_max"]
+    else:
+        raise KeyError(f"Unknown ROI type {roi_dict['type']}, must be rectangle or annulus")
+
+    bounding_box = (
+        slice(int(np.clip(np.floor(y_min), 0, y_size)), int(np.clip(np.ceil(y_max) + 1, 0, y_size))),
+        slice(int(np.clip(np.floor(x_min), 0, x_size)), int(np.clip(np.ceil(x_max) + 1, 0, x_size))),
+    )
+
+    y_grid, x_grid = np.mgrid[bounding_box[0], bounding_box[1]]
+    if roi_dict["type"] == "rectangle":
+        mask = (x_grid >= x_min) & (x_grid <= x_max) & (y_grid >= y_min) & (y_grid <= y_max)
+    else:
+        radius = np.hypot(x_grid - roi_dict["center_x"], y_grid - roi_dict["center_y"])
+        mask = (radius >= roi_dict["r_min"]) & (radius <= roi_dict["r_max"])
+
+    return bounding_box, mask
+
+
+def xrd_reduce_image_dataset(image_dataset, roi_list, chunk_frames=8):
+    """
+    Compute sum, maximum and centroid of every ROI over all frames of a detector dataset. Frames are read by chunks
+    and only within the bounding box of the ROIs, the whole stack is never loaded in memory.
+
+    Parameters:
+        image_dataset (h5py.Dataset or np.array): (frames, y, x) stack or single (y, x) image
+        roi_list (list): list of ROI dictionaries, see xrd_make_roi_mask. Each ROI needs a "name" key
+        chunk_frames (int): number of frames read at once
+
+    Returns:
+        dict: results_dict[roi_name] = {"sum", "max", "centroid_x", "centroid_y"}
+    """
+    single_frame = image_dataset.ndim == 2
+    nb_frames = 1 if single_frame else image_dataset.shape[0]
+
+    roi_masks = [xrd_make_roi_mask(image_dataset.shape, roi_dict) for roi_dict in roi_list]
+
+    # Union of all bounding boxes, the only part of the detector read from file
+    y_start = min(box[0].start for box, _ in roi_masks)
+    y_stop = max(box[0].stop for box, _ in roi_masks)
+    x_start = min(box[1].start for box, _ in roi_masks)
+    x_stop = max(box[1].stop for box, _ in roi_masks)
+
+    accumulators = [{"sum": 0.0, "max": -np.inf, "moment_x": 0.0, "moment_y": 0.0} for _ in roi_list]
+
+    for start in range(0, nb_frames, chunk_frames):
+        if single_frame:
+            chunk = np.asarray(image_dataset[y_start:y_stop, x_start:x_stop], dtype=np.float64)[np.newaxis]
+        else:
+            stop = min(start + chunk_frames, nb_frames)
+            chunk = np.asarray(image_dataset[start:stop, y_start:y_stop, x_start:x_stop], dtype=np.float64)
+
+        for accumulator, (box, mask) in zip(accumulators, roi_masks):
+            if not mask.any():
+                continue
+            y_slice = slice(box[0].start - y_start, box[0].stop - y_start)
+            x_slice = slice(box[1].start - x_start, box[1].stop - x_start)
+            roi_values = chunk[:, y_slice, x_slice][:, mask]
+            y_index, x_index = np.nonzero(mask)
+
+            frame_sum = roi_values.sum(axis=0)
+            accumulator["sum"] += frame_sum.sum()
+            accumulator["max"] = max(accumulator["max"], roi_values.max())
+            accumulator["moment_x"] += frame_sum @ (x_index + box[1].start)
+            accumulator["moment_y"] += frame_sum @ (y_index + box[0].start)
+
+    results_dict = {}
+    for roi_dict, accumulator in zip(roi_list, accumulators):
+        total = accumulator["sum"]
+        results_dict[roi_dict["name"]] = {
+            "sum": total,
+            "max": accumulator["max"] if np.isfinite(accumulator["max"]) else np.nan,
+            "centroid_x": accumulator["moment_x"] / total if total != 0 else np.nan,
+            "centroid_y": accumulator["moment_y"] / total if total != 0 else np.nan,
+        }
+
+    return results_dict
+
+
+def xrd_batch_roi_reduction(xrd_group, roi_list, chunk_frames=8, max_workers=None):
+    """
+    Reduce the 2D detector images of every position of a dataset to ROI sums, maxima and centroids, in parallel
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group
+        roi_list (list): list of ROI dictionaries, see xrd_make_roi_mask
+        chunk_frames (int): number of frames read at once, see xrd_reduce_image_dataset
+        max_workers (int): number of threads used for the reduction
+
+    Returns:
+        dict: results_dict[position][roi_name] = {"sum", "max", "centroid_x", "centroid_y"}
+    """
+    instrument = xrd_group.attrs["instrument"]
+    position_list = [position for position, _ in get_position_groups(xrd_group)]
+
+    def reduce_position(position):
+        image_dataset = xrd_get_image_dataset_from_hdf5(xrd_group[position], instrument)
+        return xrd_reduce_image_dataset(image_dataset, roi_list, chunk_frames)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results_list = list(executor.map(reduce_position, position_list))
+
+    return dict(zip(position_list, results_list))
+
+
+def xrd_get_detector_geometry_from_hdf5(position_group):
+    """
+    Read the detector geometry of a Rigaku Smartlab 2D image from the instrument/image header (d*TREK format)
+
+    Parameters:
+        position_group (h5py.Group): position group within a Rigaku Smartlab dataset
+
+    Returns:
+        dict: {"shape", "center_x", "center_y", "pixel_x", "pixel_y", "distance", "two_theta", "wavelength"}
+        center in pixels, pixel sizes and distance in mm, detector arm angle in degrees, wavelength in angstrom
+    """
+    header_group = position_group.get("instrument/image")
+    if header_group is None:
+        raise KeyError("No image header found in instrument group, can not get detector geometry")
+    header = {key: str(convert_bytes(value)) for key, value in hdf5_group_to_dict(header_group).items()}
+
+    try:
+        prefix = header["DETECTOR_NAMES"].split()[0]
+        center_x, center_y, pixel_x, pixel_y = [
+            float(value) for value in header[f"{prefix}SPATIAL_DISTORTION_INFO"].split()[:4]
+        ]
+        gonio_dict = dict(
+            zip(header[f"{prefix}GONIO_NAMES"].split(), [float(value) for value in header[f"{prefix}GONIO_VALUES"].split()])
+        )
+        distance = next(value for name, value in gonio_dict.items() if "Distance" in name)
+        two_theta = next(
+            (value for name, value in gonio_dict.items() if "Swing" in name or "TwoTheta" in name), 0.0
+        )
+        # SOURCE_WAVELENGTH is given as "number_of_wavelengths wavelength_1 ..."
+        wavelength = float(header["SOURCE_WAVELENGTH"].split()[1])
+    except (KeyError, StopIteration, ValueError, IndexError):
+        raise KeyError("Image header is incomplete, can not get detector geometry")
+
+    geometry = {
+        "shape": tuple(position_group["measurement/2Dimage"].shape),
+        "center_x": center_x,
+        "center_y": center_y,
+        "pixel_x": pixel_x,
+        "pixel_y": pixel_y,
+        "distance": distance,
+        "two_theta": two_theta,
+        "wavelength": wavelength,
+    }
+
+    return geometry
+
+
+def xrd_calc_pixel_angles(geometry):
+    """
+    Calculate the scattering angle and azimuthal angle of every detector pixel. The detector is normal to the beam
+    at the given distance, then rotated around the vertical axis by the detector arm angle.
+
+    Parameters:
+        geometry (dict): detector geometry, see xrd_get_detector_geometry_from_hdf5
+
+    Returns:
+        np.array: 2theta of every pixel (deg)
+        np.array: chi of every pixel (deg)
+    """
+    y_index, x_index = np.indices(geometry["shape"])
+    horizontal = (x_index - geometry["center_x"]) * geometry["pixel_x"]
+    vertical = (y_index - geometry["center_y"]) * geometry["pixel_y"]
+    arm_angle = np.radians(geometry["two_theta"])
+
+    # Pixel positions in the laboratory frame, beam along z
+    lab_x = horizontal * np.cos(arm_angle) + geometry["distance"] * np.sin(arm_angle)
+    lab_y = vertical
+    lab_z = -horizontal * np.sin(arm_angle) + geometry["distance"] * np.cos(arm_angle)
+
+    two_theta = np.degrees(np.arctan2(np.hypot(lab_x, lab_y), lab_z))
+    chi = np.degrees(np.arctan2(lab_y, lab_x))
+
+    return two_theta, chi
+
+
+def xrd_unwrap_chi(chi, nb_chi_bins=36):
+    """
+    Make the chi range covered by a detector continuous. Detectors straddling chi = ±180° get 360° added to the angles
+    past the largest gap in their coverage, the binned range then starts and ends at the edges of the detector.
+
+    Parameters:
+        chi (np.array): chi of every pixel (deg), see xrd_calc_pixel_angles
+        nb_chi_bins (int): number of bins along chi, gaps narrower than a bin are not cut
+
+    Returns:
+        np.array: chi of every pixel (deg), can exceed 180°
+    """
+    chi_sorted = np.sort(chi.ravel())
+    gaps = np.diff(chi_sorted)
+    largest = np.argmax(gaps)
+    wrap_gap = chi_sorted[0] + 360 - chi_sorted[-1]
+    # Detectors covering the full circle have no gap wider than a bin and keep the [-180°, 180°] range
+    if gaps[largest] <= max(wrap_gap, 360 / nb_chi_bins):
+        return chi
+    return np.where(chi <= chi_sorted[largest], chi + 360, chi)
+
+
+def xrd_make_integration_matrix(geometry, nb_radial_bins=1000, nb_chi_bins=36, unit="2th"):
+    """
+    Build the sparse matrix mapping every detector pixel to its (radial, chi) bin. Multiplying the matrix by a
+    flattened image gives the summed intensity of every bin of the caked image.
+
+    Parameters:
+        geometry (dict): detector geometry, see xrd_get_detector_geometry_from_hdf5
+        nb_radial_bins (int): number of bins along 2theta or q
+        nb_chi_bins (int): number of bins along chi
+        unit (str): radial unit, "2th" (deg) or "q" (A-1)
+
+    Returns:
+        scipy.sparse.csr_matrix: (nb_chi_bins * nb_radial_bins, number of pixels) binning matrix
+        np.array: radial bin centers
+        np.array: chi bin centers, see xrd_unwrap_chi
+    """
+    two_theta, chi = xrd_calc_pixel_angles(geometry)
+    chi = xrd_unwrap_chi(chi, nb_chi_bins)
+
+    if unit == "q":
+        radial = 4 * np.pi * np.sin(np.radians(two_theta) / 2) / geometry["wavelength"]
+    else:
+        radial = two_theta
+
+    radial_edges = np.linspace(radial.min(), radial.max(), nb_radial_bins + 1)
+    chi_edges = np.linspace(chi.min(), chi.max(), nb_chi_bins + 1)
+
+    radial_index = np.clip(np.digitize(radial.ravel(), radial_edges) - 1, 0, nb_radial_bins - 1)
+    chi_index = np.clip(np.digitize(chi.ravel(), chi_edges) - 1, 0, nb_chi_bins - 1)
+    bin_index = chi_index * nb_radial_bins + radial_index
+
+    matrix = sparse.csr_matrix(
+        (np.ones(radial.size), (bin_index, np.arange(radial.size))),
+        shape=(nb_chi_bins * nb_radial_bins, radial.size),
+    )
+
+    return matrix, (radial_edges[1:] + radial_edges[:-1]) / 2, (chi_edges[1:] + chi_edges[:-1]) / 2
+
+
+def xrd_get_integration_matrix(xrd_group, geometry, nb_radial_bins=1000, nb_chi_bins=36, unit="2th", matrix_dict=None):
+    """
+    Return the integration matrix for a detector geometry and bin settings. Matrices are cached in the
+    integration group of the dataset and only built when a new geometry or binning is requested. The file is only
+    read, the matrices used are added to matrix_dict to be stored by xrd_store_integration_matrices.
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group
+        geometry (dict): detector geometry, see xrd_get_detector_geometry_from_hdf5
+        nb_radial_bins (int): number of bins along 2theta or q
+        nb_chi_bins (int): number of bins along chi
+        unit (str): radial unit, "2th" or "q"
+        matrix_dict (dict, optional): filled with {key: (geometry, unit, matrix, radial_array, chi_array)}, None for
+            the matrices already stored
+
+    Returns:
+        scipy.sparse.csr_matrix, np.array, np.array: see xrd_make_integration_matrix
+    """
+    settings = sorted(geometry.items()) + [nb_radial_bins, nb_chi_bins, unit]
+    key = hashlib.md5(repr(settings).encode()).hexdigest()
+
+    integration_group = xrd_group.get("integration")
+    if integration_group is not None and key in integration_group:
+        if matrix_dict is not None:
+            matrix_dict[key] = None
+        matrix_group = integration_group[key]
+        matrix = sparse.csr_matrix(
+            (matrix_group["data"][()], matrix_group["indices"][()], matrix_group["indptr"][()]),
+            shape=tuple(matrix_group.attrs["matrix_shape"]),
+        )
+        return matrix, matrix_group["radial"][()], matrix_group["chi"][()]
+
+    matrix, radial_array, chi_array = xrd_make_integration_matrix(geometry, nb_radial_bins, nb_chi_bins, unit)
+    if matrix_dict is not None:
+        matrix_dict[key] = (geometry, unit, matrix, radial_array, chi_array)
+
+    return matrix, radial_array, chi_array
+
+
+def xrd_store_integration_matrices(xrd_group, matrix_dict):
+    """
+    Store the integration matrices built by xrd_get_integration_matrix in the integration group of the dataset. Only
+    the matrices of the last integration are kept, the others are deleted (their space is given back by
+    repack_hdf5). The file must be opened in append mode.
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group
+        matrix_dict (dict): {key: (geometry, unit, matrix, radial_array, chi_array)}, None for the stored matrices
+    """
+    integration_group = xrd_group.require_group("integration")
+    for key in list(integration_group.keys()):
+        if key not in matrix_dict:
+            del integration_group[key]
+
+    for key, matrix_entry in matrix_dict.items():
+        if matrix_entry is None or key in integration_group:
+            continue
+        geometry, unit, matrix, radial_array, chi_array = matrix_entry
+        matrix_group = integration_group.create_group(key)
+        matrix_group.attrs["matrix_shape"] = matrix.shape
+        matrix_group.attrs["unit"] = unit
+        for name, value in geometry.items():
+            matrix_group.attrs[name] = value
+        matrix_group.create_dataset("data", data=matrix.data.astype(np.float32), compression="gzip")
+        matrix_group.create_dataset("indices", data=matrix.indices, compression="gzip")
+        matrix_group.create_dataset("indptr", data=matrix.indptr, compression="gzip")
+        matrix_group["radial"] = radial_array
+        matrix_group["chi"] = chi_array
+    return None
+
+
+def xrd_batch_integrate_images(xrd_group, nb_radial_bins=1000, nb_chi_bins=36, unit="2th", batch_size=32,
+                               matrix_dict=None):
+    """
+    Azimuthally integrate the 2D images of every position of a Rigaku Smartlab dataset. Positions are grouped by
+    detector geometry and integrated by batches as a single sparse matrix product.
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group
+        nb_radial_bins (int): number of bins along 2theta or q
+        nb_chi_bins (int): number of bins along chi
+        unit (str): radial unit, "2th" or "q"
+        batch_size (int): number of images integrated at once
+        matrix_dict (dict, optional): filled with the integration matrices built, see xrd_get_integration_matrix
+
+    Returns:
+        dict: results_dict[position] = {"radial", "chi", "intensity", "caked", "unit"}
+    """
+    if xrd_group.attrs["instrument"] != "Rigaku Smartlab":
+        raise KeyError("Image integration is only available for Rigaku Smartlab datasets")
+
+    # Group positions sharing the same detector geometry
+    geometry_dict = {}
+    for position, position_group in get_position_groups(xrd_group):
+        geometry = xrd_get_detector_geometry_from_hdf5(position_group)
+        geometry_key = repr(sorted(geometry.items()))
+        geometry_dict.setdefault(geometry_key, (geometry, []))[1].append(position)
+
+    results_dict = {}
+    for geometry, position_list in geometry_dict.values():
+        matrix, radial_array, chi_array = xrd_get_integration_matrix(
+            xrd_group, geometry, nb_radial_bins, nb_chi_bins, unit, matrix_dict
+        )
+
+        # Number of pixels per bin, used to normalize summed intensities
+        pixel_counts = np.asarray(matrix.sum(axis=1)).ravel().reshape(nb_chi_bins, nb_radial_bins)
+        radial_counts = pixel_counts.sum(axis=0)
+
+        for start in range(0, len(position_list), batch_size):
+            batch = position_list[start : start + batch_size]
+            image_stack = np.stack(
+                [xrd_group[position]["measurement/2Dimage"][()].ravel() for position in batch], axis=1
+            ).astype(np.float64)
+
+            binned_stack = (matrix @ image_stack).T.reshape(len(batch), nb_chi_bins, nb_radial_bins)
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                caked_stack = np.where(pixel_counts > 0, binned_stack / pixel_counts, np.nan)
+                intensity_stack = np.where(radial_counts > 0, binned_stack.sum(axis=1) / radial_counts, np.nan)
+
+            for position, caked, intensity in zip(batch, caked_stack, intensity_stack):
+                results_dict[position] = {
+                    "radial": radial_array,
+                    "chi": chi_array,
+                    "intensity": intensity,
+                    "caked": caked,
+                    "unit": unit,
+                }
+
+    return results_dict
+
+
+@shared_cached
+def xrd_get_reintegrated_from_hdf5(xrd_group, target_x, target_y):
+    position_group = get_target_position_group(xrd_group, target_x, target_y)
+    integrated_group = position_group.get("results/integrated")
+    if integrated_group is None:
+        raise KeyError("No integrated images found, run image integration first")
+
+    measurement_dataframe = pd.DataFrame(
+        {"q": integrated_group["radial"][()], "intensity": integrated_group["intensity"][()]}
+    )
+
+    return measurement_dataframe
+
+
+def xrd_get_caked_from_hdf5(xrd_group, target_x, target_y):
+    position_group = get_target_position_group(xrd_group, target_x, target_y)
+    integrated_group = position_group.get("results/integrated")
+    if integrated_group is None:
+        raise KeyError("No integrated images found, run image integration first")
+
+    return integrated_group["radial"][()], integrated_group["chi"][()], integrated_group["caked"][()]
+
+
 def xrd_get_fits_from_hdf5(xrd_group, target_x, target_y):
     fits_dict = {}
     position_group = get_target_position_group(xrd_group, target_x, target_y)
@@ -84,21 +608,205 @@ def xrd_get_results_from_hdf5(xrd_group, target_x, target_y):
     return data_dict
 
 
+def xrd_get_all_integrated_from_hdf5(xrd_group):
+    """
+    Read every integrated pattern of a dataset in one pass. Patterns are put on the x-axis of the first position
+    (interpolating when needed) so that they can be stacked in a single 2D array.
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group
+
+    Returns:
+        list: position group names, in the same order as the rows of the intensity stack
+        np.array: common x-axis (q for bm02 - esrf, 2theta for Rigaku Smartlab)
+        np.array: intensity stack of shape (number of positions, number of points)
+    """
+    position_list = []
+    x_list = []
+    intensity_list = []
+
+    for position, position_group in get_position_groups(xrd_group):
+        measurement_group = position_group.get("measurement")
+
+        if xrd_group.attrs["instrument"] == "bm02 - esrf":
+            integrated_group = measurement_group.get("CdTe_integrate")
+            x_array = integrated_group["q"][()]
+            intensity_array = integrated_group["intensity"][0]
+        elif xrd_group.attrs["instrument"] == "Rigaku Smartlab":
+            x_array = measurement_group["angle"][()]
+            intensity_array = measurement_group["counts"][()]
+        else:
+            raise KeyError(
+                "XRD instrument is neither bm02 - esrf nor Rigaku Smartlab, can not retrieve integrated data."
+            )
+
+        position_list.append(position)
+        x_list.append(np.asarray(x_array, dtype=np.float64))
+        intensity_list.append(np.asarray(intensity_array, dtype=np.float64))
+
+    if not position_list:
+        return position_list, np.array([]), np.empty((0, 0))
+
+    x_array = x_list[0]
+    intensity_stack = np.empty((len(position_list), len(x_array)))
+    for idx, (x, intensity) in enumerate(zip(x_list, intensity_list)):
+        if len(x) == len(x_array) and np.allclose(x, x_array):
+            intensity_stack[idx] = intensity
+        else:
+            intensity_stack[idx] = np.interp(x_array, x, intensity, left=np.nan, right=np.nan)
+
+    return position_list, x_array, intensity_stack
+
+
+def xrd_estimate_background(intensity_stack, iterations=40):
+    """
+    Estimate the background of all patterns at once with the SNIP algorithm (Statistics-sensitive Non-linear
+    Iterative Peak-clipping). Every clipping iteration is applied to the whole stack.
+
+    Parameters:
+        intensity_stack (np.array): 1D pattern or 2D stack of patterns (positions, points)
+        iterations (int): half-width of the largest clipping window, in points. Should be larger than peak widths
+
+    Returns:
+        np.array: background, same shape as intensity_stack
+    """
+    stack = np.atleast_2d(np.nan_to_num(np.asarray(intensity_stack, dtype=np.float64)))
+    stack = np.clip(stack, 0, None)
+
+    # Log-log-square root operator to compress the dynamic range before clipping
+    lls = np.log(np.log(np.sqrt(stack + 1) + 1) + 1)
+
+    iterations = min(iterations, (stack.shape[1] - 1) // 2)
+    for k in range(1, iterations + 1):
+        neighbour_mean = (lls[:, : -2 * k] + lls[:, 2 * k :]) / 2
+        lls[:, k:-k] = np.minimum(lls[:, k:-k], neighbour_mean)
+
+    background = (np.exp(np.exp(lls) - 1) - 1) ** 2 - 1
+
+    return background.reshape(np.shape(intensity_stack))
+
+
+def xrd_find_peaks(x_array, net_intensity, prominence=None, min_width=3):
+    """
+    Find peaks on a background subtracted pattern, with position, height and FWHM for each of them
+
+    Parameters:
+        x_array (np.array): x-axis of the pattern
+        net_intensity (np.array): background subtracted intensity
+        prominence (float): minimum prominence of a peak, default is 10 times the estimated noise level
+        min_width (float): minimum width of a peak, in points
+
+    Returns:
+        dict: {"position": np.array, "height": np.array, "fwhm": np.array}
+    """
+    net_intensity = np.nan_to_num(net_intensity)
+    if prominence is None:
+        # Noise estimated from the median absolute deviation of the point to point differences
+        noise = np.median(np.abs(np.diff(net_intensity))) / 0.6745 / np.sqrt(2)
+        prominence = max(10 * noise, np.finfo(float).eps)
+
+    peak_indices, _ = find_peaks(net_intensity, prominence=prominence, width=min_width)
+    widths, _, left_ips, right_ips = peak_widths(net_intensity, peak_indices, rel_height=0.5)
+
+    # Convert interpolated indices to x-axis units
+    index_array = np.arange(len(x_array))
+    left_x = np.interp(left_ips, index_array, x_array)
+    right_x = np.interp(right_ips, index_array, x_array)
+
+    peaks_dict = {
+        "position": x_array[peak_indices],
+        "height": net_intensity[peak_indices],
+        "fwhm": np.abs(right_x - left_x),
+    }
+
+    return peaks_dict
+
+
+def _xrd_peak_search_chunk(x_array, intensity_chunk, prominence, iterations):
+    """Background removal and peak search of a chunk of patterns, run by the workers of xrd_batch_peak_search"""
+    net_chunk = intensity_chunk - xrd_estimate_background(intensity_chunk, iterations)
+    return [xrd_find_peaks(x_array, net, prominence) for net in net_chunk]
+
+
+def xrd_batch_peak_search(xrd_group, prominence=None, iterations=40, tolerance=None, min_fraction=0.1, chunk_size=64,
+                          max_workers=None):
+    """
+    Run a peak search on every integrated pattern of a dataset. Positions are split in chunks searched in parallel
+    processes (find_peaks holds the GIL), the background of every chunk is removed in one vectorized pass. Peaks found
+    across the whole map are grouped by position into reference peaks, giving consistent peak parameters from one
+    position to the next. Only reads the file, the results are written by xrd_peaks_dict_to_hdf5 in the parent.
+
+    Parameters:
+        xrd_group (h5py.Group): XRD dataset group
+        prominence (float): minimum prominence of a peak, see xrd_find_peaks
+        iterations (int): number of SNIP iterations, see xrd_estimate_background
+        tolerance (float): maximum gap between two peaks of the same group, default is the median FWHM
+        min_fraction (float): minimum fraction of positions in which a reference peak must be found
+        chunk_size (int): number of positions searched by one worker task, a single chunk is searched in process
+        max_workers (int): number of worker processes
+
+    Returns:
+        dict: results_dict[position] = {"peak_1": {"position", "height", "fwhm", "reference"}, ...}
+    """
+    position_list, x_array, intensity_stack = xrd_get_all_integrated_from_hdf5(xrd_group)
+    if not position_list:
+        return {}
+
+    chunk_list = [intensity_stack[start : start + chunk_size] for start in range(0, len(position_list), chunk_size)]
+    if len(chunk_list) == 1:
+        peaks_chunks = [_xrd_peak_search_chunk(x_array, chunk_list[0], prominence, iterations)]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            peaks_chunks = list(executor.map(
+                _xrd_peak_search_chunk, repeat(x_array), chunk_list, repeat(prominence), repeat(iterations)
+            ))
+    peaks_dict_list = [peaks_dict for peaks_chunk in peaks_chunks for peaks_dict in peaks_chunk]
+
+    # Flatten all detected peaks, keeping track of the position they belong to
+    row_array = np.concatenate([np.full(len(peaks["position"]), row) for row, peaks in enumerate(peaks_dict_list)])
+    all_peaks = {key: np.concatenate([peaks[key] for peaks in peaks_dict_list]) for key in ["position", "height", "fwhm"]}
+
+    results_dict = {position: {} for position in position_list}
+    if len(row_array) == 0:
+        return results_dict
+
+    # Group peaks into references by splitting the sorted peak positions where the gap exceeds the tolerance
+    if tolerance is None:
+        tolerance = np.median(all_peaks["fwhm"])
+    order = np.argsort(all_peaks["position"])
+    label_array = np.empty(len(order), dtype=int)
+    label_array[order] = np.concatenate([[0], np.cumsum(np.diff(all_peaks["position"][order]) > tolerance)])
+
+    reference_number = 0
+    for label in np.unique(label_array):
+        in_group = label_array == label
+        if len(np.unique(row_array[in_group])) < min_fraction * len(position_list):
+            continue
+        reference_number += 1
+        reference = np.median(all_peaks["position"][in_group])
+
+        for row, position in enumerate(position_list):
+            result = {"position": np.nan, "height": np.nan, "fwhm": np.nan, "reference": reference}
+            candidates = np.flatnonzero(in_group & (row_array == row))
+            if len(candidates) > 0:
+                # Keep the highest peak if several peaks of a single pattern fall in the same group
+                best = candidates[np.argmax(all_peaks["height"][candidates])]
+                result.update({key: all_peaks[key][best] for key in ["position", "height", "fwhm"]})
+            results_dict[position][f"peak_{reference_number}"] = result
+
+    return results_dict
+
+
+@shared_cached
 def xrd_make_results_dataframe_from_hdf5(xrd_group):
     OPTIONS_LIST = ["A", "C", "phase_fraction", "Rwp"]
 
     data_dict_list = []
 
-    for position, position_group in xrd_group.items():
-        if position == "alignment_scans":
-            continue
+    for position, position_group in get_position_groups(xrd_group):
         instrument_group = position_group.get("instrument")
         # Exclude spots outside the wafer
-        if (
-            np.abs(instrument_group["x_pos"][()])
-            + np.abs(instrument_group["y_pos"][()])
-            <= 60
-        ):
+        if is_on_wafer(instrument_group["x_pos"][()], instrument_group["y_pos"][()]):
 
             data_dict = {
                 "x_pos (mm)": instrument_group["x_pos"][()],
@@ -127,6 +835,31 @@ def xrd_make_results_dataframe_from_hdf5(xrd_group):
 
                             data_dict[f"[{phase}]_{value}_({units})"] = dataset
 
+            # Check in peaks for the results of the batch peak search, the reference position of every peak is a
+            # column of its own so that the column names do not change when the peak search is run again
+            peaks_group = position_group.get("results/peaks")
+            if peaks_group is not None:
+                for peak, peak_group in peaks_group.items():
+                    for value, value_group in peak_group.items():
+                        if "units" in value_group.attrs:
+                            units = value_group.attrs["units"]
+                        else:
+                            units = "arb"
+                        data_dict[f"[{peak}]_{value}_({units})"] = value_group[()]
+                    position_units = peak_group["position"].attrs.get("units", "arb")
+                    data_dict[f"[{peak}]_reference_({position_units})"] = peak_group.attrs["reference"]
+
+            # Check in roi for the results of the ROI reduction of 2D images
+            roi_group = position_group.get("results/roi")
+            if roi_group is not None:
+                for roi, roi_subgroup in roi_group.items():
+                    for value, value_group in roi_subgroup.items():
+                        if "units" in value_group.attrs:
+                            units = value_group.attrs["units"]
+                        else:
+                            units = "arb"
+                        data_dict[f"[roi {roi}]_{value}_({units})"] = value_group[()]
+
             data_dict_list.append(data_dict)
 
             # Check in R_coefficients for Rwp
@@ -147,14 +880,17 @@ def xrd_make_results_dataframe_from_hdf5(xrd_group):
     return result_dataframe
 
 
-def xrd_plot_integrated_from_dataframe(fig, df):
+def xrd_plot_integrated_from_dataframe(fig, df, x_range=None):
     fig.update_xaxes(title_text="q (A-1)")
     fig.update_yaxes(title_text="Counts")
 
+    # Decimate the pattern to the screen resolution, keeping only the zoomed range if specified
+    q, intensity = decimate_trace(df["q"], df["intensity"], x_range=x_range)
+
     fig.add_trace(
         go.Scatter(
-            x=df["q"],
-            y=df["intensity"],
+            x=q,
+            y=intensity,
             mode="lines",
             line=dict(color="SlateBlue", width=2),
         )
@@ -166,12 +902,11 @@ def xrd_plot_integrated_from_dataframe(fig, df):
 def xrd_plot_fits_from_dataframe(fig, df, fits=None):
     colors = cycle(px.colors.qualitative.Plotly)
 
-    if not fits:
-        fits = df.columns[1:]
     fig.update_xaxes(title_text="2th (°)")
     fig.update_yaxes(title_text="Counts")
 
-    for fit in fits:
+    # Every fit is plotted, unselected ones are hidden so that selection changes can be patched on the figure
+    for fit in df.columns[1:]:
         fig.add_trace(
             go.Scatter(
                 x=df["Angle"],
@@ -179,12 +914,79 @@ def xrd_plot_fits_from_dataframe(fig, df, fits=None):
                 mode="lines",
                 line=dict(color=next(colors), width=2),
                 name=fit,
+                visible=not fits or fit in fits,
             )
         )
     return fig
 
 
-def xrd_plot_image_from_array(array, z_min, z_max):
+def xrd_plot_image_from_pyramid(pyramid, z_min, z_max, x_range=None, y_range=None):
+    """
+    Plot a 2D detector image from its pyramid. Only the tile matching the displayed area is sent to the browser,
+    colour mapped on the server as a PNG.
+
+    Parameters:
+        pyramid (list): see xrd_make_image_pyramid
+        z_min (float): colorbar minimum, image minimum if None
+        z_max (float): colorbar maximum, image maximum if None
+        x_range (list): [min, max] displayed range in pixels, whole image if None
+        y_range (list): [min, max] displayed range in pixels, whole image if None
+
+    Returns:
+        go.Figure: image figure
+    """
+    height, width = pyramid[0].shape
+    if z_min is None:
+        z_min = np.nanmin(pyramid[0])
+    if z_max is None:
+        z_max = np.nanmax(pyramid[0])
+    if x_range is None:
+        x_range = [-0.5, width - 0.5]
+    if y_range is None:
+        y_range = [-0.5, height - 0.5]
+
+    tile, factor, origin = xrd_get_image_tile(pyramid, x_range, y_range)
+
+    fig = go.Figure()
+    # Invisible heatmap only used to carry the colorbar, go.Image does not have one
+    fig.add_trace(
+        go.Heatmap(
+            z=[[z_min, z_max]],
+            x=[origin[0], origin[0]],
+            y=[origin[1]],
+            zmin=z_min,
+            zmax=z_max,
+            opacity=0,
+            hoverinfo="skip",
+            colorscale="Plasma",
+            colorbar=colorbar_layout(z_min, z_max, precision=0, title="count"),
+        )
+    )
+    fig.add_trace(
+        go.Image(
+            source=array_to_png(tile, z_min, z_max),
+            x0=origin[0],
+            y0=origin[1],
+            dx=factor,
+            dy=factor,
+            hoverinfo="x+y",
+        )
+    )
+
+    fig.update_layout(
+        title="Image",
+        xaxis=dict(title="x", range=x_range, showgrid=False),
+        yaxis=dict(title="y", range=y_range, autorange=False, showgrid=False),
+        height=800,
+        width=800,
+        margin=dict(r=100, t=100),
+        uirevision="image",
+    )
+
+    return fig
+
+
+def xrd_plot_image_from_array(array, z_min, z_max, x=None, y=None, title="Image", x_title="x", y_title="y"):
     if z_min is None:
         z_min = np.nanmin(array)
     if z_max is None:
@@ -194,15 +996,17 @@ def xrd_plot_image_from_array(array, z_min, z_max):
     fig = go.Figure(
         data=go.Heatmap(
             z=array,
+            x=x,
+            y=y,
             colorscale="Plasma",
             colorbar=colorbar_layout(z_min, z_max, precision=0, title="count"),
         )
     )
 
     fig.update_layout(
-        title="Image",
-        xaxis_title="x",
-        yaxis_title="y",
+        title=title,
+        xaxis_title=x_title,
+        yaxis_title=y_title,
         height=800,
         width=800,
         margin=dict(r=100, t=100),
@@ -3,6 +3,7 @@ from pathlib import Path
 import h5py
 
 from ..functions.functions_hdf5 import *
+from ..functions.functions_shared import open_hdf5
 
 
 def convertFloat(item):
@@ -127,7 +128,7 @@ def create_new_hdf5(hdf5_path, sample_metadata):
     Returns:
         None
     """
-    with h5py.File(hdf5_path, "x") as hdf5_file:
+    with open_hdf5(hdf5_path, "x", libver="latest") as hdf5_file:
         hdf5_file.attrs["HT_class"] = "HTroot"
 
         sample = hdf5_file.create_group("sample")
@@ -123,7 +123,8 @@ def get_position_from_path(filepath):
     return int(x_idx), int(y_idx)
 
 
-def calculate_wafer_positions(scan_numbers, step_x=5, step_y=5, start_x=-40, start_y=-40):
+def calculate_wafer_positions(scan_numbers, step_x=WAFER_GRID_STEP, step_y=WAFER_GRID_STEP, start_x=WAFER_GRID_START,
+                              start_y=WAFER_GRID_START):
     """
     Calculates the wafer positions based on scan numbers and specified step and start values.
 
@@ -266,7 +267,7 @@ def write_edx_to_hdf5(hdf5_path, source_path, dataset_name = None):
     if dataset_name is None:
         dataset_name = source_path.stem
 
-    with h5py.File(hdf5_path, "a") as hdf5_file:
+    with open_hdf5(hdf5_path, "a") as hdf5_file:
         edx_group = hdf5_file.create_group(f"{dataset_name}")
         edx_group.attrs["HT_type"] = "edx"
         edx_group.attrs["instrument"] = "Bruker Quantax Xflash-7"
@@ -150,7 +150,7 @@ def write_esrf_to_hdf5(hdf5_path, source_path, dataset_name):
     if raw_h5_path is None:
         raise NameError("Couldn't locate RAW_DATA H5 file")
 
-    with h5py.File(hdf5_path, "a") as hdf5_file:
+    with open_hdf5(hdf5_path, "a") as hdf5_file:
         with h5py.File(raw_h5_path, "r") as raw_source:
             esrf_group = hdf5_file.create_group(dataset_name)
             esrf_group.attrs["HT_type"] = "xrd"
@@ -261,7 +261,7 @@ def write_xrd_results_to_hdf5(hdf5_path, results_folderpath, target_dataset):
     if isinstance(results_folderpath, str):
         results_folderpath = Path(results_folderpath)
 
-    with h5py.File(hdf5_path, "a") as target:
+    with open_hdf5(hdf5_path, "a") as target:
 
         if target_dataset not in target:
             raise NameError("Couldn't locate target dataset")
@@ -271,7 +271,7 @@ def write_xrd_results_to_hdf5(hdf5_path, results_folderpath, target_dataset):
         for lst_filepath in safe_rglob(results_folderpath, pattern="*.lst"):
             dia_filepath = lst_filepath.with_suffix(".dia")
             file_index = str(lst_filepath.stem).split("_")[-1]
-            for name, group in target_group.items():
+            for name, group in get_position_groups(target_group):
                 if name == "alignment_scans":
                     continue
                 else:
@@ -236,7 +236,7 @@ def write_moke_to_hdf5(hdf5_path, source_path, dataset_name = None, mode="a"):
             file_path = source_path / file_name
             grouped_dict[p_number].append(file_path)  # Dictionary with measurements grouped by p_numbers
 
-    with h5py.File(hdf5_path, mode) as hdf5_file:
+    with open_hdf5(hdf5_path, mode) as hdf5_file:
         # Create the root group for the measurement
         moke_group = hdf5_file.create_group(f"{dataset_name}")
         moke_group.attrs["HT_type"] = "moke"
@@ -341,20 +341,22 @@ def write_moke_to_hdf5(hdf5_path, source_path, dataset_name = None, mode="a"):
 
 
 
-def moke_results_dict_to_hdf5(moke_group, results_dict, treatment_dict=None):
+def moke_results_dict_to_hdf5(moke_group, results_dict, treatment_dict=None, fit_keys=None):
     if treatment_dict is None:
         treatment_dict = {}
+    if fit_keys is None:
+        fit_keys = {}
 
     for position in list(moke_group.keys()):
         if "scan_parameters" in position:
             continue
         position_group = moke_group[position]
+        # Positions skipped by moke_batch_fit get back their stored results
+        if position not in results_dict.keys() and position in fit_keys:
+            activate_fit_results(position_group, fit_keys[position])
         if position in results_dict.keys():
 
-            if "results" in position_group:
-                del position_group["results"]
-
-            results_group = position_group.create_group("results")
+            results_group = create_fit_results_group(position_group, fit_keys.get(position))
             parameters_group = results_group.create_group("parameters")
             for key, value in treatment_dict.items():
                 current_group = parameters_group.create_dataset(key, data=value)
@@ -34,8 +34,8 @@ def read_data_from_dektak(file_path, header_length=46):
 def position_from_tuple(scan_number):
     pattern = r"\((\d+),(\d+)\)"
     match = re.search(pattern, scan_number)
-    x = (int(match.group(2)) - 10) * 5  # Header tuple has the format (y,x)
-    y = (10 - int(match.group(1))) * 5
+    x = (int(match.group(2)) - 10) * WAFER_GRID_STEP  # Header tuple has the format (y,x)
+    y = (10 - int(match.group(1))) * WAFER_GRID_STEP
     return x, y
 
 
@@ -67,7 +67,7 @@ def write_dektak_to_hdf5(hdf5_path, source_path, dataset_name=None, mode="a"):
     if dataset_name is None:
         dataset_name = source_path.stem
 
-    with h5py.File(hdf5_path, mode) as hdf5_file:
+    with open_hdf5(hdf5_path, mode) as hdf5_file:
         # Create the root group for the measurement
         profil_group = hdf5_file.create_group(f"{dataset_name}")
         profil_group.attrs["HT_type"] = "profil"
@@ -111,11 +111,8 @@ def write_dektak_to_hdf5(hdf5_path, source_path, dataset_name=None, mode="a"):
     return None
 
 
-def write_dektak_results_to_hdf5(position_group, results_dict, overwrite=True):
-    if overwrite and "results" in position_group:
-        del position_group["results"]
-
-    results = safe_create_new_subgroup(position_group, "results")
+def write_dektak_results_to_hdf5(position_group, results_dict, overwrite=True, fit_key=None):
+    results = create_fit_results_group(position_group, fit_key, overwrite)
     if "fit_parameters" in results_dict.keys():
         results.attrs["type"] = "fitted"
         for key, result in results_dict.items():
@@ -132,6 +129,23 @@ def write_dektak_results_to_hdf5(position_group, results_dict, overwrite=True):
     return None
 
 
+def write_dektak_manual_height_to_hdf5(position_group, measured_height):
+    """
+    Replace the measured height of a position by a manual value, the other results (fits) are kept
+
+    Parameters:
+        position_group (h5py.Group): position group
+        measured_height (float): height in nm
+    """
+    results = create_fit_results_group(position_group, overwrite=False)
+    if "measured_height" in results:
+        del results["measured_height"]
+    results.attrs["type"] = "manual"
+    results["measured_height"] = measured_height
+    results["measured_height"].attrs["units"] = "nm"
+    return None
+
+
 def update_dektak_hdf5(dektak_group):
     """
     Function to update an old version of a profilometry group to specs of newer versions.
@@ -151,7 +165,7 @@ def update_dektak_hdf5(dektak_group):
 
     if source_version < 0.2:
         # Version 0.2 added manual vs fitted tags to results groups
-        for position, position_group in dektak_group.items():
+        for position, position_group in get_position_groups(dektak_group):
             results_group = position_group.get("results")
             if results_group:
                 if "type" not in results_group.attrs:
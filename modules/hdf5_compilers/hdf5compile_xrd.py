@@ -187,7 +187,7 @@ def write_smartlab_to_hdf5(hdf5_path, source_path, dataset_name, mode="a"):
     if dataset_name is None:
         dataset_name = source_path.stem
 
-    with h5py.File(hdf5_path, mode) as hdf5_file:
+    with open_hdf5(hdf5_path, mode) as hdf5_file:
         xrd_group = hdf5_file.create_group(dataset_name)
         xrd_group.attrs["HT_type"] = "xrd"
         xrd_group.attrs["instrument"] = "Rigaku Smartlab"
@@ -248,3 +248,119 @@ def write_smartlab_to_hdf5(hdf5_path, source_path, dataset_name, mode="a"):
             measurement_group.create_dataset("2Dimage", img_data.shape, data=img_data)
 
     return None
+
+
+def xrd_peaks_dict_to_hdf5(xrd_group, results_dict, parameters_dict=None):
+    """
+    Writes the results of xrd_batch_peak_search to the results/peaks group of every position.
+    Previous peak search results are overwritten, other results (refinements, fits) are kept.
+
+    Args:
+        xrd_group (h5py.Group): The XRD dataset group
+        results_dict (dict): Dictionary generated by functions_xrd.xrd_batch_peak_search
+        parameters_dict (dict, optional): Peak search parameters to store alongside the results
+
+    Returns:
+        None
+    """
+    if parameters_dict is None:
+        parameters_dict = {}
+
+    if xrd_group.attrs["instrument"] == "bm02 - esrf":
+        position_units = "A-1"
+    else:
+        position_units = "deg"
+
+    for position, position_results in results_dict.items():
+        position_group = xrd_group[position]
+        results_group = safe_create_new_subgroup(position_group, "results")
+
+        if "peaks" in results_group:
+            del results_group["peaks"]
+
+        peaks_group = results_group.create_group("peaks")
+        for key, value in parameters_dict.items():
+            if value is not None:
+                peaks_group.attrs[key] = value
+
+        for peak, peak_dict in position_results.items():
+            peak_group = peaks_group.create_group(peak)
+            peak_group.attrs["reference"] = peak_dict["reference"]
+            peak_group["position"] = peak_dict["position"]
+            peak_group["height"] = peak_dict["height"]
+            peak_group["fwhm"] = peak_dict["fwhm"]
+            peak_group["position"].attrs["units"] = position_units
+            peak_group["height"].attrs["units"] = "counts"
+            peak_group["fwhm"].attrs["units"] = position_units
+
+    return None
+
+
+def xrd_roi_dict_to_hdf5(xrd_group, results_dict, roi_list):
+    """
+    Writes the results of xrd_batch_roi_reduction to the results/roi group of every position.
+    A ROI is overwritten if it already exists, other ROIs are kept.
+
+    Args:
+        xrd_group (h5py.Group): The XRD dataset group
+        results_dict (dict): Dictionary generated by functions_xrd.xrd_batch_roi_reduction
+        roi_list (list): ROI definitions used for the reduction, stored as attributes of each ROI group
+
+    Returns:
+        None
+    """
+    units_dict = {"sum": "counts", "max": "counts", "centroid_x": "px", "centroid_y": "px"}
+
+    for position, position_results in results_dict.items():
+        position_group = xrd_group[position]
+        results_group = safe_create_new_subgroup(position_group, "results")
+        roi_group = safe_create_new_subgroup(results_group, "roi")
+
+        for roi_dict in roi_list:
+            roi_name = roi_dict["name"]
+            if roi_name in roi_group:
+                del roi_group[roi_name]
+
+            roi_subgroup = roi_group.create_group(roi_name)
+            for key, value in roi_dict.items():
+                roi_subgroup.attrs[key] = value
+
+            for value, result in position_results[roi_name].items():
+                roi_subgroup[value] = result
+                roi_subgroup[value].attrs["units"] = units_dict[value]
+
+    return None
+
+
+def xrd_integrated_dict_to_hdf5(xrd_group, results_dict):
+    """
+    Writes the results of xrd_batch_integrate_images to the results/integrated group of every position.
+    Previous integration results are overwritten.
+
+    Args:
+        xrd_group (h5py.Group): The XRD dataset group
+        results_dict (dict): Dictionary generated by functions_xrd.xrd_batch_integrate_images
+
+    Returns:
+        None
+    """
+    for position, position_results in results_dict.items():
+        position_group = xrd_group[position]
+        results_group = safe_create_new_subgroup(position_group, "results")
+
+        if "integrated" in results_group:
+            del results_group["integrated"]
+
+        integrated_group = results_group.create_group("integrated")
+        integrated_group.attrs["unit"] = position_results["unit"]
+        integrated_group["radial"] = position_results["radial"]
+        integrated_group["chi"] = position_results["chi"]
+        integrated_group["intensity"] = position_results["intensity"]
+        integrated_group.create_dataset("caked", data=position_results["caked"], compression="gzip")
+
+        integrated_group["radial"].attrs["units"] = "A-1" if position_results["unit"] == "q" else "deg"
+        integrated_group["chi"].attrs["units"] = "deg"
+        integrated_group["intensity"].attrs["units"] = "counts"
+        integrated_group["caked"].attrs["units"] = "counts"
+
+    return None
@@ -1,12 +1,11 @@
 from dash import html, dcc
 import dash_bootstrap_components as dbc
-import os
 
 # "https://github.com/eliasdabbas/dash-file-browser"
 
 
 class WidgetsBROWSER:
-    def __init__(self):
+    def __init__(self, data_folder_root):
 
         self.browser = html.Div(
             children=[
@@ -15,7 +14,7 @@ class WidgetsBROWSER:
                         dbc.Col(lg=1, sm=1, md=1),
                         dbc.Col(
                             [
-                                dcc.Store(id="stored_cwd", data=os.getcwd()),
+                                dcc.Store(id="stored_cwd", data=data_folder_root),
                                 html.Hr(),
                                 html.Br(),
                                 html.H4(
@@ -27,7 +26,7 @@ class WidgetsBROWSER:
                                         )
                                     )
                                 ),
-                                html.H3([html.Code(os.getcwd(), id="cwd")]),
+                                html.H3([html.Code(data_folder_root, id="cwd")]),
                                 html.Br(),
                                 html.Br(),
                                 html.Div(
@@ -0,0 +1,141 @@
+"""
+Class containing all Dash items and layout information for the catalogue tab
+"""
+
+import os
+
+from dash import html, dcc, dash_table
+
+
+class WidgetsCATALOGUE:
+    def __init__(self, cache_folder_root):
+        self.catalogue_path = os.path.join(cache_folder_root, "catalogue.sqlite")
+
+        # Search conditions, one row per condition: quantity, operator, value
+        condition_children = []
+        for index in range(3):
+            condition_children += [
+                html.Div(
+                    className=f"subgrid-{3 * index + 1}",
+                    children=[
+                        dcc.Dropdown(
+                            id=f"catalogue_quantity_{index}",
+                            className="long-item",
+                            options=[],
+                            placeholder="Quantity",
+                        )
+                    ],
+                ),
+                html.Div(
+                    className=f"subgrid-{3 * index + 2}",
+                    children=[
+                        dcc.Dropdown(
+                            id=f"catalogue_operator_{index}",
+                            options=[">", ">=", "<", "<=", "=", "!="],
+                            value=">",
+                            clearable=False,
+                        )
+                    ],
+                ),
+                html.Div(
+                    className=f"subgrid-{3 * index + 3}",
+                    children=[
+                        dcc.Input(
+                            id=f"catalogue_value_{index}",
+                            className="long-item",
+                            type="number",
+                            placeholder="Value",
+                            value=None,
+                        )
+                    ],
+                ),
+            ]
+
+        self.catalogue_left = html.Div(
+            className="subgrid top-left",
+            children=condition_children,
+        )
+
+        # Widget for the text box
+        self.catalogue_center = html.Div(
+            className="textbox top-center",
+            children=[
+                html.Div(
+                    className="text-top",
+                    children=[html.Span(children="", id="catalogue_path_box")],
+                ),
+                html.Div(
+                    className="text-mid",
+                    children=[html.Span(children="", id="catalogue_text_box")],
+                ),
+                html.Div(
+                    className="text-7",
+                    children=[html.Button(id="catalogue_update_button", children="Update catalogue", n_clicks=0)],
+                ),
+                html.Div(
+                    className="text-8",
+                    children=[html.Button(id="catalogue_cancel_button", children="Cancel", n_clicks=0,
+                                          style={"display": "none"})],
+                ),
+                html.Div(
+                    className="text-9",
+                    children=[html.Button(id="catalogue_search_button", children="Search", n_clicks=0)],
+                ),
+            ],
+        )
+
+        # Catalogue content by dataset type
+        self.catalogue_right = html.Div(
+            className="top-right",
+            children=[
+                html.Label("Catalogue content"),
+                dash_table.DataTable(id="catalogue_summary_table", data=[], columns=[], page_size=6),
+            ],
+        )
+
+        # Matching positions
+        self.catalogue_table = html.Div(
+            [dash_table.DataTable(id="catalogue_results_table", data=[], columns=[], page_size=20,
+                                  sort_action="native", style_table={"overflowX": "auto"})],
+            className="plot-left",
+        )
+
+        self.catalogue_plot = html.Div(
+            [dcc.Graph(id="catalogue_plot")], className="plot-right"
+        )
+
+        # Stored variables
+        self.catalogue_stores = html.Div(
+            children=[
+                dcc.Store(id="catalogue_db_path", data=self.catalogue_path),
+            ]
+        )
+
+    def make_tab_from_widgets(self):
+        catalogue_tab = dcc.Tab(
+            id="catalogue",
+            label="Catalogue",
+            value="catalogue",
+            children=[html.Div(children=[
+                dcc.Loading(
+                    id="loading_catalogue",
+                    type="default",
+                    delay_show=500,
+                    children=[
+                        html.Div(
+                            [
+                                self.catalogue_left,
+                                self.catalogue_center,
+                                self.catalogue_right,
+                                self.catalogue_table,
+                                self.catalogue_plot,
+                                self.catalogue_stores
+                            ],
+                            className="grid-container",
+                        )
+                    ]
+                )
+            ])]
+        )
+
+        return catalogue_tab
@@ -0,0 +1,165 @@
+"""
+Class containing all Dash items and layout information for the comparison tab
+"""
+
+import os
+
+from dash import html, dcc
+
+
+class WidgetsCOMPARISON:
+    def __init__(self, cache_folder_root):
+        # Same catalogue as the catalogue tab
+        self.catalogue_path = os.path.join(cache_folder_root, "catalogue.sqlite")
+
+        # Quantity, maps and colour range selection
+        self.comparison_left = html.Div(
+            className="subgrid top-left",
+            children=[
+                html.Div(
+                    className="subgrid-1",
+                    children=[html.Label("Quantity")],
+                ),
+                html.Div(
+                    className="subgrid-2",
+                    children=[
+                        dcc.Dropdown(
+                            id="comparison_quantity",
+                            className="long-item",
+                            options=[],
+                            placeholder="Quantity",
+                        )
+                    ],
+                ),
+                html.Div(
+                    className="subgrid-3",
+                    children=[
+                        dcc.Input(
+                            id="comparison_columns",
+                            className="long-item",
+                            type="number",
+                            min=1,
+                            step=1,
+                            value=5,
+                            placeholder="Maps per row",
+                        )
+                    ],
+                ),
+                # Maps to compare, all wafers when empty
+                html.Div(
+                    className="subgrid-4",
+                    style={"gridColumn": "1 / span 3"},
+                    children=[
+                        dcc.Dropdown(
+                            id="comparison_entries",
+                            options=[],
+                            value=[],
+                            multi=True,
+                            placeholder="All wafers",
+                        )
+                    ],
+                ),
+                html.Div(
+                    className="subgrid-7",
+                    children=[
+                        dcc.RadioItems(
+                            id="comparison_range_mode",
+                            options=[
+                                {"label": "2-98 %", "value": "percentile"},
+                                {"label": "Min-max", "value": "full"},
+                                {"label": "Manual", "value": "manual"},
+                            ],
+                            value="percentile",
+                        )
+                    ],
+                ),
+                html.Div(
+                    className="subgrid-8",
+                    children=[
+                        dcc.Input(
+                            id="comparison_z_min",
+                            className="long-item",
+                            type="number",
+                            placeholder="z_min",
+                            value=None,
+                        )
+                    ],
+                ),
+                html.Div(
+                    className="subgrid-9",
+                    children=[
+                        dcc.Input(
+                            id="comparison_z_max",
+                            className="long-item",
+                            type="number",
+                            placeholder="z_max",
+                            value=None,
+                        )
+                    ],
+                ),
+            ],
+        )
+
+        # Widget for the text box
+        self.comparison_center = html.Div(
+            className="textbox top-center",
+            children=[
+                html.Div(
+                    className="text-top",
+                    children=[html.Span(children="", id="comparison_path_box")],
+                ),
+                html.Div(
+                    className="text-mid",
+                    children=[html.Span(children="", id="comparison_text_box")],
+                ),
+                html.Div(
+                    className="text-9",
+                    children=[html.Button(id="comparison_button", children="Compare", n_clicks=0)],
+                ),
+            ],
+        )
+
+        # Summary of the selected maps
+        self.comparison_right = html.Div(
+            className="top-right",
+            children=[html.Span(children="", id="comparison_range_box")],
+        )
+
+        self.comparison_plot = html.Div(
+            [dcc.Graph(id="comparison_plot", style={"width": "100%"})], className="comparison-map"
+        )
+
+        # Stored variables
+        self.comparison_stores = html.Div(
+            children=[
+                dcc.Store(id="comparison_db_path", data=self.catalogue_path),
+            ]
+        )
+
+    def make_tab_from_widgets(self):
+        comparison_tab = dcc.Tab(
+            id="comparison",
+            label="Comparison",
+            value="comparison",
+            children=[html.Div(children=[
+                dcc.Loading(
+                    id="loading_comparison",
+                    type="default",
+                    delay_show=500,
+                    children=[
+                        html.Div(
+                            [
+                                self.comparison_left,
+                                self.comparison_center,
+                                self.comparison_right,
+                                self.comparison_plot,
+                                self.comparison_stores
+                            ],
+                            className="grid-container",
+                        )
+                    ]
+                )
+            ])]
+        )
+
+        return comparison_tab
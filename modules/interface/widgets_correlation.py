@@ -0,0 +1,147 @@
+"""
+Class containing all Dash items and layout information for the correlation tab
+"""
+
+from dash import html, dcc
+
+
+class WidgetsCORRELATION:
+    def __init__(self):
+        # Reference positions, tolerance and plotted quantities
+        self.correlation_left = html.Div(
+            className="subgrid top-left",
+            children=[
+                html.Div(
+                    className="subgrid-1",
+                    children=[html.Label("Reference")],
+                ),
+                html.Div(
+                    className="subgrid-2",
+                    children=[
+                        dcc.Dropdown(
+                            id="correlation_reference",
+                            className="long-item",
+                            options=[],
+                            clearable=False,
+                        )
+                    ],
+                ),
+                html.Div(
+                    className="subgrid-3",
+                    children=[
+                        dcc.Input(
+                            id="correlation_tolerance",
+                            className="long-item",
+                            type="number",
+                            min=0,
+                            step=0.1,
+                            value=2,
+                            placeholder="Tolerance (mm)",
+                        )
+                    ],
+                ),
+                html.Div(
+                    className="subgrid-4",
+                    children=[
+                        dcc.Dropdown(
+                            id="correlation_x",
+                            className="long-item",
+                            options=[],
+                            placeholder="X quantity",
+                        )
+                    ],
+                ),
+                html.Div(
+                    className="subgrid-5",
+                    children=[
+                        dcc.Dropdown(
+                            id="correlation_y",
+                            className="long-item",
+                            options=[],
+                            placeholder="Y quantity",
+                        )
+                    ],
+                ),
+                html.Div(
+                    className="subgrid-6",
+                    children=[
+                        dcc.Dropdown(
+                            id="correlation_color",
+                            className="long-item",
+                            options=[],
+                            placeholder="Colour quantity",
+                        )
+                    ],
+                ),
+                html.Div(
+                    className="subgrid-7",
+                    children=[
+                        dcc.RadioItems(
+                            id="correlation_join_mode",
+                            options=[
+                                {"label": "Matched in all", "value": "inner"},
+                                {"label": "All reference", "value": "left"},
+                            ],
+                            value="inner",
+                        )
+                    ],
+                ),
+            ],
+        )
+
+        # Widget for the text box
+        self.correlation_center = html.Div(
+            className="textbox top-center",
+            children=[
+                html.Div(
+                    className="text-top",
+                    children=[html.Span(children="", id="correlation_path_box")],
+                ),
+                html.Div(
+                    className="text-mid",
+                    children=[html.Span(children="", id="correlation_text_box")],
+                ),
+            ],
+        )
+
+        # Number of matched positions by dataset
+        self.correlation_right = html.Div(
+            className="top-right",
+            children=[html.Span(children="", id="correlation_match_box", style={"white-space": "pre-line"})],
+        )
+
+        self.correlation_scatter = html.Div(
+            [dcc.Graph(id="correlation_scatter")], className="plot-left"
+        )
+
+        self.correlation_matrix = html.Div(
+            [dcc.Graph(id="correlation_matrix")], className="plot-right"
+        )
+
+    def make_tab_from_widgets(self):
+        correlation_tab = dcc.Tab(
+            id="correlation",
+            label="Correlation",
+            value="correlation",
+            children=[html.Div(children=[
+                dcc.Loading(
+                    id="loading_correlation",
+                    type="default",
+                    delay_show=500,
+                    children=[
+                        html.Div(
+                            [
+                                self.correlation_left,
+                                self.correlation_center,
+                                self.correlation_right,
+                                self.correlation_scatter,
+                                self.correlation_matrix,
+                            ],
+                            className="grid-container",
+                        )
+                    ]
+                )
+            ])]
+        )
+
+        return correlation_tab
@@ -4,6 +4,9 @@ Class containing all Dash items and layout information for the EDX tab
 
 from dash import html, dcc
 
+from ..interface.widgets_shared import (make_heatmap_interpolation_controls, make_heatmap_derived_controls,
+                                       make_heatmap_outlier_controls)
+
 
 class WidgetsEDX:
     def __init__(self):
@@ -110,7 +113,9 @@ class WidgetsEDX:
 
         # EDX heatmap
         self.edx_heatmap = html.Div(
-            [dcc.Graph(id="edx_heatmap")], className="plot-left"
+            [make_heatmap_interpolation_controls("edx"), make_heatmap_derived_controls("edx"),
+             make_heatmap_outlier_controls("edx"),
+             dcc.Graph(id="edx_heatmap")], className="plot-left"
         )
 
         # Stored variables
@@ -38,6 +38,11 @@ class WidgetsHDF5:
                     className='text-7',
                     children=[html.Button(id='hdf5_add_button', children='Add measurement', n_clicks=0)]
                 ),
+                html.Div(
+                    className='text-8',
+                    children=[html.Button(id='hdf5_cancel_button', children='Cancel', n_clicks=0,
+                                          style={'display': 'none'})]
+                ),
                 html.Div(
                     className='text-9',
                     children=[dcc.Dropdown(className='long-item',
@@ -58,7 +63,9 @@ class WidgetsHDF5:
                 ),
                 html.Div(
                     className="text-mid",
-                    children=[html.Span(children="test", id="hdf5_text_box")],
+                    children=[html.Span(children="test", id="hdf5_text_box"),
+                              html.Br(),
+                              html.Span(children="", id="hdf5_scheduler_status")],
                 ),
                 html.Div(
                     className='text-7',
@@ -66,11 +73,26 @@ class WidgetsHDF5:
                 ),
                 html.Div(
                     className='text-8',
-                    children=[html.Button(id='hdf5_update', children="Update HDF5 structure", n_clicks=0)]
+                    children=[html.Button(id='hdf5_update', children="Update HDF5 structure", n_clicks=0),
+                              html.Button(id='hdf5_repack', children="Compact HDF5", n_clicks=0)]
                 ),
                 html.Div(
                     className='text-9',
-                    children=[html.Button(id='hdf5_export', children="Export to CSV", n_clicks=0)]
+                    children=[
+                        dcc.Dropdown(
+                            id='hdf5_export_format',
+                            options=[{'label': 'CSV', 'value': 'csv'},
+                                     {'label': 'Parquet', 'value': 'parquet'},
+                                     {'label': 'Arrow IPC', 'value': 'arrow'}],
+                            value='csv',
+                            clearable=False
+                        ),
+                        html.Div(children=[
+                            html.Button(id='hdf5_export', children="Export file", n_clicks=0),
+                            html.Button(id='hdf5_export_folder', children="Export folder", n_clicks=0)],
+                            style={'display': 'flex', 'gap': '10px'}
+                        )
+                    ]
                 ),
             ],
         )
@@ -138,6 +160,7 @@ class WidgetsHDF5:
             children=[
                 dcc.Store(id="hdf5_upload_folder_root", data=upload_folder_root),
                 dcc.Store(id="hdf5_upload_folder_path", data=None),
+                dcc.Interval(id="hdf5_scheduler_interval", interval=5000),
             ]
         )
 
@@ -4,6 +4,9 @@ Class containing all Dash items and layout information for the MOKE tab
 
 from dash import html, dcc
 
+from ..interface.widgets_shared import (make_heatmap_interpolation_controls, make_heatmap_derived_controls,
+                                       make_heatmap_outlier_controls)
+
 
 
 class WidgetsMOKE:
@@ -32,6 +35,11 @@ class WidgetsMOKE:
                 html.Div(
                     className="text_8",
                     children=[html.Button(id='moke_make_database_button', children="Make database!", n_clicks=0)],
+                ),
+                html.Div(
+                    className="text-9",
+                    children=[html.Button(id='moke_cancel_button', children="Cancel", n_clicks=0,
+                                          style={"display": "none"})],
                 )
             ],
         )
@@ -194,6 +202,9 @@ class WidgetsMOKE:
         # Widget for Moke heatmap
         self.moke_heatmap = html.Div(
             children=[
+                make_heatmap_interpolation_controls("moke"),
+                make_heatmap_derived_controls("moke"),
+                make_heatmap_outlier_controls("moke"),
                 dcc.Graph(id="moke_heatmap"),
             ],
             className="plot-left",
@@ -238,6 +249,13 @@ class WidgetsMOKE:
                     id="moke_loop_map_button",
                     n_clicks=0,
                 ),
+                html.Button(
+                    className='column-2 long-item',
+                    children="Cancel",
+                    id="moke_loop_map_cancel_button",
+                    n_clicks=0,
+                    style={"display": "none"},
+                ),
                 dcc.Checklist(
                     className='long-item',
                     id="moke_loop_map_checklist",
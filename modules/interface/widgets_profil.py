@@ -3,6 +3,9 @@ Class containing all Dash items and layout information for the profil tab
 """
 from dash import html, dcc
 
+from ..interface.widgets_shared import (make_heatmap_interpolation_controls, make_heatmap_derived_controls,
+                                       make_heatmap_outlier_controls)
+
 
 class WidgetsPROFIL:
     def __init__(self):
@@ -24,6 +27,10 @@ class WidgetsPROFIL:
 
                 html.Div(className="text-mid", children=[
                     html.Span(children="test", id="profil_text_box")
+                ]),
+
+                html.Div(className="text-9", children=[
+                    html.Button(children="Cancel", id="profil_cancel_button", n_clicks=0, style={"display": "none"})
                 ])
             ]))
 
@@ -106,7 +113,9 @@ class WidgetsPROFIL:
 
         # EDX heatmap
         self.profil_heatmap = html.Div(
-            [dcc.Graph(id="profil_heatmap")], className="plot-left"
+            [make_heatmap_interpolation_controls("profil"), make_heatmap_derived_controls("profil"),
+             make_heatmap_outlier_controls("profil"),
+             dcc.Graph(id="profil_heatmap")], className="plot-left"
         )
 
         # Stored variables
@@ -115,7 +124,8 @@ class WidgetsPROFIL:
             dcc.Store(id="profil_database_path_store", data=None),
             dcc.Store(id="profil_file_path_store", data=None),
             dcc.Store(id="profil_parameters_store", data=None),
-            dcc.Store(id="profil_database_metadata_store", data=None)
+            dcc.Store(id="profil_database_metadata_store", data=None),
+            dcc.Store(id="profil_plot_overlay_store", data=None),
         ])
 
 
@@ -0,0 +1,128 @@
+"""
+Dash items shared by several tabs
+"""
+
+from dash import html, dcc
+
+
+def make_heatmap_interpolation_controls(prefix):
+    """
+    Interpolation controls displayed above the heatmap of a tab: method, dense grid resolution (mm), contours and
+    kriging uncertainty
+
+    Parameters:
+        prefix (str): tab name, the ids are {prefix}_heatmap_interpolation, {prefix}_heatmap_resolution and
+            {prefix}_heatmap_map_options
+
+    Returns:
+        html.Div
+    """
+    return html.Div(
+        style={"display": "flex", "gap": "10px", "align-items": "center"},
+        children=[
+            dcc.RadioItems(
+                id=f"{prefix}_heatmap_interpolation",
+                options=[
+                    {"label": "Measured", "value": "none"},
+                    {"label": "RBF", "value": "rbf"},
+                    {"label": "Kriging", "value": "kriging"},
+                ],
+                value="none",
+                inline=True,
+            ),
+            dcc.Input(
+                id=f"{prefix}_heatmap_resolution",
+                type="number",
+                min=0.25,
+                step=0.25,
+                value=1,
+                placeholder="Resolution (mm)",
+                style={"width": "80px"},
+            ),
+            dcc.Checklist(
+                id=f"{prefix}_heatmap_map_options",
+                options=[
+                    {"label": "Contours", "value": "contours"},
+                    {"label": "Uncertainty", "value": "uncertainty"},
+                ],
+                value=[],
+                inline=True,
+            ),
+        ],
+    )
+
+
+def make_heatmap_derived_controls(prefix):
+    """
+    Derived map controls displayed above the heatmap of a tab: reference dataset, operation and export button
+
+    Parameters:
+        prefix (str): tab name, the ids are {prefix}_heatmap_reference, {prefix}_heatmap_operation and
+            {prefix}_heatmap_export_derived
+
+    Returns:
+        html.Div
+    """
+    return html.Div(
+        style={"display": "flex", "gap": "10px", "align-items": "center"},
+        children=[
+            dcc.Dropdown(
+                id=f"{prefix}_heatmap_reference",
+                options=[],
+                value=None,
+                placeholder="Compare with dataset",
+                style={"width": "200px"},
+            ),
+            dcc.RadioItems(
+                id=f"{prefix}_heatmap_operation",
+                options=[
+                    {"label": "Difference", "value": "difference"},
+                    {"label": "Ratio", "value": "ratio"},
+                    {"label": "z-score", "value": "zscore"},
+                ],
+                value="difference",
+                inline=True,
+            ),
+            html.Button(id=f"{prefix}_heatmap_export_derived", children="Export map", n_clicks=0),
+        ],
+    )
+
+
+def make_heatmap_outlier_controls(prefix):
+    """
+    Outlier review controls displayed above the heatmap of a tab: robust z-score threshold, detection, selection of
+    the candidates to accept, accept and reject buttons, and the store holding the candidates waiting for review
+
+    Parameters:
+        prefix (str): tab name, the ids are {prefix}_outlier_threshold, {prefix}_outlier_detect,
+            {prefix}_outlier_select, {prefix}_outlier_accept, {prefix}_outlier_reject and {prefix}_outlier_store
+
+    Returns:
+        html.Div
+    """
+    return html.Div(
+        style={"display": "flex", "gap": "10px", "align-items": "center"},
+        children=[
+            dcc.Input(
+                id=f"{prefix}_outlier_threshold",
+                type="number",
+                min=1,
+                step=0.5,
+                value=3.5,
+                placeholder="Outlier threshold",
+                style={"width": "80px"},
+            ),
+            html.Button(id=f"{prefix}_outlier_detect", children="Find outliers", n_clicks=0),
+            dcc.Dropdown(
+                id=f"{prefix}_outlier_select",
+                options=[],
+                value=[],
+                multi=True,
+                placeholder="Candidates to accept",
+                style={"min-width": "300px"},
+            ),
+            html.Button(id=f"{prefix}_outlier_accept", children="Accept selected", n_clicks=0),
+            html.Button(id=f"{prefix}_outlier_reject", children="Reject all", n_clicks=0),
+            dcc.Store(id=f"{prefix}_outlier_store"),
+        ],
+    )
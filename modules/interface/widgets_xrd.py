@@ -4,6 +4,9 @@ Class containing all Dash items and layout information for the XRD tab
 
 from dash import html, dcc
 
+from ..interface.widgets_shared import (make_heatmap_interpolation_controls, make_heatmap_derived_controls,
+                                       make_heatmap_outlier_controls)
+
 class WidgetsXRD:
     def __init__(self, folderpath):
         
@@ -24,6 +27,10 @@ class WidgetsXRD:
 
                 html.Div(className="text-mid", children=[
                     html.Span(children="test", id="xrd_text_box")
+                ]),
+
+                html.Div(className="text-7", children=[
+                    html.Button(id="xrd_peak_search_button", children="Peak search", n_clicks=0)
                 ])
             ]))
 
@@ -81,6 +88,8 @@ class WidgetsXRD:
                                 {"label": "Image", "value": "image"},
                                 {"label": "Integrated", "value": "integrated"},
                                 {"label": "Fitted", "value": "fitted"},
+                                {"label": "Re-integrated", "value": "reintegrated"},
+                                {"label": "Caked", "value": "caked"},
                             ],
                             value="image"
                         )
@@ -97,6 +106,19 @@ class WidgetsXRD:
                         )
                     ]
                 ),
+                html.Div(className="subgrid-4", children=[
+                    html.Label("ROI"),
+                    dcc.Input(id="xrd_roi_name", className="long-item", type="text", placeholder="ROI name",
+                              value=None),
+                    dcc.Dropdown(id="xrd_roi_type", className="long-item", options=["rectangle", "annulus"],
+                                 value="rectangle")
+                ]),
+                html.Div(className="subgrid-5", id="xrd_roi_inputs", children=[
+
+                ]),
+                html.Div(className="subgrid-6", children=[
+                    html.Button(children="Compute ROI", id="xrd_roi_button", className="long-item", n_clicks=0)
+                ]),
                 html.Div(className="subgrid-7", children=[
                     html.Label("Image colorbar bounds"),
                     dcc.Input(id="xrd_image_max", className="long-item", type="number", placeholder="maximum value",
@@ -104,6 +126,19 @@ class WidgetsXRD:
                     dcc.Input(id="xrd_image_min", className="long-item", type="number", placeholder="minimum value",
                               value=None)
                 ]),
+                html.Div(className="subgrid-8", children=[
+                    html.Label("Image integration"),
+                    dcc.Input(id="xrd_integration_radial_bins", className="long-item", type="number",
+                              placeholder="radial bins", value=1000),
+                    dcc.Input(id="xrd_integration_chi_bins", className="long-item", type="number",
+                              placeholder="chi bins", value=36),
+                    dcc.Dropdown(id="xrd_integration_unit", className="long-item", options=["2th", "q"],
+                                 value="2th")
+                ]),
+                html.Div(className="subgrid-9", children=[
+                    html.Button(children="Integrate images", id="xrd_integration_button", className="long-item",
+                                n_clicks=0)
+                ]),
             ],
         )
 
@@ -114,7 +149,9 @@ class WidgetsXRD:
 
         # XRD heatmap
         self.xrd_heatmap = html.Div(
-            [dcc.Graph(id="xrd_heatmap")], className="plot-left"
+            [make_heatmap_interpolation_controls("xrd"), make_heatmap_derived_controls("xrd"),
+             make_heatmap_outlier_controls("xrd"),
+             dcc.Graph(id="xrd_heatmap")], className="plot-left"
         )
 
         # Stored variables
@@ -0,0 +1,10 @@
+#!/bin/bash
+# Serve the app with several worker processes and debug disabled (Unix only, gunicorn)
+cd "$(dirname "$0")"
+source .venv/bin/activate
+
+WORKERS=${WORKERS:-4}
+THREADS=${THREADS:-4}
+PORT=${PORT:-8050}
+
+gunicorn --workers "$WORKERS" --threads "$THREADS" --timeout 300 --bind "0.0.0.0:$PORT" app:server
@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+
+from modules.functions.functions_catalogue import (catalogue_connect, catalogue_write_file, catalogue_query,
+                                                   catalogue_plot_matches)
+
+STAT = SimpleNamespace(st_mtime_ns=0, st_size=0)
+
+
+def make_catalogue(tmp_path):
+    db_path = tmp_path / "catalogue.sqlite"
+    connection = catalogue_connect(db_path)
+    try:
+        # The second file has no sample name
+        for file_name, sample_name, thickness in [("named.hdf5", "S1", 100.0), ("unnamed.hdf5", None, 120.0)]:
+            result_rows = [("profil", x_pos, 0.0, "thickness", "nm", thickness + x_pos, 0) for x_pos in [-5.0, 5.0]]
+            catalogue_write_file(connection, tmp_path / file_name, tmp_path, STAT, sample_name, [], result_rows, [])
+    finally:
+        connection.close()
+    return db_path
+
+
+def test_repeated_conditions_keep_their_columns(tmp_path):
+    db_path = make_catalogue(tmp_path)
+
+    df = catalogue_query(db_path, [("thickness", ">", 90), ("thickness", ">", 90), ("thickness", "<", 200)])
+
+    assert list(df.columns[4:]) == ["thickness > 90", "thickness > 90 (c1)", "thickness < 200"]
+    assert len(df) == 4
+
+
+def test_files_without_sample_name_are_plotted(tmp_path):
+    df = catalogue_query(make_catalogue(tmp_path), [("thickness", ">", 0)])
+
+    fig = catalogue_plot_matches(df)
+
+    assert sorted(trace.name for trace in fig.data) == ["S1 (named.hdf5)", "unnamed.hdf5"]
+    assert sum(len(trace.x) for trace in fig.data) == 4
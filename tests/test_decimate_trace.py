@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from modules.functions.functions_shared import decimate_trace
+
+
+@pytest.fixture
+def trace():
+    x = np.linspace(0, 100, 100001)
+    y = np.sin(x) + np.random.default_rng(0).normal(0, 0.01, x.size)
+    y[12345] = 50.0
+    y[67890] = -50.0
+    return x, y
+
+
+def test_short_trace_is_unchanged():
+    x = np.arange(10.0)
+    decimated_x, decimated_y = decimate_trace(x, x**2, nb_points=100)
+
+    assert np.array_equal(decimated_x, x) and np.array_equal(decimated_y, x**2)
+
+
+def test_decimation_keeps_the_extrema(trace):
+    x, y = trace
+    decimated_x, decimated_y = decimate_trace(x, y, nb_points=2000)
+
+    assert len(decimated_x) <= 2000
+    assert np.all(np.diff(decimated_x) > 0)
+    assert decimated_x[0] == x[0] and decimated_x[-1] == x[-1]
+    # Single point spikes survive, and so does the minimum and maximum of every bucket
+    assert 50.0 in decimated_y and -50.0 in decimated_y
+    assert decimated_y.max() == y.max() and decimated_y.min() == y.min()
+    assert np.all(np.isin(decimated_y, y))
+
+
+def test_zoomed_range_is_decimated_at_full_budget(trace):
+    x, y = trace
+    decimated_x, decimated_y = decimate_trace(x, y, nb_points=2000, x_range=[10, 20])
+
+    # One point on each side of the range so that the line reaches the plot edges
+    assert decimated_x[0] < 10 <= decimated_x[1] and decimated_x[-2] <= 20 < decimated_x[-1]
+    assert 1000 < len(decimated_x) <= 2000
+    assert 50.0 in decimated_y
+
+
+def test_nan_values_are_skipped():
+    x = np.arange(10000.0)
+    y = np.cos(x / 100)
+    y[::7] = np.nan
+
+    decimated_x, decimated_y = decimate_trace(x, y, nb_points=500)
+
+    assert np.isfinite(decimated_y[1:-1]).all()
+    assert np.nanmax(decimated_y) == np.nanmax(y)
@@ -0,0 +1,129 @@
+import h5py
+import numpy as np
+import pytest
+
+from modules.functions import functions_profil
+from modules.functions.functions_profil import (profil_fit_position, profil_write_fit_results,
+                                                write_dektak_manual_height_to_hdf5,
+                                                profil_make_results_dataframe_from_hdf5)
+from modules.functions.functions_shared import (make_fit_key, create_fit_results_group, repack_hdf5, FIT_RESULTS_SETS,
+                                                FIT_RESULTS_SETS_KEPT)
+
+
+@pytest.fixture
+def profil_group(tmp_path):
+    distance = np.linspace(0, 4000, 4000)
+    profile = np.where(((distance - 500) // 500) % 2 == 0, 100.0, 0.0) * (distance >= 500)
+    profile += np.random.default_rng(0).normal(0, 1, distance.size)
+
+    with h5py.File(tmp_path / "sample.hdf5", "w") as hdf5_file:
+        group = hdf5_file.create_group("profil")
+        group.attrs["HT_type"] = "profil"
+        position_group = group.create_group("(0.0, 0.0)")
+        position_group.attrs["ignored"] = False
+        position_group["instrument/x_pos"] = 0.0
+        position_group["instrument/y_pos"] = 0.0
+        position_group["measurement/distance"] = distance
+        position_group["measurement/profile"] = profile
+        yield group
+
+
+@pytest.fixture
+def fit_counter(monkeypatch):
+    calls = []
+    fit_function = functions_profil.profil_spot_fit_steps
+
+    def counted_fit(*args):
+        calls.append(args[1:])
+        return fit_function(*args)
+
+    monkeypatch.setattr(functions_profil, "profil_spot_fit_steps", counted_fit)
+    return calls
+
+
+def fit_position(position_group, nb_steps, x0):
+    fit_key, results_dict = profil_fit_position(position_group, nb_steps, x0)
+    profil_write_fit_results(position_group, fit_key, results_dict)
+    return results_dict is not None
+
+
+def test_make_fit_key_is_stable():
+    raw_array = np.arange(10, dtype=np.float64)
+    key = make_fit_key({"nb_steps": 3, "x0": 500}, [raw_array], "1")
+
+    assert key == make_fit_key({"x0": 500, "nb_steps": 3}, [raw_array.copy()], "1")
+    assert key != make_fit_key({"nb_steps": 4, "x0": 500}, [raw_array], "1")
+    assert key != make_fit_key({"nb_steps": 3, "x0": 500}, [raw_array + 1], "1")
+    assert key != make_fit_key({"nb_steps": 3, "x0": 500}, [raw_array], "2")
+    assert key != make_fit_key({"nb_steps": 3, "x0": 500}, [raw_array.astype(np.float32)], "1")
+
+
+def test_unchanged_fit_is_relinked(profil_group, fit_counter):
+    position_group = profil_group["(0.0, 0.0)"]
+
+    assert fit_position(position_group, 3, 500)
+    first_link = position_group.get("results", getlink=True).path
+    assert fit_position(position_group, 2, 500)
+    assert not fit_position(position_group, 3, 500)
+
+    assert len(fit_counter) == 2
+    assert position_group.get("results", getlink=True).path == first_link
+    assert len(position_group[FIT_RESULTS_SETS]) == 2
+    assert len(position_group["results/extracted_heights"]) == 6
+
+
+def test_manual_height_keeps_fit_results(profil_group, fit_counter):
+    position_group = profil_group["(0.0, 0.0)"]
+    fit_position(position_group, 3, 500)
+    stored_set = position_group["results"]
+    fitted_height = stored_set["measured_height"][()]
+
+    write_dektak_manual_height_to_hdf5(position_group, 42)
+
+    results_group = position_group["results"]
+    assert not isinstance(position_group.get("results", getlink=True), h5py.SoftLink)
+    assert results_group["measured_height"][()] == 42
+    assert results_group.attrs["type"] == "manual"
+    assert "fit_parameters" in results_group and "extracted_heights" in results_group
+    # The stored set is unchanged, refitting with the same parameters gives back the fitted height
+    assert stored_set["measured_height"][()] == fitted_height
+    assert not fit_position(position_group, 3, 500)
+    assert position_group["results/measured_height"][()] == fitted_height
+    assert len(fit_counter) == 1
+
+    df = profil_make_results_dataframe_from_hdf5(profil_group)
+    assert "fit_parameters_(arb)" in df.columns
+
+
+def test_least_recently_used_sets_are_evicted(profil_group):
+    position_group = profil_group["(0.0, 0.0)"]
+    for index in range(FIT_RESULTS_SETS_KEPT + 2):
+        create_fit_results_group(position_group, f"key_{index}")
+
+    stored_sets = position_group[FIT_RESULTS_SETS]
+    assert len(stored_sets) == FIT_RESULTS_SETS_KEPT
+    assert "key_0" not in stored_sets and f"key_{FIT_RESULTS_SETS_KEPT + 1}" in stored_sets
+
+
+def test_repack_gives_back_evicted_space(tmp_path):
+    hdf5_path = tmp_path / "sample.hdf5"
+    with h5py.File(hdf5_path, "w") as hdf5_file:
+        hdf5_file.attrs["revision"] = 3
+        hdf5_file.create_group("profil/(0.0, 0.0)")
+    # One fit per session, like refits from the interface. Growing sets never fit in the space freed by the
+    # evictions, which is lost when the file is closed
+    for index in range(FIT_RESULTS_SETS_KEPT * 2):
+        with h5py.File(hdf5_path, "a") as hdf5_file:
+            results_group = create_fit_results_group(hdf5_file["profil/(0.0, 0.0)"], f"key_{index}")
+            results_group["data"] = np.zeros(10000 * (index + 1))
+
+    size_before, size_after = repack_hdf5(hdf5_path)
+
+    evicted_bytes = sum(10000 * (index + 1) * 8 for index in range(FIT_RESULTS_SETS_KEPT))
+    assert size_after < size_before - 0.9 * evicted_bytes
+    with h5py.File(hdf5_path, "r") as hdf5_file:
+        position_group = hdf5_file["profil/(0.0, 0.0)"]
+        last_key = f"key_{FIT_RESULTS_SETS_KEPT * 2 - 1}"
+        assert position_group.get("results", getlink=True).path == f"{FIT_RESULTS_SETS}/{last_key}"
+        assert position_group["results/data"].shape == (10000 * FIT_RESULTS_SETS_KEPT * 2,)
+        assert hdf5_file.attrs["revision"] == 4
@@ -0,0 +1,119 @@
+import h5py
+import numpy as np
+import pytest
+
+from modules.functions import functions_mask, functions_shared
+from modules.functions.functions_shared import open_hdf5, configure_shared_cache
+from modules.functions.functions_mask import (MASK_LAYERS, read_stored_mask_layers, get_mask_layers, write_mask_layers,
+                                              toggle_mask_point, flush_mask_edits, get_pending_mask_edits,
+                                              configure_mask_edits)
+
+# 13 positions, the packed layers do not fill their last byte. The last position is outside the wafer
+POSITIONS = [(x_pos, y_pos) for x_pos in [-10.0, -5.0, 0.0, 5.0] for y_pos in [-5.0, 0.0, 5.0]] + [(60.0, 30.0)]
+
+
+@pytest.fixture(autouse=True)
+def local_edit_buffer(monkeypatch):
+    # Edits are buffered in the module when the disk buffer is not configured
+    monkeypatch.setitem(functions_shared._shared_cache, "cache", None)
+    monkeypatch.setitem(functions_mask._mask_edits, "cache", None)
+    monkeypatch.setattr(functions_mask, "_mask_edits_local", {})
+
+
+@pytest.fixture
+def hdf5_path(tmp_path):
+    hdf5_path = tmp_path / "sample.hdf5"
+    with h5py.File(hdf5_path, "w") as hdf5_file:
+        group = hdf5_file.create_group("edx")
+        for x_pos, y_pos in POSITIONS:
+            position_group = group.create_group(f"({x_pos}, {y_pos})")
+            position_group.attrs["ignored"] = False
+            position_group["instrument/x_pos"] = x_pos
+            position_group["instrument/y_pos"] = y_pos
+    return hdf5_path
+
+
+def read_ignored(hdf5_group):
+    return np.array([hdf5_group[f"({x_pos}, {y_pos})"].attrs["ignored"] for x_pos, y_pos in POSITIONS])
+
+
+def test_layers_of_files_without_masks(hdf5_path):
+    with h5py.File(hdf5_path, "a") as hdf5_file:
+        hdf5_file["edx/(0.0, 5.0)"].attrs["ignored"] = True
+        layers = read_stored_mask_layers(hdf5_file["edx"])
+
+    assert set(layers) == set(MASK_LAYERS)
+    assert np.flatnonzero(layers["user_ignored"]).tolist() == [POSITIONS.index((0.0, 5.0))]
+    assert np.flatnonzero(layers["outside_wafer"]).tolist() == [len(POSITIONS) - 1]
+    assert not layers["auto_outlier"].any() and not layers["failed_fit"].any()
+
+
+def test_bit_packed_layers_round_trip(hdf5_path):
+    rng = np.random.default_rng(0)
+    layers = {layer: rng.random(len(POSITIONS)) < 0.4 for layer in ["user_ignored", "auto_outlier", "failed_fit"]}
+
+    with h5py.File(hdf5_path, "a") as hdf5_file:
+        write_mask_layers(hdf5_file["edx"], layers)
+
+    with h5py.File(hdf5_path, "r") as hdf5_file:
+        group = hdf5_file["edx"]
+        assert group.attrs["mask_length"] == len(POSITIONS)
+        assert group.attrs["mask_user_ignored"].size == 2
+        stored_layers = read_stored_mask_layers(group)
+        for layer, mask in layers.items():
+            assert np.array_equal(stored_layers[layer], mask)
+        # outside_wafer is not copied to the ignored attributes, the other layers are
+        assert stored_layers["outside_wafer"][-1]
+        assert np.array_equal(read_ignored(group), np.logical_or.reduce(list(layers.values())))
+
+
+def test_toggles_are_buffered_until_flushed(hdf5_path):
+    point_layers, nb_pending = toggle_mask_point(hdf5_path, "edx", 5.0, 0.0)
+
+    assert point_layers == {"user_ignored": True, "outside_wafer": False, "auto_outlier": False, "failed_fit": False}
+    assert nb_pending == 1
+    index = POSITIONS.index((5.0, 0.0))
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        assert not read_stored_mask_layers(hdf5_file["edx"])["user_ignored"][index]
+        assert get_mask_layers(hdf5_file["edx"]).layers["user_ignored"][index]
+
+    assert flush_mask_edits(hdf5_path) == 1
+    assert get_pending_mask_edits(hdf5_path, "edx") == {}
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        assert read_stored_mask_layers(hdf5_file["edx"])["user_ignored"][index]
+        assert np.flatnonzero(read_ignored(hdf5_file["edx"])).tolist() == [index]
+
+    # Toggling again unmasks the point
+    point_layers, nb_pending = toggle_mask_point(hdf5_path, "edx", 5.0, 0.0)
+    assert not point_layers["user_ignored"]
+    flush_mask_edits(hdf5_path)
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        assert not read_ignored(hdf5_file["edx"]).any()
+
+
+def test_toggles_are_written_once_the_buffer_is_full(hdf5_path, monkeypatch):
+    monkeypatch.setattr(functions_mask, "MASK_FLUSH_SIZE", 3)
+
+    nb_pending_list = [toggle_mask_point(hdf5_path, "edx", x_pos, y_pos)[1] for x_pos, y_pos in POSITIONS[:3]]
+
+    assert nb_pending_list == [1, 2, 0]
+    with open_hdf5(hdf5_path, "r") as hdf5_file:
+        assert read_stored_mask_layers(hdf5_file["edx"])["user_ignored"][:3].all()
+
+
+def test_toggle_of_unknown_position(hdf5_path):
+    assert toggle_mask_point(hdf5_path, "edx", 100.0, 100.0) == (None, 0)
+
+
+def test_buffered_edits_survive_a_full_shared_cache(hdf5_path, tmp_path):
+    shared_cache = configure_shared_cache(tmp_path / "shared", size_limit=2**20)
+    configure_mask_edits(tmp_path / "mask_edits")
+    toggle_mask_point(hdf5_path, "edx", 5.0, 0.0)
+
+    # Ten times the size limit of the shared cache, its oldest entries are evicted
+    for index in range(10):
+        shared_cache.set(("filler", index), bytes(2**20))
+    assert len(shared_cache) < 10
+
+    assert get_pending_mask_edits(hdf5_path, "edx") == {("user_ignored", 5.0, 0.0): True}
+    assert flush_mask_edits(hdf5_path) == 1
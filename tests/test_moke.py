@@ -0,0 +1,61 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from modules.functions.functions_moke import moke_treat_measurement_dataframe
+
+OPTIONS = {"coil_factor": 0.92, "pulse_voltage": 100, "smoothing_polyorder": 1, "smoothing_range": 5}
+
+
+def make_loop(length):
+    # First pulse 0 → -X → 0, second pulse 0 → +X → 0, the point between the pulses at zero field
+    time = np.linspace(0, 2 * np.pi, length, endpoint=False)
+    integrated_pulse = -3 * np.sin(time) + np.random.default_rng(length).normal(0, 0.01, length)
+    integrated_pulse[length // 2] = 0.0
+    integrated_pulse[[3, length // 2 - 1]] = np.nan
+    return pd.DataFrame({"integrated_pulse": integrated_pulse, "magnetization": np.tanh(3 * np.cos(time)) + 0.1})
+
+
+def reference_treatment(measurement_df, options_dict):
+    """Row by row treatment the vectorized one replaced"""
+    midpoint = len(measurement_df) // 2
+    max_field = options_dict["pulse_voltage"] * options_dict["coil_factor"] / 100
+    pulse = measurement_df["integrated_pulse"]
+    measurement_df.loc[:midpoint, "field"] = pulse.loc[:midpoint].apply(lambda x: -x * max_field / abs(pulse.min()))
+    measurement_df.loc[midpoint:, "field"] = pulse.loc[midpoint:].apply(lambda x: -x * max_field / abs(pulse.max()))
+
+    if options_dict["correct_offset"]:
+        measurement_df["magnetization"] = measurement_df["magnetization"] - measurement_df["magnetization"].mean()
+
+    if options_dict["filter_zero"]:
+        length = len(measurement_df)
+        measurement_df = measurement_df[measurement_df["field"].notna()].copy()
+        measurement_df.loc[: length // 2, "field"] = measurement_df.loc[: length // 2, "field"].where(
+            measurement_df["field"] > 1e-2
+        )
+        measurement_df.loc[length // 2 :, "field"] = measurement_df.loc[length // 2 :, "field"].where(
+            measurement_df["field"] < -1e-2
+        )
+
+    if options_dict["connect_loops"]:
+        measurement_df = measurement_df[measurement_df["field"].notna()]
+        midpoint = len(measurement_df) // 2
+        reordered = pd.concat([measurement_df.iloc[midpoint:], measurement_df.iloc[:midpoint]], ignore_index=True)
+        measurement_df = pd.concat([reordered, reordered.iloc[:1]], ignore_index=True)
+    return measurement_df
+
+
+@pytest.mark.parametrize("length", [100, 101])
+@pytest.mark.parametrize("filter_zero, connect_loops, correct_offset", list(itertools.product([True, False], repeat=3)))
+def test_treatment_matches_the_reference(length, filter_zero, connect_loops, correct_offset):
+    options_dict = {**OPTIONS, "smoothing": False, "filter_zero": filter_zero, "connect_loops": connect_loops,
+                    "correct_offset": correct_offset}
+
+    treated_df = moke_treat_measurement_dataframe(make_loop(length), options_dict)
+
+    pd.testing.assert_frame_equal(treated_df, reference_treatment(make_loop(length), options_dict))
+    if filter_zero and not connect_loops:
+        # The point between the pulses is above neither threshold
+        assert np.isnan(treated_df.loc[length // 2, "field"])
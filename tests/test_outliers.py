@@ -0,0 +1,88 @@
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from modules.functions import functions_shared
+from modules.functions.functions_outliers import (neighbourhood_median_mad, detect_outliers, outliers_make_store,
+                                                  outliers_accept)
+from modules.functions.functions_shared import is_on_wafer, get_dataset_positions
+from modules.functions.functions_mask import read_stored_mask_layers
+
+
+@pytest.fixture
+def results_df():
+    x_grid, y_grid = np.meshgrid(np.arange(-40, 45, 5.0), np.arange(-40, 45, 5.0))
+    on_wafer = is_on_wafer(x_grid, y_grid)
+    x_array, y_array = x_grid[on_wafer], y_grid[on_wafer]
+    rng = np.random.default_rng(3)
+    return pd.DataFrame({
+        "x_pos (mm)": x_array,
+        "y_pos (mm)": y_array,
+        "ignored": False,
+        # A smooth gradient and a constant result, both with a little noise
+        "thickness (nm)": 100 + 0.5 * x_array + 0.2 * y_array + rng.normal(0, 0.1, len(x_array)),
+        "Element Fe (at.%)": 30 + rng.normal(0, 0.1, len(x_array)),
+    })
+
+
+def find_row(df, x_pos, y_pos):
+    return df.index[(df["x_pos (mm)"] == x_pos) & (df["y_pos (mm)"] == y_pos)][0]
+
+
+def test_neighbourhood_leaves_the_point_out():
+    plane = np.arange(9.0).reshape(1, 3, 3)
+    plane[0, 1, 1] = 1000
+
+    median, mad, nb_neighbours = neighbourhood_median_mad(plane)
+
+    assert median[0, 1, 1] == 4.0
+    assert nb_neighbours[0, 1, 1] == 8 and nb_neighbours[0, 0, 0] == 3
+
+
+def test_planted_outliers_are_flagged(results_df):
+    # The gradient spreads the neighbours of a point by a few nm, the planted step stands well above it
+    results_df.loc[find_row(results_df, 10.0, -5.0), "thickness (nm)"] += 20
+    results_df.loc[find_row(results_df, -20.0, 15.0), "Element Fe (at.%)"] = 35
+
+    outlier_df = detect_outliers(results_df)
+
+    flagged = list(zip(outlier_df["x_pos (mm)"], outlier_df["y_pos (mm)"], outlier_df["column"]))
+    assert sorted(flagged) == [(-20.0, 15.0, "Element Fe (at.%)"), (10.0, -5.0, "thickness (nm)")]
+    assert (outlier_df["score"] > 3.5).all()
+
+
+def test_gradient_alone_is_not_flagged(results_df):
+    assert detect_outliers(results_df).empty
+
+
+def test_ignored_points_are_left_out_of_the_statistics(results_df):
+    # An ignored point far off does not make its neighbours stand out, and is not flagged itself
+    results_df.loc[find_row(results_df, 0.0, 0.0), ["thickness (nm)", "ignored"]] = [1e6, True]
+
+    assert detect_outliers(results_df).empty
+
+
+def test_accepted_candidates_are_added_to_the_layer(tmp_path, monkeypatch):
+    monkeypatch.setitem(functions_shared._shared_cache, "cache", None)
+    positions = [(x_pos, 0.0) for x_pos in [-10.0, -5.0, 0.0, 5.0, 10.0]]
+    hdf5_path = tmp_path / "sample.hdf5"
+    with h5py.File(hdf5_path, "w") as hdf5_file:
+        for x_pos, y_pos in positions:
+            position_group = hdf5_file.create_group(f"edx/({x_pos}, {y_pos})")
+            position_group.attrs["ignored"] = False
+            position_group["instrument/x_pos"] = x_pos
+            position_group["instrument/y_pos"] = y_pos
+
+    candidates = pd.DataFrame({"x_pos (mm)": [-10.0, 0.0, 10.0], "y_pos (mm)": 0.0, "column": "a", "score": 5.0})
+    outlier_store = outliers_make_store("edx", candidates)
+
+    assert outliers_accept(hdf5_path, outlier_store, [0]) == (1, 1)
+    # Later reviews add to the layer, the rejected candidate stays unmasked
+    assert outliers_accept(hdf5_path, outlier_store, [2]) == (1, 2)
+
+    with h5py.File(hdf5_path, "r") as hdf5_file:
+        auto_outlier = read_stored_mask_layers(hdf5_file["edx"])["auto_outlier"]
+        flagged = {tuple(position) for position in get_dataset_positions(hdf5_file["edx"])[auto_outlier]}
+        assert flagged == {(-10.0, 0.0), (10.0, 0.0)}
+        assert hdf5_file["edx/(10.0, 0.0)"].attrs["ignored"] and not hdf5_file["edx/(0.0, 0.0)"].attrs["ignored"]
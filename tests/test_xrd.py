@@ -0,0 +1,186 @@
+import h5py
+import numpy as np
+import pytest
+
+from modules.functions.functions_xrd import (xrd_estimate_background, xrd_find_peaks, xrd_batch_peak_search,
+                                             xrd_make_results_dataframe_from_hdf5, xrd_calc_pixel_angles,
+                                             xrd_make_integration_matrix, xrd_batch_integrate_images,
+                                             xrd_store_integration_matrices)
+from modules.hdf5_compilers.hdf5compile_xrd import xrd_peaks_dict_to_hdf5
+
+ANGLE = np.linspace(20, 80, 3000)
+GEOMETRY = {"shape": (201, 241), "center_x": 120.0, "center_y": 100.0, "pixel_x": 0.1, "pixel_y": 0.1,
+            "distance": 100.0, "two_theta": 0.0, "wavelength": 1.5406}
+RING = (8.0, 8.5)
+PEAKS = [(30.0, 1000.0, 0.1), (45.0, 400.0, 0.15), (62.0, 2000.0, 0.08)]
+
+
+def make_pattern(shift=0.0, seed=0):
+    baseline = 200 + 2 * ANGLE
+    peaks = sum(height * np.exp(-((ANGLE - center - shift) ** 2) / (2 * sigma**2)) for center, height, sigma in PEAKS)
+    return baseline, peaks + np.random.default_rng(seed).normal(0, 3, ANGLE.size)
+
+
+@pytest.fixture
+def xrd_group(tmp_path):
+    with h5py.File(tmp_path / "sample.hdf5", "w") as hdf5_file:
+        group = hdf5_file.create_group("xrd")
+        group.attrs["HT_type"] = "xrd"
+        group.attrs["instrument"] = "Rigaku Smartlab"
+        for index, x_pos in enumerate([-5.0, 0.0, 5.0]):
+            position_group = group.create_group(f"({x_pos}, 0.0)")
+            position_group.attrs["ignored"] = False
+            position_group["instrument/x_pos"] = x_pos
+            position_group["instrument/y_pos"] = 0.0
+            baseline, peaks = make_pattern(seed=index)
+            position_group["measurement/angle"] = ANGLE
+            position_group["measurement/counts"] = baseline + peaks
+        yield group
+
+
+def test_background_follows_the_baseline():
+    baseline, peaks = make_pattern()
+    background = xrd_estimate_background(baseline + peaks, iterations=40)
+
+    away_from_peaks = np.all([np.abs(ANGLE - center) > 5 * sigma for center, height, sigma in PEAKS], axis=0)
+    assert np.allclose(background[away_from_peaks], baseline[away_from_peaks], rtol=0.05)
+    for center, height, sigma in PEAKS:
+        # The peaks are clipped, their top is left in the net intensity
+        top = np.argmin(np.abs(ANGLE - center))
+        assert background[top] < baseline[top] + 0.1 * height
+
+
+def test_background_of_a_stack_matches_single_patterns():
+    stack = np.stack([np.sum(make_pattern(shift, seed), axis=0) for seed, shift in enumerate([0.0, 0.5, 1.0])])
+
+    background = xrd_estimate_background(stack)
+
+    assert background.shape == stack.shape
+    assert np.allclose(background[1], xrd_estimate_background(stack[1]))
+
+
+def test_find_peaks_on_synthetic_pattern():
+    baseline, peaks = make_pattern()
+
+    peaks_dict = xrd_find_peaks(ANGLE, peaks)
+
+    assert len(peaks_dict["position"]) == len(PEAKS)
+    step = ANGLE[1] - ANGLE[0]
+    for position, height, fwhm, (center, true_height, sigma) in zip(
+        peaks_dict["position"], peaks_dict["height"], peaks_dict["fwhm"], PEAKS
+    ):
+        assert position == pytest.approx(center, abs=step)
+        assert height == pytest.approx(true_height, rel=0.05)
+        assert fwhm == pytest.approx(2 * np.sqrt(2 * np.log(2)) * sigma, rel=0.1)
+
+
+def test_peak_columns_do_not_change_between_searches(xrd_group):
+    results_dict = xrd_batch_peak_search(xrd_group)
+    assert all(len(position_results) == len(PEAKS) for position_results in results_dict.values())
+
+    xrd_peaks_dict_to_hdf5(xrd_group, results_dict)
+    columns = list(xrd_make_results_dataframe_from_hdf5(xrd_group).columns)
+    assert "[peak_1]_position_(deg)" in columns and "[peak_1]_reference_(deg)" in columns
+
+    # Shifted peaks give new reference positions, not new columns
+    for index, (position, position_group) in enumerate(xrd_group.items()):
+        baseline, peaks = make_pattern(shift=0.02, seed=index)
+        position_group["measurement/counts"][...] = baseline + peaks
+    xrd_peaks_dict_to_hdf5(xrd_group, xrd_batch_peak_search(xrd_group))
+
+    df = xrd_make_results_dataframe_from_hdf5(xrd_group)
+    assert list(df.columns) == columns
+    assert df["[peak_1]_reference_(deg)"].iloc[0] == pytest.approx(PEAKS[0][0] + 0.02, abs=0.05)
+
+
+def make_ring_image():
+    two_theta, chi = xrd_calc_pixel_angles(GEOMETRY)
+    return np.where((two_theta >= RING[0]) & (two_theta < RING[1]), 100.0, 1.0)
+
+
+@pytest.fixture
+def smartlab_group(tmp_path):
+    header = {
+        "DETECTOR_NAMES": b"PIXIS_",
+        "PIXIS_SPATIAL_DISTORTION_INFO": f"{GEOMETRY['center_x']} {GEOMETRY['center_y']} 0.1 0.1".encode(),
+        "PIXIS_GONIO_NAMES": b"TwoThetaSwing Distance",
+        "PIXIS_GONIO_VALUES": b"0.0 100.0",
+        "SOURCE_WAVELENGTH": b"1 1.5406",
+    }
+    with h5py.File(tmp_path / "sample.hdf5", "w") as hdf5_file:
+        group = hdf5_file.create_group("xrd")
+        group.attrs["HT_type"] = "xrd"
+        group.attrs["instrument"] = "Rigaku Smartlab"
+        for scale, x_pos in enumerate([0.0, 5.0], start=1):
+            position_group = group.create_group(f"({x_pos}, 0.0)")
+            position_group["instrument/x_pos"] = x_pos
+            position_group["instrument/y_pos"] = 0.0
+            for key, value in header.items():
+                position_group[f"instrument/image/{key}"] = value
+            position_group["measurement/2Dimage"] = scale * make_ring_image()
+        yield group
+
+
+def test_integration_matrix_bins_every_pixel_once():
+    matrix, radial_array, chi_array = xrd_make_integration_matrix(GEOMETRY, nb_radial_bins=100, nb_chi_bins=8)
+
+    assert matrix.shape == (8 * 100, 201 * 241)
+    assert np.all(np.diff(matrix.tocsc().indptr) == 1)
+    assert np.all(np.diff(radial_array) > 0) and np.all(np.diff(chi_array) > 0)
+
+
+def test_chi_bins_of_a_detector_across_180_degrees():
+    # The beam is right of the detector, its pixels are all around chi = ±180°
+    geometry = {**GEOMETRY, "center_x": 400.0}
+    two_theta, chi = xrd_calc_pixel_angles(geometry)
+    assert chi.min() < -170 and chi.max() > 170
+
+    matrix, radial_array, chi_array = xrd_make_integration_matrix(geometry, nb_radial_bins=100, nb_chi_bins=8)
+
+    assert np.all(np.diff(matrix.tocsc().indptr) == 1)
+    assert np.all(np.diff(chi_array) > 0)
+    # The bins span the detector only, every chi bin holds pixels
+    assert chi_array[0] < 180 < chi_array[-1] and chi_array[-1] - chi_array[0] < 90
+    pixels_per_chi = np.asarray(matrix.sum(axis=1)).reshape(8, 100).sum(axis=1)
+    assert np.all(pixels_per_chi > 0)
+
+
+def test_integrated_ring_is_a_peak_at_its_angle(smartlab_group):
+    matrix_dict = {}
+    results_dict = xrd_batch_integrate_images(smartlab_group, nb_radial_bins=200, nb_chi_bins=8,
+                                              matrix_dict=matrix_dict)
+
+    assert len(results_dict) == 2
+    for scale, position in enumerate(["(0.0, 0.0)", "(5.0, 0.0)"], start=1):
+        results = results_dict[position]
+        assert results["caked"].shape == (8, 200)
+        in_ring = (results["radial"] > RING[0] + 0.1) & (results["radial"] < RING[1] - 0.1)
+        outside = (results["radial"] < RING[0] - 0.1) | (results["radial"] > RING[1] + 0.1)
+        assert np.allclose(results["intensity"][in_ring], 100 * scale)
+        assert np.allclose(results["intensity"][outside & np.isfinite(results["intensity"])], scale)
+
+    # The matrix of the geometry is built once, stored in the dataset and reused
+    assert len(matrix_dict) == 1 and "integration" not in smartlab_group
+    xrd_store_integration_matrices(smartlab_group, matrix_dict)
+    matrix_dict = {}
+    second_dict = xrd_batch_integrate_images(smartlab_group, nb_radial_bins=200, nb_chi_bins=8,
+                                             matrix_dict=matrix_dict)
+    assert np.allclose(second_dict["(0.0, 0.0)"]["intensity"], results_dict["(0.0, 0.0)"]["intensity"],
+                       equal_nan=True)
+    assert list(matrix_dict.values()) == [None] and len(smartlab_group["integration"]) == 1
+
+    # Integrating with other bins replaces the stored matrix
+    matrix_dict = {}
+    xrd_batch_integrate_images(smartlab_group, nb_radial_bins=100, nb_chi_bins=4, matrix_dict=matrix_dict)
+    xrd_store_integration_matrices(smartlab_group, matrix_dict)
+    assert list(smartlab_group["integration"]) == list(matrix_dict)
+    assert smartlab_group["integration"][next(iter(matrix_dict))]["chi"].size == 4
+
+
+def test_parallel_search_matches_a_single_chunk(xrd_group):
+    serial_dict = xrd_batch_peak_search(xrd_group)
+    parallel_dict = xrd_batch_peak_search(xrd_group, chunk_size=1, max_workers=2)
+
+    assert parallel_dict.keys() == serial_dict.keys()
+    for position, position_results in serial_dict.items():
+        assert parallel_dict[position] == position_results